@@ -8,7 +8,10 @@ Each data instance is a 10x10x2 tensor:
   * [r,c,0] contains a map of the turns in which the square at row=r, col=c has been shot.
     0 means the square has not been shot yet.
   * [r,c,1] contains a map of the result codes obtained at each position.
-    See code_to_hits_sunks() and hits_sunks_to_code().
+    See code_to_hit_sunk_list and hit_sunk_to_code_dict.
+
+simulate_games() produces one such observation per turn of simulated games, together
+with the shots made and the result code obtained in that turn.
 
 
 """
@@ -17,16 +20,18 @@ __date__ = "24/09/2018"
 
 import sys
 import os
+import abc
 import sqlite3
 import numpy as np
-import pickle
-import multiprocessing
 import itertools
+import multiprocessing
+import random
 import time
 
 sys.path.append("..")
 import generation
 import game
+import player
 
 # -------------------------- Begin configurable part
 
@@ -36,50 +41,93 @@ base_board_db_path = "board_database.sq3"
 # Be verbose?
 be_verbose = True
 
-base_board_table_name = "placements"
+# Table of placements and table with the generation checkpoint
+base_board_table_name = "packed_placements"
+checkpoint_table_name = "generation_checkpoint"
+
+# Rounds of the Feistel network used to shuffle datasets without storing the permutation
+feistel_round_count = 4
 
 
 # -------------------------- End configurable part
 
 class BoardDB:
     """Class to create, store and retrieve valid board layouts.
+
+    Each placement is stored as a fixed-size blob of ceil(width*height/8) bytes (13 for 10x10 boards):
+    bit (row-1)*width + (col-1) of the little-endian integer in the blob is set if and only if square
+    (row, col) is occupied. Among the symmetric images of a placement (see `generation.get_symmetric_placements`),
+    only the one with the smallest blob is stored. The blob is the primary key of a WITHOUT ROWID table,
+    so duplicates are discarded by SQLite itself with INSERT OR IGNORE. Since boats cannot touch, boats are fully determined by the occupied squares
+    (see `BoardDB.binary_map_to_placement`).
+
+    The database uses write-ahead logging, and `BoardDB.generate_placements` records in
+    `checkpoint_table_name` its seed and the number of batches completed in the same
+    transaction as each batch, so that interrupted runs can be resumed.
     """
-    # Table of valid placements
     base_board_creation_query = f"""
-        CREATE TABLE {base_board_table_name} (
-         binary_map       TEXT     NOT NULL,
-         rc_lists_pickle  TEXT     NOT NULL,
-         CONSTRAINT unique_boards UNIQUE(binary_map)
+        CREATE TABLE IF NOT EXISTS {base_board_table_name} (
+         binary_map       BLOB     PRIMARY KEY
+        ) WITHOUT ROWID;"""
+    checkpoint_creation_query = f"""
+        CREATE TABLE IF NOT EXISTS {checkpoint_table_name} (
+         id                INTEGER  PRIMARY KEY CHECK (id = 0),
+         seed              INTEGER  NOT NULL,
+         batch_size        INTEGER  NOT NULL,
+         next_batch_index  INTEGER  NOT NULL
         );"""
-    base_board_insertion_query = f"""
-        INSERT INTO {base_board_table_name} 
-        (binary_map, rc_lists_pickle) VALUES (?, ?);"""
+    base_board_insertion_query = f"INSERT OR IGNORE INTO {base_board_table_name} (binary_map) VALUES (?);"
     base_board_count_query = f"SELECT COUNT(ALL) FROM {base_board_table_name};"
+    base_board_selection_query = f"SELECT binary_map FROM {base_board_table_name};"
+    checkpoint_selection_query = f"SELECT seed, batch_size, next_batch_index FROM {checkpoint_table_name};"
+    checkpoint_update_query = f"""
+        INSERT OR REPLACE INTO {checkpoint_table_name} 
+        (id, seed, batch_size, next_batch_index) VALUES (0, ?, ?, ?);"""
 
-    def __init__(self):
+    def __init__(self, db_path=None):
         """Connect to the database, creating tables as necessary.
+        :param db_path: path to the database file. If None, base_board_db_path is used.
         """
-        self.board_placer = generation.RandomBoatPlacer()
+        self.db_path = db_path if db_path is not None else base_board_db_path
+        self.width = game.Battl3ship.default_board_width
+        self.height = game.Battl3ship.default_board_height
+        self.binary_map_byte_count = (self.width * self.height + 7) // 8
+        # Row i contains, for each square index, the index of the square mapped to it by the i-th symmetry
+        index_by_row_col = {(row, col): (row - 1) * self.width + (col - 1)
+                            for row in range(1, self.height + 1)
+                            for col in range(1, self.width + 1)}
+        self._symmetry_source_indices = np.argsort([
+            [index_by_row_col[symmetry(row_col)] for row_col in index_by_row_col.keys()]
+            for symmetry in generation.get_board_symmetries(width=self.width, height=self.height)], axis=1)
         try:
-            self.conn = self._open_database(create_ok=not os.path.exists(base_board_db_path))
+            self.conn = self._open_database(create_ok=not os.path.exists(self.db_path))
         except IOError as ex:
             raise IOError("Database seemed corrupted") from ex
 
     def insert_placement(self, boat_placement, commit=True):
-        """Insert a placement in `base_board_table`. Its validity is not verified
+        """Insert a placement in `base_board_table`. Its validity is not verified.
 
-        :raise ValueError: if the placement was already contained in the table
+        Only one of the symmetric images of each placement is stored, so that each row represents all of them.
+        Use `generation.get_symmetric_placements` to recover them.
+
+        :raise ValueError: if the placement or any of its symmetric images was already contained in the table
         """
-        binary_map = self._placement_to_binary_map(boat_placement)
-        rc_lists_str = pickle.dumps((sorted(boat_placement)))
+        if self.insert_placements(boat_placements=[boat_placement], commit=commit) == 0:
+            raise ValueError("Duplicated board")
 
-        try:
-            self.conn.execute(self.base_board_insertion_query, (binary_map, rc_lists_str))
-        except sqlite3.IntegrityError as ex:
-            raise ValueError("Duplicated board") from ex
+    def insert_placements(self, boat_placements, commit=True):
+        """Insert several placements in `base_board_table` at once, ignoring those
+        (or any of their symmetric images) already contained in the table.
+        Their validity is not verified.
 
+        :return: the number of placements actually inserted
+        """
+        changes_before = self.conn.total_changes
+        self.conn.executemany(self.base_board_insertion_query,
+                              ((binary_map,) for binary_map in self._placements_to_binary_maps(boat_placements)))
         if commit:
             self.conn.commit()
+        return self.conn.total_changes - changes_before
 
     def count_placements(self):
         """Return the number of placements currently available in the DB.
@@ -88,76 +136,130 @@ class BoardDB:
         for r in cur:
             return int(r[0])
 
-    def generate_placements(self, target_placement_count):
+    def generate_placements(self, target_placement_count, seed=None, batch_size=512):
         """Generate random boat placements until the database contains at least
-        `min_count` entries. If the database of placements contains at least
-        that number of entries, this function does not add any additional ones.
-        """
-        current_count = self.count_placements()
-        missing_placements = target_placement_count - current_count
-        batch_size = 512
+        `target_placement_count` entries (i.e., classes of symmetric placements). If the database of placements
+        contains at least that number of entries, this function does not add any additional ones.
 
-        with multiprocessing.Pool() as pool:
-            while missing_placements > 0:
-                time_before = time.time()
-                new_placements = list(itertools.chain(*pool.imap_unordered(
-                    func=BoardDB._get_placement_batch,
-                    iterable=[batch_size for _ in range(os.cpu_count())],
-                    chunksize=1)))
+        Placements are streamed from `generation.generate_placements` and committed in batches
+        of `batch_size`, so memory usage does not grow with `target_placement_count`.
+        Each commit also updates the generation checkpoint. If the run is interrupted, calling
+        this method again with the same seed (or with seed=None) and batch_size resumes it.
 
-                new_placements = new_placements[:missing_placements]
+        :param seed: master seed passed to `generation.generate_placements`. Runs with the same
+          seed starting from the same database produce the same database. If None, the seed of the
+          checkpoint is used if available, or a random one otherwise.
+        """
+        missing_placements = target_placement_count - self.count_placements()
+        if missing_placements <= 0:
+            return
+
+        first_batch_index = 0
+        checkpoint = self.conn.execute(self.checkpoint_selection_query).fetchone()
+        if checkpoint is not None and (seed is None or seed == checkpoint[0]) and batch_size == checkpoint[1]:
+            seed, _, first_batch_index = checkpoint
+            if be_verbose:
+                print(f"Resuming generation with seed={seed} from batch {first_batch_index}")
+        elif seed is None:
+            # SQLite integers are signed 64-bit values
+            seed = random.getrandbits(63)
+
+        # Placements are requested until enough non-duplicated ones are inserted
+        placements = generation.generate_placements(
+            seed=seed, batch_size=batch_size, first_batch_index=first_batch_index)
+        try:
+            for batch_index in itertools.count(first_batch_index):
+                time_before = time.time()
+                new_placements = list(itertools.islice(placements, batch_size))
                 time_placement = time.time() - time_before
 
                 time_before = time.time()
-                discarded_placements = 0
-                for placement in new_placements:
-                    try:
-                        self.insert_placement(boat_placement=placement, commit=False)
-                    except ValueError:
-                        discarded_placements += 1
+                inserted_placements = self.insert_placements(boat_placements=new_placements, commit=False)
+                self.conn.execute(self.checkpoint_update_query, (seed, batch_size, batch_index + 1))
                 self.conn.commit()
                 time_insert = time.time() - time_before
 
+                missing_placements -= inserted_placements
+
                 if be_verbose:
+                    current_count = self.count_placements()
                     print(f"Completed batch. Times: "
                           f"placement={time_placement}, "
                           f"insert={time_insert}, "
-                          f"discarded={discarded_placements}, "
-                          f"per board={(time_placement + time_insert) / (len(new_placements) - discarded_placements)}")
-                    print(f"There are {board_db.count_placements()} placements"
-                          f" ({100*board_db.count_placements()/target_placement_count}%)")
+                          f"discarded={len(new_placements) - inserted_placements}, "
+                          f"per board={(time_placement + time_insert) / max(1, inserted_placements)}")
+                    print(f"There are {current_count} placements"
+                          f" ({100 * current_count / target_placement_count}%)")
+
+                if missing_placements <= 0:
+                    break
+        finally:
+            placements.close()
 
-                missing_placements -= len(new_placements) - discarded_placements
+    def export_placements(self, npy_path, chunk_size=65536):
+        """Write all placements in the database to a .npy file that can be read with `PlacementDataset`.
 
-    def binary_map_to_array(self, binary_map_str):
+        The file contains a uint8 array of shape (placement_count, `self.binary_map_byte_count`),
+        whose rows are the binary maps stored in the database. Placements are copied in chunks of
+        chunk_size rows, so memory usage does not depend on the number of placements.
+
+        :return: the number of exported placements
+        """
+        placement_count = self.count_placements()
+        exported_placements = np.lib.format.open_memmap(
+            npy_path, mode="w+", dtype=np.uint8, shape=(placement_count, self.binary_map_byte_count))
+        cursor = self.conn.execute(self.base_board_selection_query)
+        exported_count = 0
+        while exported_count < placement_count:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = np.frombuffer(b"".join(row[0] for row in rows), dtype=np.uint8).reshape(
+                (len(rows), self.binary_map_byte_count))
+            exported_placements[exported_count:exported_count + len(rows)] = chunk
+            exported_count += len(rows)
+        assert exported_count == placement_count
+        exported_placements.flush()
+        del exported_placements
+        return exported_count
+
+    def binary_map_to_array(self, binary_map):
         """Return a zero-indexed binary array that represents all boat positions
         given a binary map stored in the database.
         """
-        square_count = game.Battl3ship.default_board_height * game.Battl3ship.default_board_width
-        assert len(binary_map_str) == square_count
-        board = np.zeros(square_count, dtype=int)
-        for i, c in enumerate(binary_map_str):
-            board[i] = int(c)
-        return board.reshape((game.Battl3ship.default_board_height, game.Battl3ship.default_board_width))
-
-    @staticmethod
-    def _get_placement_batch(batch_size: int):
-        """Get a list of placements of length batch_size.
+        assert len(binary_map) == self.binary_map_byte_count
+        bits = np.unpackbits(np.frombuffer(binary_map, dtype=np.uint8), bitorder="little")
+        return bits[:self.width * self.height].reshape((self.height, self.width))
+
+    def binary_map_to_placement(self, binary_map):
+        """Return the placement, i.e., a list of boats, each a list of (row, col) coordinates,
+        represented by a binary map stored in the database.
         """
-        board_placer = generation.RandomBoatPlacer()
-        return [board_placer.get_random_placement() for _ in range(batch_size)]
+        return binary_map_to_placement(binary_map=binary_map, width=self.width, height=self.height)
 
-    def _placement_to_binary_map(self, boat_placement):
-        """Translate a list of row,col lists into a string containing only 1 and 0
-        representing the board state
+    def _placements_to_binary_maps(self, boat_placements):
+        """Translate a list of placements (lists of row,col lists) into the list of blobs stored in the database,
+        i.e., the smallest blob among those of the symmetric images of each placement.
         """
-        board = np.zeros((game.Battl3ship.default_board_height + 1,
-                          game.Battl3ship.default_board_width + 1),
-                         dtype=int)
-        for row_col_list in boat_placement:
-            for row, col in row_col_list:
-                board[row, col] = 1
-        return "".join(f"{v}" for v in board[1:, 1:].flatten())
+        square_count = self.width * self.height
+        occupancy = np.zeros((len(boat_placements), square_count), dtype=np.uint8)
+        occupancy.ravel()[[i * square_count + (row - 1) * self.width + (col - 1)
+                           for i, boat_placement in enumerate(boat_placements)
+                           for row_col_list in boat_placement
+                           for row, col in row_col_list]] = 1
+
+        # Shape: (placement, symmetry, byte)
+        packed_images = np.packbits(occupancy[:, self._symmetry_source_indices], axis=2, bitorder="little")
+        # Blobs are compared as 128-bit big-endian integers (i.e., as bytes), after padding them with zeros
+        padded_images = np.zeros(packed_images.shape[:2] + (16,), dtype=np.uint8)
+        padded_images[:, :, :packed_images.shape[2]] = packed_images
+        high_words, low_words = np.moveaxis(padded_images.view(">u8"), 2, 0)
+        is_min_high_word = high_words == high_words.min(axis=1, keepdims=True)
+        selected_symmetries = np.where(is_min_high_word, low_words, np.iinfo(np.uint64).max).argmin(axis=1)
+        selected_images = packed_images[np.arange(len(boat_placements)), selected_symmetries].tobytes()
+        binary_maps = [selected_images[i:i + self.binary_map_byte_count]
+                       for i in range(0, len(selected_images), self.binary_map_byte_count)]
+        return binary_maps
 
     def _open_database(self, create_ok=False):
         """Open the database and return a connection to it.
@@ -168,7 +270,10 @@ class BoardDB:
 
         :return: a connection to the database
         """
-        conn = sqlite3.connect(base_board_db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        # Committed transactions survive application crashes; only an OS crash can lose the last ones
+        conn.execute("PRAGMA synchronous=NORMAL;")
 
         cur = conn.execute(f"SELECT name FROM sqlite_master WHERE type='table';")
         existing_table_names = [r[0] for r in cur]
@@ -179,111 +284,576 @@ class BoardDB:
                 raise IOError(f"{base_board_table_name} does not exist but create_ok is False")
             print(f"Creating {base_board_table_name}")
             conn.execute(self.base_board_creation_query)
+        conn.execute(self.checkpoint_creation_query)
 
         return conn
 
 
-def __build_resultcode_dicts():
-    """Create the result code to hit,sunk lists
-    and the hit,sunk to result code data structures.
+def binary_map_to_placement(binary_map, width=None, height=None):
+    """Return the placement, i.e., a list of boats, each a list of (row, col) coordinates,
+    represented by a binary map as stored by `BoardDB`.
+    :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+    """
+    width = width if width is not None else game.Battl3ship.default_board_width
+    height = height if height is not None else game.Battl3ship.default_board_height
+    mask = int.from_bytes(binary_map, "little")
+    return generation.get_placement_from_row_cols(
+        (index // width + 1, index % width + 1)
+        for index in range(width * height)
+        if (mask >> index) & 1)
+
 
-    * `code_to_hit_sunk_list` is a list indexed by result code,
-      each entry being a tuple (hit_tuple, sunk_tuple).
-        * The first one, `hit_tuple`, contains the lengths of the
-          hit boats
-        * The second one, `sunk_tuple`, contains the lengths of the
-          sunk boats
-      Any or both of the tuples can be empty.
-      Repeated values can appear within and across the two tuples.
-      Codes cover all possible shot results.
+class PlacementDataset:
+    """Random-access reader of placements exported with `BoardDB.export_placements`.
 
-    * `hit_sunk_to_code_dict` is a dict indexed by `(hit_tuple, sink_tuple)`,
-      with the semantics as defined for `code_to_hit_sunk_list`.
-      Only valid (hit_tuple, sink_tuple) indices are available in the dictionary,
-      that is, those contained as entries in `code_to_hit_sunk_list`.
+    The file is memory-mapped, so only the placements actually read are loaded into memory,
+    and datasets larger than the available memory can be used.
 
-    :return: code_to_hit_sunk_list, hit_sunk_to_code_dict
+    As in `BoardDB`, each stored placement represents all its symmetric images
+    (see `generation.get_symmetric_placements`), and is the one with the smallest binary map among them.
     """
-    valid_lengths = list(game.Battl3ship.required_boat_count_by_length.keys())
-
-    # Build all possible individual results for each shot
-    # The format of each result is (is_hit, length).
-    #   * If is_hit is False, it means the boat is sunk.
-    #   * If length is 0, it means nothing was hit.
-    assert 0 not in valid_lengths
-    one_shot_results = [(is_hit, length)
-                        for is_hit in [True, False]
-                        for length in valid_lengths + [0]]
-
-    # Build all 3-shot combinations
-    three_shot_combinations = [(s1, s2, s3)
-                               for s1 in one_shot_results
-                               for s2 in one_shot_results
-                               for s3 in one_shot_results]
-
-    # Filter all invalid combinations and create the list of valid values
-    valid_shots = []
-    for shots in three_shot_combinations:
-        try:
-            # Boats of length 1 can only be sunk
-            if any(s[0] and s[1] == 1 for s in shots):
-                raise ValueError("Boats of length 1 can only be sunk")
-
-            # To avoid duplicates, missed shots can only appear as "sunk"
-            if any(s[0] and s[1] == 0 for s in shots):
-                raise ValueError("Missed shots shall only appear as sunk to avoid duplicity.")
-
-            # To avoid duplicates, length in shots can only appear in ascending order
-            shot_lengths = [l for _, l in shots]
-            if shot_lengths != sorted(shot_lengths):
-                raise ValueError("Length in shots can only appear in ascending order")
-
-            # Check that the number of boats of each type is
-            # consistent with the maximum number of boats
-            # that can be placed
-            affected_boats_by_length = {
-                length: sum(1 for s in shots if (s is not None and s[1] == length))
-                for length in valid_lengths
-            }
-            for length, placed_boats in game.Battl3ship.required_boat_count_by_length.items():
-                if affected_boats_by_length[length] > placed_boats:
-                    raise ValueError(f"affected_boats_by_length = {affected_boats_by_length}"
-                                     f" violates the maximum number of boats per length, "
-                                     f" {game.Battl3ship.required_boat_count_by_length.items()}")
-
-            # To avoid duplicates, hits of a given length cannot appear after sunks of that length
-            for i in range(len(shots) - 1):
-                if shots[i][1] == shots[i + 1][1] \
-                        and (shots[i][0], shots[i + 1][0]) == (False, True):
-                    raise ValueError("Hits cannot be reported after sunks")
-
-            # The sample passes al tests, therefore it must be valid
-            valid_shots.append(shots)
-        except ValueError as ex:
-            # print(f"Discarded {shots} because of: {ex}")
-            pass
-    valid_shots = sorted(valid_shots)
-
-    # code_to_hit_sunk_list, hit_sunk_to_code_dict can now be generated
-    code_to_hit_sunk_list = []
-    hit_sunk_to_code_dict = {}
-    for valid_shot in valid_shots:
-        hit_tuple = tuple(length
-                          for is_hit, length in valid_shot
-                          if length != 0 and is_hit)
-        sunk_tuple = tuple(length
-                           for is_hit, length in valid_shot
-                           if length != 0 and not is_hit)
-
-        hit_sunk_to_code_dict[(hit_tuple, sunk_tuple)] = len(code_to_hit_sunk_list)
-        code_to_hit_sunk_list.append((hit_tuple, sunk_tuple))
-
-    for code in range(len(code_to_hit_sunk_list)):
-        assert hit_sunk_to_code_dict[code_to_hit_sunk_list[code]] == code
-    for h_s_lists, code in hit_sunk_to_code_dict.items():
-        assert code_to_hit_sunk_list[code] == h_s_lists
-
-    return code_to_hit_sunk_list, hit_sunk_to_code_dict
+
+    def __init__(self, npy_path, width=None, height=None):
+        """Open the dataset (read-only).
+        :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+        """
+        self.width = width if width is not None else game.Battl3ship.default_board_width
+        self.height = height if height is not None else game.Battl3ship.default_board_height
+        self.binary_maps = np.load(npy_path, mmap_mode="r")
+        if self.binary_maps.ndim != 2 or self.binary_maps.shape[1] != (self.width * self.height + 7) // 8:
+            raise ValueError(f"Invalid dataset shape {self.binary_maps.shape} for "
+                             f"{self.height}x{self.width} boards")
+
+    def __len__(self):
+        return len(self.binary_maps)
+
+    def get_batch(self, indices):
+        """Get the boards of several placements.
+
+        :param indices: a slice, or a sequence or array of placement indices.
+        :return: a uint8 array of shape (len(indices), height, width) with 1 at occupied squares and 0 elsewhere
+        """
+        if not isinstance(indices, slice):
+            indices = np.asarray(indices, dtype=np.int64)
+        boards = np.unpackbits(self.binary_maps[indices], axis=1, count=self.width * self.height, bitorder="little")
+        return boards.reshape((-1, self.height, self.width))
+
+    def get_placement(self, index):
+        """Get the placement with the given index, i.e., a list of boats, each a list of (row, col) coordinates.
+        """
+        return binary_map_to_placement(
+            binary_map=self.binary_maps[index].tobytes(), width=self.width, height=self.height)
+
+    def get_random_placement(self, random_generator):
+        """Get a placement chosen uniformly at random among all the placements represented by the dataset,
+        i.e., among the symmetric images of all stored placements. Stored placements are picked with
+        probability proportional to their number of distinct images, and then one of these images is returned.
+
+        :param random_generator: random.Random instance used for all random decisions.
+        :return: a list of boats, each a sorted list of (row, col) coordinates.
+        """
+        symmetry_count = len(generation.get_board_symmetries(width=self.width, height=self.height))
+        while True:
+            images = generation.get_symmetric_placements(
+                placement=self.get_placement(random_generator.randrange(len(self))),
+                width=self.width, height=self.height)
+            if random_generator.randrange(symmetry_count) < len(images):
+                return random_generator.choice(images)
+
+    def iterate_batches(self, batch_size, shuffle=False, seed=None):
+        """Iterate over the whole dataset in batches, as returned by `get_batch`.
+
+        :param shuffle: if True, placements are visited in random order. Each batch is then read with
+          sorted indices, which keeps reads local within the file. The permutation is computed
+          on the fly (see `get_permuted_indices`), so memory usage does not depend on the dataset size.
+        :param seed: seed of the random permutation used if shuffle is True.
+        """
+        if not shuffle:
+            for first in range(0, len(self), batch_size):
+                yield self.get_batch(slice(first, first + batch_size))
+            return
+
+        keys = np.random.default_rng(seed).integers(
+            0, np.iinfo(np.uint64).max, size=feistel_round_count, dtype=np.uint64, endpoint=True)
+        for first in range(0, len(self), batch_size):
+            positions = np.arange(first, min(first + batch_size, len(self)), dtype=np.uint64)
+            yield self.get_batch(np.sort(get_permuted_indices(
+                positions=positions, index_count=len(self), keys=keys)).astype(np.int64))
+
+
+def get_permuted_indices(positions, index_count, keys):
+    """Get the images of some positions under a pseudo-random permutation of range(index_count),
+    without storing the permutation. A balanced Feistel network, with one round per key,
+    permutes the smallest range of 2**(2*k) integers containing range(index_count), and images
+    outside range(index_count) are permuted again until they fall inside it (cycle walking).
+    Since that range is less than 4 times larger than index_count, few rounds are needed.
+
+    :param positions: uint64 array of integers in range(index_count)
+    :param keys: uint64 array with the round keys, which determine the permutation
+    :return: a uint64 array with the image of each position. Distinct positions have distinct images.
+    """
+    half_bit_count = max(1, ((index_count - 1).bit_length() + 1) // 2)
+    half_mask = np.uint64((1 << half_bit_count) - 1)
+
+    def feistel(values):
+        left = values >> np.uint64(half_bit_count)
+        right = values & half_mask
+        for key in keys:
+            mixed = (right ^ key) * np.uint64(0x9E3779B97F4A7C15)
+            mixed ^= mixed >> np.uint64(29)
+            mixed *= np.uint64(0xBF58476D1CE4E5B9)
+            mixed ^= mixed >> np.uint64(32)
+            left, right = right, left ^ (mixed & half_mask)
+        return (left << np.uint64(half_bit_count)) | right
+
+    images = feistel(np.asarray(positions, dtype=np.uint64))
+    outside = images >= np.uint64(index_count)
+    while np.any(outside):
+        images[outside] = feistel(images[outside])
+        outside = images >= np.uint64(index_count)
+    return images
+
+
+class PlacementQuery:
+    """Find the placements represented by a `PlacementDataset` consistent with an observation of the board:
+    squares known to be empty (misses), squares known to be occupied (hits) and boats known to be sunk.
+
+    Each stored placement represents all its distinct symmetric images (see `PlacementDataset`), so matches
+    are (index, symmetry index) pairs: the image of the index-th stored placement under the symmetry
+    with that index in `generation.get_board_symmetries`. For each stored placement, only the first symmetry
+    producing each distinct image is considered, so that each represented placement is matched exactly once.
+
+    Placements are kept in memory as two arrays of 64-bit words (`self.low_words` and `self.high_words`)
+    with the bits of their binary maps. Observations are translated into one pair of words per symmetry,
+    and each query tests all symmetries at once with a few vectorized AND and comparison operations.
+    Repeated images only exist for the few placements invariant under some symmetry, so the
+    (index, symmetry index) pairs to skip are stored apart and removed from the matches afterwards.
+    """
+    # Number of placements processed at once in each operation, which keeps temporary arrays in cache
+    chunk_size = 1 << 14
+
+    def __init__(self, placement_dataset):
+        """
+        :param placement_dataset: a `PlacementDataset` instance.
+        """
+        self.placement_dataset = placement_dataset
+        self.width = placement_dataset.width
+        self.height = placement_dataset.height
+        if self.width * self.height > 128:
+            raise ValueError("Boards with more than 128 squares are not supported")
+        square_count = self.width * self.height
+
+        self.symmetries = generation.get_board_symmetries(width=self.width, height=self.height)
+        # Row s contains, for each square index, the index of its image under the s-th symmetry
+        self._symmetry_target_indices = np.array([
+            [(row_col[0] - 1) * self.width + (row_col[1] - 1)
+             for row_col in map(symmetry, ((row, col)
+                                           for row in range(1, self.height + 1)
+                                           for col in range(1, self.width + 1)))]
+            for symmetry in self.symmetries])
+
+        # Entry [s, k, v, w] is the w-th word (low, high) of the image under the s-th symmetry
+        # of a binary map whose k-th byte is v and whose other bytes are zero
+        byte_count = placement_dataset.binary_maps.shape[1]
+        byte_values = np.arange(256, dtype=np.uint64)
+        image_word_tables = np.zeros((len(self.symmetries), byte_count, 256, 2), dtype=np.uint64)
+        for symmetry_index, target_indices in enumerate(self._symmetry_target_indices):
+            for square_index, target_index in enumerate(target_indices):
+                image_word_tables[symmetry_index, square_index // 8, :, target_index // 64] |= \
+                    ((byte_values >> np.uint64(square_index % 8)) & np.uint64(1)) << np.uint64(target_index % 64)
+
+        placement_count = len(placement_dataset)
+        self.low_words = np.empty(placement_count, dtype="<u8")
+        self.high_words = np.empty(placement_count, dtype="<u8")
+        # Matches to skip because they repeat the image of a previous symmetry, sorted by index
+        duplicate_indices = []
+        duplicate_symmetry_indices = []
+        padded_binary_maps = np.zeros((self.chunk_size, 16), dtype=np.uint8)
+        for first in range(0, placement_count, self.chunk_size):
+            chunk = placement_dataset.binary_maps[first:first + self.chunk_size]
+            padded_binary_maps[:len(chunk), :byte_count] = chunk
+            words = padded_binary_maps[:len(chunk)].view("<u8")
+            low_words, high_words = words[:, 0].copy(), words[:, 1].copy()
+            self.low_words[first:first + len(chunk)] = low_words
+            self.high_words[first:first + len(chunk)] = high_words
+
+            # Placements are invariant under some symmetry (other than the identity)
+            # if and only if two of their images are equal
+            is_invariant = np.zeros(len(chunk), dtype=bool)
+            for symmetry_index in range(1, len(self.symmetries)):
+                image_low_words = np.bitwise_or.reduce(
+                    image_word_tables[symmetry_index, np.arange(byte_count), chunk, 0], axis=1)
+                candidates = np.flatnonzero(image_low_words == low_words)
+                if len(candidates) > 0:
+                    image_high_words = np.bitwise_or.reduce(
+                        image_word_tables[symmetry_index, np.arange(byte_count), chunk[candidates], 1], axis=1)
+                    is_invariant[candidates[image_high_words == high_words[candidates]]] = True
+            for index in np.flatnonzero(is_invariant):
+                images = [tuple(np.bitwise_or.reduce(image_word_tables[symmetry_index, np.arange(byte_count), chunk[index]]))
+                          for symmetry_index in range(len(self.symmetries))]
+                for symmetry_index, image in enumerate(images):
+                    if image in images[:symmetry_index]:
+                        duplicate_indices.append(first + index)
+                        duplicate_symmetry_indices.append(symmetry_index)
+        self._duplicate_indices = np.array(duplicate_indices, dtype=np.int64)
+        self._duplicate_symmetry_indices = np.array(duplicate_symmetry_indices, dtype=np.int64)
+
+        # Row v contains the 8 bits of byte value v, least significant first
+        self._bits_by_byte_value = np.unpackbits(
+            np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1, bitorder="little").astype(np.int64)
+
+    def find(self, miss_row_cols=(), hit_row_cols=(), sunk_row_col_lists=()):
+        """Find the placements consistent with an observation.
+
+        :param miss_row_cols: (row, col) coordinates of squares known to be empty.
+        :param hit_row_cols: (row, col) coordinates of squares known to be occupied.
+        :param sunk_row_col_lists: list of sunk boats, each a list of (row, col) coordinates.
+          Since boats cannot touch, a sunk boat is equivalent to hits at its squares
+          and misses at the squares surrounding it.
+
+        :return: indices, symmetry_indices: two arrays with one entry per consistent placement.
+          Each placement is the image of the stored placement indices[i] under the symmetry
+          `self.symmetries[symmetry_indices[i]]`. Entries are grouped in blocks of `chunk_size`
+          consecutive indices, and sorted by symmetry index and then by index within each block.
+        """
+        index_chunks = []
+        symmetry_index_chunks = []
+        for first, is_consistent in self._iterate_consistent_chunks(
+                miss_row_cols=miss_row_cols, hit_row_cols=hit_row_cols, sunk_row_col_lists=sunk_row_col_lists):
+            # Much faster than np.nonzero for 2D arrays. Flat positions are sorted by symmetry index.
+            flat_positions = np.flatnonzero(is_consistent)
+            chunk_length = is_consistent.shape[1]
+            match_counts = np.diff(np.searchsorted(
+                flat_positions, chunk_length * np.arange(len(self.symmetries) + 1)))
+            symmetry_indices = np.repeat(np.arange(len(self.symmetries), dtype=np.uint8), match_counts)
+            indices = flat_positions - np.repeat(
+                chunk_length * np.arange(len(self.symmetries)) - first, match_counts)
+            index_chunks.append(indices)
+            symmetry_index_chunks.append(symmetry_indices)
+        if not index_chunks:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return np.concatenate(index_chunks), np.concatenate(symmetry_index_chunks)
+
+    def count(self, **observation):
+        """Count the placements consistent with an observation, described as in `find`.
+        """
+        return sum(int(np.count_nonzero(is_consistent))
+                   for _, is_consistent in self._iterate_consistent_chunks(**observation))
+
+    def _iterate_consistent_chunks(self, miss_row_cols=(), hit_row_cols=(), sunk_row_col_lists=()):
+        """Test the stored placements under all symmetries against an observation (described as in `find`).
+
+        :return: a generator of (first, is_consistent) tuples, where is_consistent is a boolean array
+          of shape (symmetry count, chunk length) and entry [s, i] tells whether the image of
+          the placement with index first + i under the s-th symmetry is consistent and not repeated.
+          No tuples are generated for contradictory observations.
+        """
+        miss_mask, hit_mask = self._get_observation_masks(
+            miss_row_cols=miss_row_cols, hit_row_cols=hit_row_cols, sunk_row_col_lists=sunk_row_col_lists)
+        if miss_mask & hit_mask:
+            # Contradictory observation
+            return
+
+        # Stored placement C matches under symmetry s iff s(C) is consistent with the observation,
+        # i.e., iff square i of C agrees with the observation at square s(i).
+        # Shape: (word, symmetry), with words (low, high)
+        care_words, hit_words = (np.array([self._get_words(self._get_source_mask(mask=mask, target_indices=t))
+                                           for t in self._symmetry_target_indices], dtype=np.uint64).T
+                                 for mask in (miss_mask | hit_mask, hit_mask))
+        tested_words = [(placement_words, care_words[w], hit_words[w])
+                        for w, placement_words in enumerate((self.low_words, self.high_words))
+                        if np.any(care_words[w])]
+
+        for first in range(0, len(self.low_words), self.chunk_size):
+            last = min(first + self.chunk_size, len(self.low_words))
+            # Symmetries are the first axis, so that vectorized operations run along contiguous placements
+            is_consistent = np.ones((len(self.symmetries), last - first), dtype=bool)
+            for placement_words, care_word_row, hit_word_row in tested_words:
+                is_consistent &= (placement_words[np.newaxis, first:last] & care_word_row[:, np.newaxis]) \
+                                 == hit_word_row[:, np.newaxis]
+            duplicates = slice(*np.searchsorted(self._duplicate_indices, [first, last]))
+            is_consistent[self._duplicate_symmetry_indices[duplicates],
+                          self._duplicate_indices[duplicates] - first] = False
+            yield first, is_consistent
+
+    def get_occupancy_probabilities(self, matches=None, **observation):
+        """Get the probability that each square is occupied, assuming that all placements consistent
+        with an observation (described as in `find`) are equally likely.
+
+        :param matches: consistent placements, as returned by `find`. If None, `find` is called.
+        :return: a (height, width) array of probabilities (all zero if no placements are consistent)
+        """
+        indices, symmetry_indices = matches if matches is not None else self.find(**observation)
+        square_count = self.width * self.height
+        image_bit_counts = np.zeros(square_count, dtype=np.int64)
+        for symmetry_index, target_indices in enumerate(self._symmetry_target_indices):
+            symmetry_indices_selected = indices[symmetry_indices == symmetry_index]
+            bit_counts = np.zeros(128, dtype=np.int64)
+            for first in range(0, len(symmetry_indices_selected), self.chunk_size):
+                chunk_indices = symmetry_indices_selected[first:first + self.chunk_size]
+                # Bytes of the selected binary maps, in the same order as in the dataset
+                binary_map_bytes = np.stack((self.low_words[chunk_indices], self.high_words[chunk_indices]),
+                                            axis=1).view(np.uint8)
+                for byte_index in range((square_count + 7) // 8):
+                    byte_value_counts = np.bincount(binary_map_bytes[:, byte_index], minlength=256)
+                    bit_counts[8 * byte_index:8 * (byte_index + 1)] += byte_value_counts @ self._bits_by_byte_value
+            # Square i of the stored placements is square target_indices[i] of their images
+            image_bit_counts[target_indices] += bit_counts[:square_count]
+        probabilities = image_bit_counts / max(1, len(indices))
+        return probabilities.reshape((self.height, self.width))
+
+    def sample(self, sample_count, matches=None, seed=None, **observation):
+        """Get random placements consistent with an observation (described as in `find`),
+        chosen uniformly at random with replacement.
+
+        :param matches: consistent placements, as returned by `find`. If None, `find` is called.
+        :param seed: seed of the random generator used to choose the samples.
+        :return: a list of sample_count placements (empty if no placements are consistent),
+          each a list of boats, each boat a sorted list of (row, col) coordinates.
+        """
+        indices, symmetry_indices = matches if matches is not None else self.find(**observation)
+        if len(indices) == 0:
+            return []
+        placements = []
+        for match_index in np.random.default_rng(seed).integers(len(indices), size=sample_count):
+            symmetry = self.symmetries[symmetry_indices[match_index]]
+            placements.append(sorted(sorted(map(symmetry, row_col_list)) for row_col_list in
+                                     self.placement_dataset.get_placement(int(indices[match_index]))))
+        return placements
+
+    def _get_observation_masks(self, miss_row_cols, hit_row_cols, sunk_row_col_lists):
+        """Get the miss and hit masks of an observation, with bit (row-1)*width + (col-1) set for each square.
+        :return: miss_mask, hit_mask
+        """
+        miss_row_cols = set(miss_row_cols)
+        hit_row_cols = set(hit_row_cols)
+        for row_col_list in sunk_row_col_lists:
+            hit_row_cols.update(row_col_list)
+            miss_row_cols.update((row + dr, col + dc)
+                                 for row, col in row_col_list
+                                 for dr in (-1, 0, 1)
+                                 for dc in (-1, 0, 1))
+        miss_row_cols -= set(itertools.chain(*sunk_row_col_lists))
+
+        masks = []
+        for row_cols in (miss_row_cols, hit_row_cols):
+            mask = 0
+            for row, col in row_cols:
+                if 1 <= row <= self.height and 1 <= col <= self.width:
+                    mask |= 1 << ((row - 1) * self.width + (col - 1))
+            masks.append(mask)
+        return masks
+
+    def _get_source_mask(self, mask, target_indices):
+        """Get the mask with bit i set iff bit target_indices[i] of mask is set.
+        """
+        return sum(1 << index for index, target_index in enumerate(target_indices) if (mask >> int(target_index)) & 1)
+
+    def _get_words(self, mask):
+        """Get the (low, high) 64-bit words of a mask.
+        """
+        return mask & 0xFFFFFFFFFFFFFFFF, mask >> 64
+
+
+# Result codes for the default fleet and shots per turn. See game.ResultCodeRegistry.
+result_code_registry = game.ResultCodeRegistry.get()
+code_to_hit_sunk_list = result_code_registry.code_to_hit_sunk_list
+hit_sunk_to_code_dict = result_code_registry.hit_sunk_to_code_dict
+
+# Number of shots made in each turn, as required by game.Battl3ship.shot
+shots_per_turn = result_code_registry.shots_per_turn
+
+
+def get_turn_record_dtype(width=None, height=None):
+    """Get the numpy dtype of the turn records produced by `simulate_games`:
+      * shot_turns: (height, width) map of the turn in which each square was shot (0 if not yet shot),
+        i.e., the [r,c,0] map described in this module's docstring.
+      * result_codes: (height, width) map of the result code obtained in the turn each square was shot
+        (0 if not yet shot), i.e., the [r,c,1] map described in this module's docstring.
+      * shots: indices ((row-1)*width + (col-1)) of the squares shot in this turn.
+      * result_code: result code obtained in this turn (see `code_to_hit_sunk_list`).
+    Observations (shot_turns and result_codes) are those available to the shooting player before the turn.
+    """
+    width = width if width is not None else game.Battl3ship.default_board_width
+    height = height if height is not None else game.Battl3ship.default_board_height
+    return np.dtype([("shot_turns", np.uint8, (height, width)),
+                     ("result_codes", np.uint8, (height, width)),
+                     ("shots", np.uint8, (shots_per_turn,)),
+                     ("result_code", np.uint8)])
+
+
+class ShotPolicy(abc.ABC):
+    """Abstract base class of the shooting policies used by `simulate_games`.
+    Subclasses must implement `get_shots`.
+    """
+
+    def __init__(self, random_generator):
+        """
+        :param random_generator: random.Random instance used for all random decisions of the policy.
+        """
+        self.random_generator = random_generator
+
+    @abc.abstractmethod
+    def get_shots(self, shot_turns, result_codes):
+        """Choose the squares shot in the next turn.
+
+        :param shot_turns, result_codes: observation of the opponent's board, as described in `get_turn_record_dtype`.
+        :return: a list of `shots_per_turn` distinct square indices ((row-1)*width + (col-1)) not shot before.
+        """
+
+
+class RandomShotPolicy(ShotPolicy):
+    """Shoot at squares chosen uniformly at random among those not shot before.
+    """
+
+    def get_shots(self, shot_turns, result_codes):
+        return self.random_generator.sample(np.flatnonzero(shot_turns.ravel() == 0).tolist(), shots_per_turn)
+
+
+class HuntShotPolicy(ShotPolicy):
+    """Shoot first at squares next (N, S, W or E) to squares shot in turns that hit or sunk any boat,
+    and at squares chosen uniformly at random among those not shot before otherwise.
+    """
+    miss_code = hit_sunk_to_code_dict[((), ())]
+
+    def get_shots(self, shot_turns, result_codes):
+        is_free = shot_turns == 0
+        was_successful = ~is_free & (result_codes != self.miss_code)
+        is_neighbour = np.zeros_like(is_free)
+        is_neighbour[1:, :] |= was_successful[:-1, :]
+        is_neighbour[:-1, :] |= was_successful[1:, :]
+        is_neighbour[:, 1:] |= was_successful[:, :-1]
+        is_neighbour[:, :-1] |= was_successful[:, 1:]
+
+        candidates = np.flatnonzero((is_free & is_neighbour).ravel()).tolist()
+        if len(candidates) >= shots_per_turn:
+            return self.random_generator.sample(candidates, shots_per_turn)
+        others = np.flatnonzero((is_free & ~is_neighbour).ravel()).tolist()
+        return candidates + self.random_generator.sample(others, shots_per_turn - len(candidates))
+
+
+class TurnRecordWriter:
+    """Write turn records to a sequence of .npy shards (`<path_prefix>-<shard_index>.npy`),
+    each one containing up to records_per_shard records of the dtype given by `get_turn_record_dtype`.
+    Only one shard is kept in memory. Shards can be read with np.load(path, mmap_mode="r").
+    """
+
+    def __init__(self, path_prefix, records_per_shard=65536, width=None, height=None):
+        self.path_prefix = path_prefix
+        self.records = np.zeros(records_per_shard, dtype=get_turn_record_dtype(width=width, height=height))
+        self.record_count = 0
+        self.written_record_count = 0
+        self.shard_paths = []
+
+    def write(self, shot_turns, result_codes, shots, result_code):
+        """Add a record, writing the current shard if it becomes full.
+        """
+        record = self.records[self.record_count]
+        record["shot_turns"] = shot_turns
+        record["result_codes"] = result_codes
+        record["shots"] = shots
+        record["result_code"] = result_code
+        self.record_count += 1
+        if self.record_count == len(self.records):
+            self.flush()
+
+    def flush(self):
+        """Write the records not yet written to a new shard.
+        """
+        if self.record_count == 0:
+            return
+        shard_path = f"{self.path_prefix}-{len(self.shard_paths):05d}.npy"
+        np.save(shard_path, self.records[:self.record_count])
+        self.shard_paths.append(shard_path)
+        self.written_record_count += self.record_count
+        self.record_count = 0
+
+
+def simulate_games(dataset_path, output_prefix, game_count, policy_class=RandomShotPolicy,
+                   process_count=None, seed=None, records_per_shard=65536):
+    """Simulate complete games between two players that use policy_class to shoot, and write
+    one record (see `get_turn_record_dtype`) per turn. Placements are chosen uniformly at random
+    among those represented by a dataset exported with `BoardDB.export_placements`, including
+    the symmetric images of the stored ones (see `PlacementDataset.get_random_placement`). Games in which a player
+    runs out of squares to make a complete turn before sinking all boats are left unfinished.
+
+    Games are split among process_count processes. Process i writes its records with a
+    `TurnRecordWriter` with path prefix `<output_prefix>-<i>`, so memory usage per process is bounded.
+    The output depends only on the arguments (not on process scheduling) if seed is not None.
+
+    :param policy_class: a subclass of `ShotPolicy`, instantiated once per process.
+    :param process_count: number of worker processes. If None, os.cpu_count() is used.
+    :param seed: master seed from which each process' seed is derived.
+
+    :return: the list of paths of the written shards
+    """
+    process_count = process_count if process_count is not None else os.cpu_count()
+    seed_generator = random.Random(seed)
+    tasks = [dict(dataset_path=dataset_path,
+                  path_prefix=f"{output_prefix}-{i:03d}",
+                  game_count=game_count // process_count + (1 if i < game_count % process_count else 0),
+                  policy_class=policy_class,
+                  seed=seed_generator.getrandbits(64),
+                  records_per_shard=records_per_shard)
+             for i in range(process_count)]
+    with multiprocessing.Pool(processes=process_count) as pool:
+        return list(itertools.chain(*pool.map(_simulate_games_worker, tasks, chunksize=1)))
+
+
+def _simulate_games_worker(task):
+    """Simulate task["game_count"] games as described in `simulate_games`.
+    :return: the list of paths of the written shards
+    """
+    return _simulate_games(**task)
+
+
+def _simulate_games(dataset_path, path_prefix, game_count, policy_class, seed, records_per_shard):
+    """Simulate game_count games in this process as described in `simulate_games`.
+    :return: the list of paths of the written shards
+    """
+    random_generator = random.Random(seed)
+    placement_dataset = PlacementDataset(dataset_path)
+    width, height = placement_dataset.width, placement_dataset.height
+    policy = policy_class(random_generator=random_generator)
+    writer = TurnRecordWriter(path_prefix=path_prefix, records_per_shard=records_per_shard,
+                              width=width, height=height)
+    players = [player.Player(id=0, name="A"), player.Player(id=1, name="B")]
+
+    for _ in range(game_count):
+        simulated_game = game.Battl3ship(player_a=players[0], player_b=players[1],
+                                         starting_player=random_generator.choice(players),
+                                         board_width=width, board_height=height)
+        for p in players:
+            simulated_game.set_boats(player=p, row_col_lists=placement_dataset.get_random_placement(
+                random_generator=random_generator))
+        simulated_game.accepting_shots = True
+
+        # Observations of the opponent's board, indexed by the shooting player's id
+        shot_turns_by_id = [np.zeros((height, width), dtype=np.uint8) for _ in players]
+        result_codes_by_id = [np.zeros((height, width), dtype=np.uint8) for _ in players]
+        turn_count_by_id = [0 for _ in players]
+        game_finished = False
+        while not game_finished:
+            shooting_player = simulated_game.player_turn
+            shot_turns = shot_turns_by_id[shooting_player.id]
+            result_codes = result_codes_by_id[shooting_player.id]
+            if turn_count_by_id[shooting_player.id] * shots_per_turn > width * height - shots_per_turn:
+                # Not enough squares left for a complete turn, the game cannot finish
+                break
+            shots = policy.get_shots(shot_turns=shot_turns, result_codes=result_codes)
+
+            result_code, game_finished = simulated_game.shot(
+                player_from=shooting_player,
+                row_col_lists=[(index // width + 1, index % width + 1) for index in shots],
+                return_code=True)
+            writer.write(shot_turns=shot_turns, result_codes=result_codes, shots=shots, result_code=result_code)
+
+            turn_count_by_id[shooting_player.id] += 1
+            shot_turns.ravel()[shots] = turn_count_by_id[shooting_player.id]
+            result_codes.ravel()[shots] = result_code
+
+    writer.flush()
+    return writer.shard_paths
 
 
 if __name__ == '__main__':
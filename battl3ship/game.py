@@ -19,6 +19,8 @@ to validate and process player's actions, and update the game state accordingly.
 """
 __author__ = "Miguel Hernández Cabronero <mhernandez314@gmail.com>"
 
+import itertools
+
 ############################ Begin configurable part
 # Be verbose?
 be_verbose = False
@@ -33,6 +35,13 @@ required_boat_count_by_length = {
     1: 4,
 }
 
+# Number of shots each player makes per turn
+default_shots_per_turn = 3
+
+# Use the integer bitmask implementation (Battl3ship.BitBoard) for the players' boards?
+# If False, the dict-of-squares implementation (Battl3ship.Board) is used instead.
+use_bit_boards = True
+
 
 ############################ End configurable part
 
@@ -49,23 +58,53 @@ class Battl3ship:
     default_board_width = default_board_width
     default_board_height = default_board_height
     required_boat_count_by_length = required_boat_count_by_length
+    shots_per_turn = default_shots_per_turn
+
+    # Codes returned by check_boat_layout
+    LAYOUT_VALID = 0
+    LAYOUT_INVALID_FORMAT = 1
+    LAYOUT_INVALID_LENGTH = 2
+    LAYOUT_INVALID_BOAT_COUNT = 3
+    LAYOUT_OUT_OF_BOUNDS = 4
+    LAYOUT_NOT_LINEAR = 5
+    LAYOUT_ON_EDGE = 6
+    LAYOUT_OVERLAP = 7
+    LAYOUT_ADJACENT = 8
+    layout_code_to_description = {
+        LAYOUT_VALID: "Valid layout",
+        LAYOUT_INVALID_FORMAT: "Boats must be lists of (row, col) pairs",
+        LAYOUT_INVALID_LENGTH: "Boat length not allowed",
+        LAYOUT_INVALID_BOAT_COUNT: "Wrong number of boats of some length",
+        LAYOUT_OUT_OF_BOUNDS: "Boat outside the board",
+        LAYOUT_NOT_LINEAR: "Boat is not a horizontal or vertical line",
+        LAYOUT_ON_EDGE: "Boat entirely placed on the edge",
+        LAYOUT_OVERLAP: "Boats share squares",
+        LAYOUT_ADJACENT: "Boats are next to each other",
+    }
 
     def __init__(self, player_a, player_b, starting_player,
-                 board_width=None, board_height=None):
+                 board_width=None, board_height=None, board_class=None):
         """Initialize a game and make it ready to be start()'ed.
+
+        :param board_class: class used for the players' boards (`Battl3ship.Board` or
+          `Battl3ship.BitBoard`). If None, it is chosen based on `use_bit_boards`.
         """
         self.player_a = player_a
         self.player_b = player_b
         self.board_width = board_width if board_width is not None else default_board_width
         self.board_height = board_height if board_height is not None else default_board_height
-        self.player_a_board = Battl3ship.Board(
+        if board_class is None:
+            board_class = Battl3ship.BitBoard if use_bit_boards else Battl3ship.Board
+        self.player_a_board = board_class(
             width=self.board_width, height=self.board_height)
-        self.player_b_board = Battl3ship.Board(
+        self.player_b_board = board_class(
             width=self.board_width, height=self.board_height)
 
         self.player_turn = starting_player
         self.winner_player = None  # set only after game is finished
         self.accepting_shots = False  # set to True after set_boats has been called for both players
+        self.result_code_registry = ResultCodeRegistry.get(
+            boat_count_by_length=self.required_boat_count_by_length, shots_per_turn=self.shots_per_turn)
 
     @property
     def other_player(self):
@@ -149,6 +188,8 @@ class Battl3ship:
           * All boats must have at least one square outside the edge (edge being
             the first and last rows, and the first and last columsn).
 
+        See `Battl3ship.check_boat_layout` to find out which rule a layout violates.
+
         :param row_col_lists: a list of boats, each represented by a list of (row, col) coordinates
          in [1, height] and [1, width], respectively.
         :param ignore_boat_count: if True, the condition that all boats must be placed
@@ -159,74 +200,320 @@ class Battl3ship:
 
         :return: True or False, depending on whether the boat layout is valid..
         """
-        boat_count_by_length = dict()
-        # d[row,col] -> [[r,c],[r,c],...] every square of the boat contributes one entry with its row,col
-        boat_row_col_list_by_row_col = dict()
+        return self.check_boat_layout(
+            row_col_lists=row_col_lists, ignore_boat_count=ignore_boat_count) == Battl3ship.LAYOUT_VALID
 
+    def check_boat_layout(self, row_col_lists, ignore_boat_count=False):
+        """Verify whether a given boat layout is valid for the game, and report which rule
+        is broken otherwise. See `Battl3ship.is_valid_boat_layout` for the rules and the
+        meaning of the parameters.
+
+        Each boat and its surrounding squares (halo) are painted once into an occupancy grid,
+        so the check is linear in the number of boat squares and stops at the first violation.
+
+        :return: `Battl3ship.LAYOUT_VALID` if the layout is valid, or one of the other
+          `Battl3ship.LAYOUT_*` codes describing the first violated rule found.
+          `Battl3ship.layout_code_to_description` maps codes to human-readable descriptions.
+        """
+        height = self.board_height
+        width = self.board_width
+
+        # Check boat lengths and counts
+        boat_count_by_length = dict()
         try:
-            # Check boat lengths
             for row_col_list in row_col_lists:
+                length = len(row_col_list)
+                boat_count_by_length[length] = boat_count_by_length.get(length, 0) + 1
+        except TypeError:
+            return Battl3ship.LAYOUT_INVALID_FORMAT
+        if any(length not in required_boat_count_by_length for length in boat_count_by_length):
+            return Battl3ship.LAYOUT_INVALID_LENGTH
+        if ignore_boat_count:
+            if any(boat_count_by_length.get(length, 0) > required_count
+                   for length, required_count in required_boat_count_by_length.items()):
+                return Battl3ship.LAYOUT_INVALID_BOAT_COUNT
+        elif any(boat_count_by_length.get(length, 0) != required_count
+                 for length, required_count in required_boat_count_by_length.items()):
+            return Battl3ship.LAYOUT_INVALID_BOAT_COUNT
+
+        # The occupancy grid has a 1-square padding around the board so that halos never fall outside.
+        # Squares of boats already checked are set to 2, and squares around them to 1.
+        stride = width + 2
+        grid = bytearray((height + 2) * stride)
+        halo_row = b"\x01" * stride
+
+        for row_col_list in row_col_lists:
+            # Boats must be horizontal (step 1) or vertical (step stride) lines
+            # without gaps or repeated squares
+            try:
+                indices = []
                 for row, col in row_col_list:
-                    boat_row_col_list_by_row_col[row, col] = list(row_col_list)
-                if len(row_col_list) in boat_count_by_length:
-                    boat_count_by_length[len(row_col_list)] += 1
-                else:
-                    boat_count_by_length[len(row_col_list)] = 1
-
-            if not ignore_boat_count:
-                assert all([boat_count_by_length.get(length, 0) == required_count
-                            for length, required_count in required_boat_count_by_length.items()])
+                    if not (0 < row <= height and 0 < col <= width):
+                        return Battl3ship.LAYOUT_OUT_OF_BOUNDS
+                    indices.append(row * stride + col)
+                indices.sort()
+                step = indices[1] - indices[0] if len(indices) > 1 else stride
+                if (step != 1 and step != stride) \
+                        or indices != list(range(indices[0], indices[-1] + 1, step)):
+                    return Battl3ship.LAYOUT_NOT_LINEAR
+            except (TypeError, ValueError):
+                return Battl3ship.LAYOUT_INVALID_FORMAT
+
+            # Edge rule
+            if indices[-1] < 2 * stride or indices[0] > height * stride \
+                    or (step == stride and indices[0] % stride in (1, width)):
+                return Battl3ship.LAYOUT_ON_EDGE
+
+            for index in indices:
+                if grid[index]:
+                    return Battl3ship.LAYOUT_OVERLAP if grid[index] == 2 else Battl3ship.LAYOUT_ADJACENT
+
+            # Paint the halo as the rectangle surrounding the boat, then the boat itself.
+            # The halo cannot cover squares of previous boats, as they would be adjacent.
+            first, last = indices[0], indices[-1]
+            if step == 1:
+                halo_width = last - first + 3
+                for start in (first - stride - 1, first - 1, first + stride - 1):
+                    grid[start:start + halo_width] = halo_row[:halo_width]
             else:
-                assert all([boat_count_by_length.get(length, 0) <= required_count
-                            for length, required_count in required_boat_count_by_length.items()])
-
-            # Boat lengths can only be as configured
-            assert all(found_key in required_boat_count_by_length.keys()
-                       for found_key in boat_count_by_length.keys())
-
-            # pool of all used squares
-            used_row_col_list = [tuple(row_col)
-                                 for row_col_list in row_col_lists
-                                 for row_col in row_col_list]
-            # Check there are no duplicated squares
-            assert len(used_row_col_list) == len(list(set(used_row_col_list)))
-
-            for i in range(len(row_col_lists)):
-                boat_a = row_col_lists[i]
-
-                # Enforce the edge rule
-                assert not all([row == 1 for row, col in boat_a])
-                assert not all([row == 10 for row, col in boat_a])
-                assert not all([col == 1 for row, col in boat_a])
-                assert not all([col == 10 for row, col in boat_a])
-
-                # Check that boat is a line and not disjoint
-                if len(boat_a) > 1:
-                    if all(row == boat_a[0][0] for row, col in boat_a[1:]):
-                        # Horizontal boat
-                        cols = sorted([col for _, col in boat_a])
-                        assert cols == list(range(cols[0], cols[0] + len(cols)))
-                    elif all(col == boat_a[0][1] for row, col in boat_a[1:]):
-                        # Vertical boat
-                        rows = sorted([row for row, _ in boat_a])
-                        assert rows == list(range(rows[0], rows[0] + len(rows)))
-                    else:
-                        raise AssertionError("Row is not linear")
-
-                # Check that this boat does not collide with any other
-                for j in range(i+1, len(row_col_lists)):
-                    boat_b = row_col_lists[j]
-
-                    for r_a, c_a in boat_a:
-                        for r_b, c_b in boat_b:
-                            for dx_a in [-1, 0, 1]:
-                                for dy_a in [-1, 0, 1]:
-                                    assert (r_a + dy_a != r_b) or (c_a + dx_a != c_b)
-            return True
-        except AssertionError as ex:
-            return False
-
-    def shot(self, player_from, row_col_lists):
+                for start in range(first - stride - 1, last + stride, stride):
+                    grid[start:start + 3] = halo_row[:3]
+            for index in indices:
+                grid[index] = 2
+
+        return Battl3ship.LAYOUT_VALID
+
+    def check_boat_layouts(self, layouts, ignore_boat_count=False, chunk_size=1024):
+        """Vectorized version of `Battl3ship.check_boat_layout` for many layouts at once.
+        NumPy is needed to use this method.
+
+        :param layouts: either a list of layouts in the `row_col_lists` format accepted by
+          `Battl3ship.check_boat_layout`, or a (N, height, width) integer array of boat ids,
+          where 0 means water and each boat's squares share a positive id.
+          Element [n, r-1, c-1] of the array describes square (r, c) of the n-th layout.
+        :param ignore_boat_count: see `Battl3ship.is_valid_boat_layout`
+        :param chunk_size: maximum number of layouts processed together, to bound memory usage
+
+        :return: valid, reasons: two length-N arrays. valid is a boolean array, True for valid layouts.
+          reasons contains the `Battl3ship.LAYOUT_*` code of each layout. When a layout violates several
+          rules, the smallest code is reported, which may differ from `check_boat_layout`'s choice.
+        """
+        import numpy as np
+
+        if isinstance(layouts, np.ndarray):
+            if layouts.ndim != 3 or layouts.shape[1:] != (self.board_height, self.board_width):
+                raise ValueError(f"Invalid boat id array shape {layouts.shape}")
+            chunk_results = [self._check_boat_id_array(boat_ids=layouts[start:start + chunk_size],
+                                                       ignore_boat_count=ignore_boat_count)
+                             for start in range(0, len(layouts), chunk_size)]
+        else:
+            layouts = list(layouts)
+            chunk_results = []
+            for start in range(0, len(layouts), chunk_size):
+                boat_ids, boat_lengths, reasons = self._row_col_lists_to_boat_id_array(
+                    layouts[start:start + chunk_size])
+                chunk_results.append(self._check_boat_id_array(
+                    boat_ids=boat_ids, boat_lengths=boat_lengths,
+                    ignore_boat_count=ignore_boat_count, reasons=reasons))
+
+        if not chunk_results:
+            return np.zeros(0, dtype=bool), np.zeros(0, dtype=np.uint8)
+        reasons = np.concatenate(chunk_results)
+        return reasons == Battl3ship.LAYOUT_VALID, reasons
+
+    def _row_col_lists_to_boat_id_array(self, layouts):
+        """Paint a list of layouts in the `row_col_lists` format into a boat id array
+        as described in `Battl3ship.check_boat_layouts`. The i-th boat of each layout gets id i+1.
+
+        Problems that cannot be detected in the boat id array (invalid format, squares outside
+        the board and repeated squares) are reported in the returned reasons array.
+
+        :return: boat_ids, boat_lengths, reasons. boat_lengths is a (N, max_boat_count) array
+          with the length of each boat, or -1 if the layout has fewer boats.
+        """
+        import numpy as np
+
+        height, width = self.board_height, self.board_width
+        reasons = np.zeros(len(layouts), dtype=np.uint8)
+        max_boat_count = max((len(layout) for layout in layouts if isinstance(layout, (list, tuple))),
+                             default=0)
+        if max_boat_count > 255:
+            raise ValueError("Too many boats in a layout")
+
+        try:
+            # Fast path: all layouts are well formed and coordinates are ints.
+            # All loops run in C (map, itertools and np.fromiter).
+            boat_counts = np.fromiter(map(len, layouts), dtype=np.int64, count=len(layouts))
+            boats = list(itertools.chain.from_iterable(layouts))
+            lengths = np.fromiter(map(len, boats), dtype=np.int64, count=len(boats))
+            squares = list(itertools.chain.from_iterable(boats))
+            coordinates = list(itertools.chain.from_iterable(squares))
+            if set(map(len, squares)) - {2} or set(map(type, coordinates)) - {int}:
+                raise TypeError("Not all squares are pairs of ints")
+            coordinates = np.fromiter(coordinates, dtype=np.int64, count=len(coordinates))
+            rows, cols = coordinates[0::2] - 1, coordinates[1::2] - 1
+
+            boat_starts = np.cumsum(boat_counts) - boat_counts
+            boat_id_by_boat = np.arange(len(boats)) - np.repeat(boat_starts, boat_counts) + 1
+            boat_ids = np.repeat(boat_id_by_boat, lengths).astype(np.uint8)
+            layout_indices = np.repeat(np.repeat(np.arange(len(layouts)), boat_counts), lengths)
+            boat_lengths = np.full((len(layouts), max_boat_count), -1, dtype=np.int64)
+            boat_lengths[np.repeat(np.arange(len(layouts)), boat_counts), boat_id_by_boat - 1] = lengths
+        except (TypeError, ValueError):
+            boat_lengths, layout_indices, boat_ids, rows, cols = \
+                self._row_col_lists_to_flat_arrays(layouts, max_boat_count, reasons)
+
+        def set_reason(layout_indices_with_error, code):
+            """Set code for those layouts not already reporting an error with higher priority (lower code).
+            """
+            current_reasons = reasons[layout_indices_with_error]
+            reasons[layout_indices_with_error] = np.where(
+                (current_reasons == Battl3ship.LAYOUT_VALID) | (current_reasons > code), code, current_reasons)
+
+        # Squares outside the board are not painted
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        set_reason(layout_indices[~inside], Battl3ship.LAYOUT_OUT_OF_BOUNDS)
+        layout_indices, boat_ids, rows, cols = \
+            layout_indices[inside], boat_ids[inside], rows[inside], cols[inside]
+
+        # Repeated squares: within a boat they break linearity, otherwise boats overlap
+        flat_indices = (layout_indices * height + rows) * width + cols
+        order = np.argsort(flat_indices, kind="stable")
+        repeated = flat_indices[order][1:] == flat_indices[order][:-1]
+        same_boat = boat_ids[order][1:] == boat_ids[order][:-1]
+        set_reason(layout_indices[order][1:][repeated & same_boat], Battl3ship.LAYOUT_NOT_LINEAR)
+        set_reason(layout_indices[order][1:][repeated & ~same_boat], Battl3ship.LAYOUT_OVERLAP)
+
+        boat_id_array = np.zeros(len(layouts) * height * width, dtype=np.uint8)
+        boat_id_array[flat_indices] = boat_ids
+        return boat_id_array.reshape((len(layouts), height, width)), boat_lengths, reasons
+
+    def _row_col_lists_to_flat_arrays(self, layouts, max_boat_count, reasons):
+        """Slow path of `Battl3ship._row_col_lists_to_boat_id_array`, which tolerates malformed layouts.
+        Malformed layouts get the `Battl3ship.LAYOUT_INVALID_FORMAT` code in reasons and are otherwise ignored.
+
+        :return: boat_lengths, layout_indices, boat_ids, rows, cols, where the last four arrays contain
+          one entry per boat square and rows and cols are zero-indexed.
+        """
+        import numpy as np
+
+        # One list of max_boat_count lengths per layout, padded with -1
+        boat_lengths = []
+        # Flat lists with one entry per boat square
+        layout_indices = []
+        boat_ids = []
+        rows = []
+        cols = []
+        for layout_index, layout in enumerate(layouts):
+            try:
+                lengths = [len(row_col_list) for row_col_list in layout]
+                layout_rows = [row.__index__() for row_col_list in layout for row, _ in row_col_list]
+                layout_cols = [col.__index__() for row_col_list in layout for _, col in row_col_list]
+            except (TypeError, ValueError, AttributeError):
+                reasons[layout_index] = Battl3ship.LAYOUT_INVALID_FORMAT
+                boat_lengths.append([-1] * max_boat_count)
+                continue
+            boat_lengths.append(lengths + [-1] * (max_boat_count - len(lengths)))
+            layout_indices.extend([layout_index] * len(layout_rows))
+            for boat_id, length in enumerate(lengths, start=1):
+                boat_ids.extend([boat_id] * length)
+            rows.extend(layout_rows)
+            cols.extend(layout_cols)
+
+        return np.array(boat_lengths, dtype=np.int64).reshape((len(layouts), max_boat_count)), \
+               np.array(layout_indices, dtype=np.int64), \
+               np.array(boat_ids, dtype=np.uint8), \
+               np.array(rows, dtype=np.int64) - 1, \
+               np.array(cols, dtype=np.int64) - 1
+
+    def _check_boat_id_array(self, boat_ids, ignore_boat_count, boat_lengths=None, reasons=None):
+        """Check a (N, height, width) boat id array as described in `Battl3ship.check_boat_layouts`.
+
+        Boats are described by grouping their squares by (layout, boat id), so most of the cost is
+        proportional to the number of boat squares rather than to the size of the boards.
+
+        :param boat_lengths: if not None, a (N, K) array of boat lengths (-1 for missing boats) used instead of
+          the number of squares of each id in boat_ids.
+        :param reasons: if not None, a length-N array of previously detected reasons,
+          which is updated and returned.
+
+        :return: the array of reasons
+        """
+        import numpy as np
+
+        layout_count, height, width = boat_ids.shape
+        if reasons is None:
+            reasons = np.zeros(layout_count, dtype=np.uint8)
+        if layout_count == 0:
+            return reasons
+
+        def set_reason(failed, code):
+            """Set code for failed layouts not already reporting an error with higher priority (lower code).
+            """
+            reasons[:] = np.where(failed & ((reasons == Battl3ship.LAYOUT_VALID) | (reasons > code)), code, reasons)
+
+        if boat_ids.min() < 0:
+            set_reason(np.asarray((boat_ids < 0).any(axis=(1, 2))), Battl3ship.LAYOUT_INVALID_FORMAT)
+            boat_ids = np.maximum(boat_ids, 0)
+
+        # Only boat squares are examined from here on. Boats are identified by a (layout, boat id) key,
+        # and described by the number of squares and the sums and sums of squares of their coordinates.
+        max_boat_id = int(boat_ids.max())
+        key_count = max_boat_id + 1
+        layout_indices, rows, cols = np.nonzero(boat_ids)
+        square_boat_ids = boat_ids[layout_indices, rows, cols].astype(np.int64)
+        keys = layout_indices * key_count + square_boat_ids
+        bin_count = layout_count * key_count
+        square_counts = np.bincount(keys, minlength=bin_count)
+        present = square_counts > 0
+
+        # Boat lengths and counts
+        if boat_lengths is None:
+            boat_lengths = np.where(present, square_counts, -1).reshape((layout_count, key_count))[:, 1:]
+        allowed_lengths = np.array(sorted(required_boat_count_by_length.keys()))
+        set_reason(((boat_lengths >= 0) & ~np.isin(boat_lengths, allowed_lengths)).any(axis=1),
+                   Battl3ship.LAYOUT_INVALID_LENGTH)
+        for length, required_count in required_boat_count_by_length.items():
+            count = (boat_lengths == length).sum(axis=1)
+            set_reason(count > required_count if ignore_boat_count else count != required_count,
+                       Battl3ship.LAYOUT_INVALID_BOAT_COUNT)
+
+        # Boat geometry. For L distinct squares, all rows are equal iff L * sum(r^2) - sum(r)^2 == 0,
+        # and the columns are then consecutive iff L * sum(c^2) - sum(c)^2 == L^2 * (L^2 - 1) / 12,
+        # the minimum possible for L distinct integers (and vice versa for vertical boats).
+        row_sums = np.bincount(keys, weights=rows, minlength=bin_count)
+        row_square_sums = np.bincount(keys, weights=rows * rows, minlength=bin_count)
+        col_sums = np.bincount(keys, weights=cols, minlength=bin_count)
+        col_square_sums = np.bincount(keys, weights=cols * cols, minlength=bin_count)
+        row_spread = square_counts * row_square_sums - row_sums * row_sums
+        col_spread = square_counts * col_square_sums - col_sums * col_sums
+        line_spread = square_counts * square_counts * (square_counts * square_counts - 1) / 12
+        single_row = row_spread == 0
+        single_col = col_spread == 0
+        linear = (single_row & (col_spread == line_spread)) | (single_col & (row_spread == line_spread))
+        on_edge = (single_row & ((row_sums == 0) | (row_sums == square_counts * (height - 1)))) \
+                  | (single_col & ((col_sums == 0) | (col_sums == square_counts * (width - 1))))
+        set_reason((present & ~linear).reshape((layout_count, key_count)).any(axis=1),
+                   Battl3ship.LAYOUT_NOT_LINEAR)
+        set_reason((present & on_edge).reshape((layout_count, key_count)).any(axis=1),
+                   Battl3ship.LAYOUT_ON_EDGE)
+
+        # Squares of different boats cannot be neighbours. Neighbours are read from a padded copy
+        # so that no bounds checks are needed.
+        stride = width + 2
+        padded_ids = np.zeros((layout_count, height + 2, stride), dtype=boat_ids.dtype)
+        padded_ids[:, 1:-1, 1:-1] = boat_ids
+        padded_ids = padded_ids.reshape(-1)
+        flat_indices = (layout_indices * (height + 2) + rows + 1) * stride + cols + 1
+        adjacent = np.zeros(layout_count, dtype=bool)
+        for offset in (1, stride - 1, stride, stride + 1):
+            neighbour_ids = padded_ids[flat_indices + offset]
+            adjacent[layout_indices[(neighbour_ids != 0) & (neighbour_ids != square_boat_ids)]] = True
+        set_reason(adjacent, Battl3ship.LAYOUT_ADJACENT)
+
+        return reasons
+
+    def shot(self, player_from, row_col_lists, return_code=False):
         """Make a shot in an active, accepting shots game, updating the receiving player's
         board and returning the combined shot results (and whether the game is finished).
         The value of `self.player_turn` is automatically updated by this method.
@@ -260,10 +547,12 @@ class Battl3ship:
         :param row_col_lists: a list of length-2 iterables (row, column) describing the
           shots made. Note that all row and col indices must be in the [1, height] and [1, width]
           ranges, respectively.
+        :param return_code: if True, the shot results are returned as the integer code
+          assigned to them by `self.result_code_registry` instead of as lists.
 
         :raise ValueError: if either the player or the shot is not valid.
 
-        :return: hit_list, sink_list, game_finished
+        :return: hit_list, sink_list, game_finished; or result_code, game_finished if return_code is True
         """
         if not self.accepting_shots:
             raise ValueError("This board is not accepting shots")
@@ -280,15 +569,15 @@ class Battl3ship:
             raise ValueError(f"Unknown player_from {player_from}")
 
         # Enforce correct format
-        if len(row_col_lists) != 3 \
+        if len(row_col_lists) != self.shots_per_turn \
                 or any(len(rc) != 2 for rc in row_col_lists) \
-                or any((not 1 <= r <= self.board_height) or (not 1 <= c <= self.board_height)
+                or any((not 1 <= r <= self.board_height) or (not 1 <= c <= self.board_width)
                        for r, c in row_col_lists):
             raise ValueError(f"Invalid row_col_lists = {row_col_lists}")
 
         # Avoid duplicated shots
         if any(rc == row_col_lists[0] for rc in row_col_lists[1:]) \
-                or any(opponent_board[r, c].shot_id_list for r, c in row_col_lists):
+                or any(opponent_board.is_shot(r, c) for r, c in row_col_lists):
             raise ValueError("Invalid (repeated) shot")
 
         # Make actual shot
@@ -299,6 +588,8 @@ class Battl3ship:
         # Switch turns
         self.player_turn = self.other_player
 
+        if return_code:
+            return self.result_code_registry.encode(hit_list, sink_list), game_finished
         return hit_list, sink_list, game_finished
 
     def __str__(self):
@@ -383,6 +674,16 @@ class Battl3ship:
                 for row, col in row_col_list:
                     self[row, col].boat_row_col_list = list(row_col_list)
 
+        def is_shot(self, row, col):
+            """Return True iff at least one shot has been made at (row, col).
+            """
+            return len(self.square_by_xy[row, col].shot_id_list) > 0
+
+        def _get_square(self, x, y):
+            """Return the Square instance at (x, y).
+            """
+            return self.square_by_xy[(x, y)]
+
         def __getitem__(self, index):
             """Get the square or list of Squares at the positions given by
             a r,c slice.
@@ -402,10 +703,10 @@ class Battl3ship:
 
                 for x in x_coordinates:
                     for y in y_coordinates:
-                        matching_squares.append(self.square_by_xy[(x, y)])
+                        matching_squares.append(self._get_square(x, y))
                 return matching_squares
             else:
-                return self.square_by_xy[index]
+                return self._get_square(*index)
 
         def __str__(self):
             """Return a textual representation of the board.
@@ -440,6 +741,111 @@ class Battl3ship:
             representation_chars += ["+"] + (["-"] * self.width) + ["+"]
             return "".join(representation_chars)
 
+    class BitBoard(Board):
+        """Board implementation that keeps boats and shots as integer bitmasks.
+
+        Square (x, y) is represented by bit `x * (height + 1) + y`. Boats, shots and
+        each individual boat are stored as masks, so that resolving a shot, detecting sunk boats
+        and checking whether the game is finished only require a few bit operations.
+
+        The `shot`, `set_boats` and `is_shot` methods behave exactly as in `Battl3ship.Board`.
+        Indexing with board[x,y] returns Square instances built on demand from the masks:
+        they describe the current state, but modifying them does not alter the board.
+        """
+
+        def __init__(self, width=default_board_width, height=default_board_height):
+            self.width = width
+            self.height = height
+            self.locked = False
+            self.shots = []
+            self.boat_row_col_list = None
+
+            # As in `Battl3ship.Board`, the first index goes up to width and the second up to height
+            self._row_stride = height + 1
+            # Union of all boat squares
+            self.boat_mask = 0
+            # Union of all shot squares
+            self.shot_mask = 0
+            # One mask per boat, in the order given to set_boats
+            self.boat_masks = []
+            self._boat_row_col_lists = []
+            # bit index -> index in self.boat_masks of the boat occupying that square
+            self._boat_index_by_bit_index = dict()
+
+        def shot(self, row_col_lists):
+            """Make a shot on the board, updating the masks as necessary, and reporting the combined
+            shot results as (hit_length_list, sunk_length_list, game_finished)
+            as described in `Battl3ship.shot`.
+
+            See `Battl3ship.Board.shot`.
+            """
+            assert self.locked
+            self.shots.append(row_col_lists)
+
+            row_stride = self._row_stride
+            previous_shot_mask = self.shot_mask
+            shot_mask = previous_shot_mask
+            touched_boat_indices = set()
+            for (row, col) in row_col_lists:
+                bit_index = row * row_stride + col
+                shot_mask |= 1 << bit_index
+                # Only reporting the first shot on each square
+                if not (previous_shot_mask >> bit_index) & 1:
+                    boat_index = self._boat_index_by_bit_index.get(bit_index)
+                    if boat_index is not None:
+                        touched_boat_indices.add(boat_index)
+            self.shot_mask = shot_mask
+
+            hit_length_list = []
+            sunk_length_list = []
+            for boat_index in touched_boat_indices:
+                boat_mask = self.boat_masks[boat_index]
+                boat_length = len(self._boat_row_col_lists[boat_index])
+                if boat_mask & ~shot_mask:
+                    hit_length_list.append(boat_length)
+                else:
+                    sunk_length_list.append(boat_length)
+
+            return sorted(hit_length_list), \
+                   sorted(sunk_length_list), \
+                   not (self.boat_mask & ~shot_mask)
+
+        def set_boats(self, row_col_lists):
+            row_stride = self._row_stride
+            for row_col_list in row_col_lists:
+                boat_index = len(self.boat_masks)
+                boat_mask = 0
+                for row, col in row_col_list:
+                    bit_index = row * row_stride + col
+                    boat_mask |= 1 << bit_index
+                    self._boat_index_by_bit_index[bit_index] = boat_index
+                self.boat_masks.append(boat_mask)
+                self._boat_row_col_lists.append(list(row_col_list))
+                self.boat_mask |= boat_mask
+
+        def is_shot(self, row, col):
+            self._check_coordinates(row, col)
+            return bool((self.shot_mask >> (row * self._row_stride + col)) & 1)
+
+        def _get_square(self, x, y):
+            self._check_coordinates(x, y)
+            bit_index = x * self._row_stride + y
+            shot_id_list = []
+            if (self.shot_mask >> bit_index) & 1:
+                shot_id_list = [shot_id
+                                for shot_id, row_col_lists in enumerate(self.shots, start=1)
+                                for row, col in row_col_lists
+                                if (row, col) == (x, y)]
+            boat_index = self._boat_index_by_bit_index.get(bit_index)
+            boat_row_col_list = list(self._boat_row_col_lists[boat_index]) if boat_index is not None else []
+            return Battl3ship.Square(x, y, shot_id_list=shot_id_list, boat_row_col_list=boat_row_col_list)
+
+        def _check_coordinates(self, x, y):
+            """:raise KeyError: if (x, y) is outside the board, as `Battl3ship.Board` would.
+            """
+            if not (0 <= x <= self.width and 0 <= y <= self.height):
+                raise KeyError((x, y))
+
     class Square:
         """Represent a board's square, and provide fast access to the any boat or
         shot placed in it.
@@ -474,6 +880,103 @@ class Battl3ship:
             return self.__str__()
 
 
+class ResultCodeRegistry:
+    """Bidirectional mapping between the combined results of a turn, (hit_tuple, sunk_tuple),
+    and consecutive integer result codes, for a given fleet and number of shots per turn.
+
+    * `code_to_hit_sunk_list` is a list indexed by result code, each entry being
+      a tuple (hit_tuple, sunk_tuple) of ascending boat lengths, as returned by `Battl3ship.shot`.
+      Any or both of the tuples can be empty. Repeated values can appear within and across
+      the two tuples. Codes cover all possible shot results.
+    * `hit_sunk_to_code_dict` is the inverse dict, indexed by `(hit_tuple, sunk_tuple)`.
+
+    Codes are sorted as the tuples of individual shot results (is_hit, length) that
+    describe them, with misses first as (False, 0) and, for each length, hits before sinks.
+
+    Registries are immutable: use `ResultCodeRegistry.get` to obtain a cached instance.
+    """
+    # (sorted boat_count_by_length items, shots_per_turn) -> ResultCodeRegistry
+    _registry_by_config = dict()
+
+    def __init__(self, boat_count_by_length=None, shots_per_turn=None):
+        """
+        :param boat_count_by_length: dict with the number of boats of each length.
+          If None, `required_boat_count_by_length` is used.
+        :param shots_per_turn: number of shots made each turn. If None, `default_shots_per_turn` is used.
+        """
+        boat_count_by_length = boat_count_by_length if boat_count_by_length is not None \
+            else required_boat_count_by_length
+        self.shots_per_turn = shots_per_turn if shots_per_turn is not None else default_shots_per_turn
+        self.boat_count_by_length = dict(boat_count_by_length)
+        assert all(length >= 1 for length in self.boat_count_by_length)
+
+        # Each result is described by the shot results of the turn, (is_hit, length),
+        # so that they can be sorted consistently for any fleet
+        shot_result_lists = [[(False, 0)] * (self.shots_per_turn - sum(len(r) for r in results))
+                             + [shot_result for r in results for shot_result in r]
+                             for results in self._iterate_length_results(
+                sorted(self.boat_count_by_length.items()), self.shots_per_turn)]
+        shot_result_lists.sort()
+
+        self.code_to_hit_sunk_list = []
+        self.hit_sunk_to_code_dict = dict()
+        for shot_results in shot_result_lists:
+            hit_sunk = (tuple(length for is_hit, length in shot_results if is_hit),
+                        tuple(length for is_hit, length in shot_results if not is_hit and length != 0))
+            self.hit_sunk_to_code_dict[hit_sunk] = len(self.code_to_hit_sunk_list)
+            self.code_to_hit_sunk_list.append(hit_sunk)
+
+    @staticmethod
+    def _iterate_length_results(length_count_list, remaining_shots):
+        """Yield all the lists of shot results (one sublist per length in length_count_list)
+        possible with remaining_shots shots, where boats of length 1 can only be sunk
+        and no more boats than available of each length can be affected.
+        """
+        if not length_count_list:
+            yield []
+            return
+        (length, boat_count), other_length_counts = length_count_list[0], length_count_list[1:]
+        max_affected_count = min(boat_count, remaining_shots)
+        for hit_count in range(max_affected_count + 1 if length > 1 else 1):
+            for sunk_count in range(max_affected_count - hit_count + 1):
+                results = [(True, length)] * hit_count + [(False, length)] * sunk_count
+                for other_results in ResultCodeRegistry._iterate_length_results(
+                        other_length_counts, remaining_shots - hit_count - sunk_count):
+                    yield [results] + other_results
+
+    @classmethod
+    def get(cls, boat_count_by_length=None, shots_per_turn=None):
+        """Get the (cached) registry for a given configuration.
+        Parameters are as in `ResultCodeRegistry.__init__`.
+        """
+        key = (tuple(sorted((boat_count_by_length if boat_count_by_length is not None
+                             else required_boat_count_by_length).items())),
+               shots_per_turn if shots_per_turn is not None else default_shots_per_turn)
+        try:
+            return cls._registry_by_config[key]
+        except KeyError:
+            registry = cls(boat_count_by_length=dict(key[0]), shots_per_turn=key[1])
+            return cls._registry_by_config.setdefault(key, registry)
+
+    def encode(self, hit_length_list, sunk_length_list):
+        """Get the result code of a turn's results, as returned by `Battl3ship.shot`.
+
+        :raise ValueError: if the results are not possible with this registry's configuration.
+        """
+        try:
+            return self.hit_sunk_to_code_dict[(tuple(hit_length_list), tuple(sunk_length_list))]
+        except KeyError:
+            raise ValueError(f"Invalid results hit={hit_length_list}, sunk={sunk_length_list}")
+
+    def decode(self, code):
+        """Get the (hit_tuple, sunk_tuple) described by a result code.
+        """
+        return self.code_to_hit_sunk_list[code]
+
+    def __len__(self):
+        return len(self.code_to_hit_sunk_list)
+
+
 def test_syntax():
     width = 10
     height = 30
@@ -492,6 +995,28 @@ def test_syntax():
     board[0, 0].boat_list = list(boat_list)
     print(board[0, 0])
 
+    bit_board = Battl3ship.BitBoard(width=width, height=height)
+    bit_board.set_boats([[(2, 2), (2, 3)]])
+    bit_board.locked = True
+    assert bit_board.shot([(2, 2), (5, 5), (5, 5)]) == ([2], [], False)
+    assert bit_board.shot([(2, 3), (6, 6), (7, 7)]) == ([], [2], True)
+    assert bit_board[5, 5].shot_id_list == [1, 1]
+    assert bit_board[2, 3].boat_row_col_list == [(2, 2), (2, 3)]
+    for x in range(width):
+        for y in range(height):
+            assert bit_board[x, y].x == x
+            assert bit_board[x, y].y == y
+    assert bit_board.shot([(width - 1, height - 1)]) == ([], [], True)
+    assert bit_board.is_shot(width - 1, height - 1)
+
+    registry = ResultCodeRegistry.get()
+    assert registry is ResultCodeRegistry.get(boat_count_by_length=dict(required_boat_count_by_length))
+    assert registry.decode(0) == ((), ())
+    for code in range(len(registry)):
+        assert registry.encode(*registry.decode(code)) == code
+    single_shot_registry = ResultCodeRegistry.get(boat_count_by_length={1: 2, 2: 1}, shots_per_turn=1)
+    assert single_shot_registry.code_to_hit_sunk_list == [((), ()), ((), (1,)), ((), (2,)), ((2,), ())]
+
     print("[game.py] Tests ok!")
 
 
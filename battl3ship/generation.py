@@ -18,8 +18,14 @@
 """
 __author__ = "Miguel Hernández Cabronero <mhernandez@deic.uab.cat>"
 
+import sys
+import os
+import collections
 import itertools
+import multiprocessing
+import queue
 import random
+import threading
 import time
 
 from game import Battl3ship
@@ -76,18 +82,113 @@ def unique_permutations(sequence):
 
     return unique_permutations
 
+def get_board_symmetries(width=None, height=None):
+    """Get the symmetries of the board, i.e., the maps obtained by flipping rows and/or columns and,
+    for square boards, transposing. The boat placement rules are invariant under these symmetries.
+
+    :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+
+    :return: a list of 8 functions (4 for non-square boards) that map a (row, col) tuple to its image,
+      the first one being the identity.
+    """
+    width = width if width is not None else Battl3ship.default_board_width
+    height = height if height is not None else Battl3ship.default_board_height
+
+    def get_symmetry(transpose, flip_rows, flip_cols):
+        def symmetry(row_col):
+            row, col = row_col
+            if transpose:
+                row, col = col, row
+            if flip_rows:
+                row = height + 1 - row
+            if flip_cols:
+                col = width + 1 - col
+            return row, col
+
+        return symmetry
+
+    return [get_symmetry(transpose=transpose, flip_rows=flip_rows, flip_cols=flip_cols)
+            for transpose in ([False, True] if width == height else [False])
+            for flip_rows in [False, True]
+            for flip_cols in [False, True]]
+
+
+def get_symmetric_placements(placement, width=None, height=None):
+    """Get all distinct images of a placement under the symmetries of the board
+    (see `get_board_symmetries`). All images of a valid placement are valid.
+
+    :param placement: a list of boats, each boat being a list of (row,col) coordinates.
+    :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+
+    :return: a list of up to 8 distinct placements (4 for non-square boards), in the order of
+      `get_board_symmetries`. The first one is the identity image, i.e., placement with its boats
+      and their squares sorted, as in every other image. The list itself is not sorted.
+    """
+    images = []
+    for symmetry in get_board_symmetries(width=width, height=height):
+        image = sorted(sorted(map(symmetry, row_col_list)) for row_col_list in placement)
+        if image not in images:
+            images.append(image)
+    return images
+
+
+def get_canonical_placement(placement, width=None, height=None):
+    """Get the canonical form of a placement, i.e., the smallest of its symmetric images
+    (see `get_symmetric_placements`). Two placements have the same canonical form if and only if
+    one is an image of the other.
+
+    :param placement: a list of boats, each boat being a list of (row,col) coordinates.
+    :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+
+    :return: the canonical placement, a sorted list of boats, each a sorted list of (row, col) coordinates.
+    """
+    return min(get_symmetric_placements(placement=placement, width=width, height=height))
+
+
+def get_placement_from_row_cols(occupied_row_cols):
+    """Get the placement that occupies exactly the given squares, assuming that no two boats touch
+    (as is the case for valid placements).
+
+    :param occupied_row_cols: an iterable of (row, col) coordinates.
+    :return: a list of boats, each a list of (row, col) coordinates, sorted as in `get_canonical_placement`.
+    """
+    occupied_row_cols = set(occupied_row_cols)
+    row_col_lists = []
+    for row, col in sorted(occupied_row_cols):
+        if (row, col - 1) in occupied_row_cols or (row - 1, col) in occupied_row_cols:
+            # Not the first square of its boat
+            continue
+        step = (0, 1) if (row, col + 1) in occupied_row_cols else (1, 0)
+        row_col_list = [(row, col)]
+        while (row_col_list[-1][0] + step[0], row_col_list[-1][1] + step[1]) in occupied_row_cols:
+            row_col_list.append((row_col_list[-1][0] + step[0], row_col_list[-1][1] + step[1]))
+        row_col_lists.append(row_col_list)
+    return row_col_lists
+
+
 class RandomBoatPlacer:
     """Class to produce random and valid boat placements.
+
+    In symmetric mode, all distinct images (see `get_symmetric_placements`) of each placement
+    found are returned by consecutive calls to `get_random_placement`, which produces
+    up to 8 placements per search. Consecutive placements are then not independent.
     """
     # Used to avoid delays when generating boards.
     max_exploration_count = 100
 
-    def __init__(self, width=None, height=None):
+    def __init__(self, width=None, height=None, seed=None, symmetric=False):
         """Initialize, optionally defining the board dimensions.
         :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+        :param seed: seed for `self.random_generator`, the source of randomness of this placer.
+          If None, the generator is seeded from the OS entropy sources.
+        :param symmetric: if True, the placer works in symmetric mode.
         """
         self.width = width if width is not None else Battl3ship.default_board_width
         self.height = height if height is not None else Battl3ship.default_board_height
+        self.random_generator = random.Random(seed)
+        self.symmetric = symmetric
+        # Symmetric images of the last placement found, not yet returned
+        self.pending_placements = []
 
         # Used to validate positions without having to create a game
         # object every time
@@ -114,6 +215,9 @@ class RandomBoatPlacer:
         :return: a list of boats, each boat being a list of (row,col) coordinates.
           This is the format specified by `game.Battl3ship.set_boats`.
         """
+        if self.pending_placements:
+            return self.pending_placements.pop()
+
         remaining_positions = list(self.remaining_positions)
 
         placement = None
@@ -122,9 +226,9 @@ class RandomBoatPlacer:
         # Most usually, 3 or less iterations are needed.
         while placement is None:
             # Boats are placed in a random order
-            remaining_lengths = random.sample(self.unique_length_permutations, 1)[0]
+            remaining_lengths = self.random_generator.sample(self.unique_length_permutations, 1)[0]
             # Positions are explored in a random order
-            random.shuffle(remaining_positions)
+            self.random_generator.shuffle(remaining_positions)
 
             placement, exploration_count = self._recursive_get_one_valid_placement(
                 remaining_positions=remaining_positions,
@@ -132,6 +236,12 @@ class RandomBoatPlacer:
                 current_boat_placement=[],
                 exploration_count=0)
 
+        if self.symmetric:
+            # Images are returned in the order produced by get_symmetric_placements
+            self.pending_placements = get_symmetric_placements(
+                placement=placement, width=self.width, height=self.height)[::-1]
+            return self.pending_placements.pop()
+
         return placement
 
     def _recursive_get_one_valid_placement(self,
@@ -161,7 +271,7 @@ class RandomBoatPlacer:
         next_length = remaining_lengths[0]
 
         orientation_order = [False, True]
-        random.shuffle(orientation_order)
+        self.random_generator.shuffle(orientation_order)
         for is_boat_horizontal in orientation_order:
             # Build tentative placement assuming next_length and next_position
             try:
@@ -242,6 +352,595 @@ class RandomBoatPlacer:
 
         return boat_row_cols, surrounding_row_cols
 
+class BitmaskBoatPlacer:
+    """Class to produce random and valid boat placements, much faster than `RandomBoatPlacer`.
+
+    Square (row, col) is represented by bit (row - 1) * width + (col - 1) of an integer mask.
+    Boats are identified by their length, orientation and the bit of their top-left square (their start).
+    For each length and orientation, the mask of starts that satisfy the placement rules on their own,
+    and the halo (boat plus surrounding squares) of every boat, are computed once.
+
+    Boats are then placed from longest to shortest by backtracking. The free squares are those
+    not in the halos of the boats already placed, and the starts of all boats of length L that fit
+    are obtained at once as free & (free >> step) & ... & (free >> (L-1)*step) & valid_starts,
+    where step is 1 for horizontal boats and width for vertical ones.
+    """
+    # Maximum number of boats tentatively placed in each search. When exceeded, a new
+    # search is started from scratch, which is much faster than exploring dead ends.
+    max_node_count = 12
+    # Maximum number of searches before giving up
+    max_restart_count = 10000
+    # Random boats are probed only if at least 1 / min_probe_fitting_fraction_inverse of them fit.
+    # Otherwise, one of the fitting boats is selected directly from the binary representation of the masks.
+    min_probe_fitting_fraction_inverse = 4
+
+    def __init__(self, width=None, height=None, seed=None):
+        """Initialize, optionally defining the board dimensions.
+        :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+        :param seed: seed for `self.random_generator`, the source of randomness of this placer.
+          If None, the generator is seeded from the OS entropy sources.
+        """
+        self.width = width if width is not None else Battl3ship.default_board_width
+        self.height = height if height is not None else Battl3ship.default_board_height
+        self.random_generator = random.Random(seed)
+        self.full_mask = (1 << (self.width * self.height)) - 1
+
+        # Used to validate positions without having to create a game
+        # object every time
+        self.dummy_game = Battl3ship(player_a=None, player_b=None, starting_player=None,
+                                     board_width=self.width, board_height=self.height)
+
+        # Longest boats are placed first, as they have fewer valid positions
+        self.boat_lengths = sorted(itertools.chain(*(
+            [length] * count for length, count in Battl3ship.required_boat_count_by_length.items())),
+            reverse=True)
+
+        # Masks of valid starts for each length
+        self.horizontal_start_mask_by_length = {}
+        self.vertical_start_mask_by_length = {}
+        # List of (is_horizontal, start) of all valid boats for each length
+        self.candidates_by_length = {}
+        # Dicts indexed by (is_horizontal, start) for each length. The free mask of a boat
+        # is the complement of its halo, i.e., the squares that remain free after placing it.
+        self.free_mask_by_length_candidate = {}
+        self.row_col_list_by_length_candidate = {}
+        for length in set(self.boat_lengths):
+            self.horizontal_start_mask_by_length[length] = 0
+            self.vertical_start_mask_by_length[length] = 0
+            self.candidates_by_length[length] = []
+            self.free_mask_by_length_candidate[length] = {}
+            self.row_col_list_by_length_candidate[length] = {}
+            # Boats of length 1 are only considered once (as horizontal)
+            for is_horizontal in ([True] if length == 1 else [True, False]):
+                for row in range(1, self.height + 1):
+                    for col in range(1, self.width + 1):
+                        if is_horizontal:
+                            row_col_list = [(row, col + i) for i in range(length)]
+                        else:
+                            row_col_list = [(row + i, col) for i in range(length)]
+                        if not self.dummy_game.is_valid_boat_layout(
+                                row_col_lists=[row_col_list], ignore_boat_count=True):
+                            continue
+
+                        start = (row - 1) * self.width + (col - 1)
+                        if is_horizontal:
+                            self.horizontal_start_mask_by_length[length] |= 1 << start
+                        else:
+                            self.vertical_start_mask_by_length[length] |= 1 << start
+                        candidate = (is_horizontal, start)
+                        self.candidates_by_length[length].append(candidate)
+                        self.free_mask_by_length_candidate[length][candidate] = self.full_mask & ~self._row_cols_to_mask(
+                            (r + dr, c + dc)
+                            for r, c in row_col_list
+                            for dr in (-1, 0, 1)
+                            for dc in (-1, 0, 1))
+                        self.row_col_list_by_length_candidate[length][candidate] = row_col_list
+
+        # Data needed to place the boat_index-th boat, gathered in a tuple to save lookups
+        self._boat_placement_data = [
+            (self.horizontal_start_mask_by_length[length],
+             self.vertical_start_mask_by_length[length],
+             [(i, i * self.width) for i in range(1, length)],
+             self.candidates_by_length[length],
+             self.free_mask_by_length_candidate[length])
+            for length in self.boat_lengths]
+
+    def get_random_placement(self):
+        """Get a random valid boat placement.
+
+        :return: a list of boats, each boat being a list of (row,col) coordinates.
+          This is the format specified by `game.Battl3ship.set_boats`.
+
+        :raise ValueError: if no valid placement is found after `self.max_restart_count` searches.
+        """
+        for _ in range(self.max_restart_count):
+            chosen_candidates = []
+            remaining_node_count = [self.max_node_count]
+            if self._place_boats(boat_index=0, free_mask=self.full_mask, chosen_candidates=chosen_candidates,
+                                 remaining_node_count=remaining_node_count):
+                return [list(self.row_col_list_by_length_candidate[length][candidate])
+                        for length, candidate in zip(self.boat_lengths, chosen_candidates)]
+        raise ValueError("Cannot find a valid placement")
+
+    def _place_boats(self, boat_index, free_mask, chosen_candidates, remaining_node_count):
+        """Recursively place boats self.boat_lengths[boat_index:] so that they are within
+        free_mask, appending the (is_horizontal, start) of each boat to chosen_candidates.
+
+        :param remaining_node_count: a list with the number of calls that can still be made. It is
+          decreased in each call, and the search is abandoned when it reaches 0.
+
+        :return: True if all boats could be placed, False otherwise (chosen_candidates is then unchanged).
+        """
+        if boat_index == len(self.boat_lengths):
+            return True
+        remaining_node_count[0] -= 1
+        if remaining_node_count[0] < 0:
+            return False
+
+        horizontal_mask, vertical_mask, shifts, candidates, free_mask_by_candidate = \
+            self._boat_placement_data[boat_index]
+        horizontal_mask &= free_mask
+        vertical_mask &= free_mask
+        for horizontal_shift, vertical_shift in shifts:
+            horizontal_mask &= free_mask >> horizontal_shift
+            vertical_mask &= free_mask >> vertical_shift
+
+        candidate_count = len(candidates)
+        random_value = self.random_generator.random
+        while horizontal_mask or vertical_mask:
+            horizontal_bits = bin(horizontal_mask)
+            vertical_bits = bin(vertical_mask)
+            horizontal_count = horizontal_bits.count("1")
+            fitting_count = horizontal_count + vertical_bits.count("1")
+            if fitting_count * self.min_probe_fitting_fraction_inverse >= candidate_count:
+                # Many boats fit: probe random candidates until one fits
+                while True:
+                    is_horizontal, start = candidates[int(random_value() * candidate_count)]
+                    if ((horizontal_mask if is_horizontal else vertical_mask) >> start) & 1:
+                        break
+            else:
+                # Few boats fit: choose the k-th set bit of the masks
+                k = int(random_value() * fitting_count)
+                if k < horizontal_count:
+                    is_horizontal, bits = True, horizontal_bits
+                else:
+                    is_horizontal, bits = False, vertical_bits
+                    k -= horizontal_count
+                position = bits.find("1")
+                for _ in range(k):
+                    position = bits.find("1", position + 1)
+                start = len(bits) - 1 - position
+
+            if is_horizontal:
+                horizontal_mask &= ~(1 << start)
+            else:
+                vertical_mask &= ~(1 << start)
+            chosen_candidates.append((is_horizontal, start))
+            # Positional arguments are used because this is the innermost loop
+            if self._place_boats(boat_index + 1, free_mask & free_mask_by_candidate[is_horizontal, start],
+                                 chosen_candidates, remaining_node_count):
+                return True
+            chosen_candidates.pop()
+            if remaining_node_count[0] < 0:
+                break
+
+        return False
+
+    def _row_cols_to_mask(self, row_cols):
+        """Get the mask with the bits of all (row, col) squares set. Squares outside the board are ignored.
+        """
+        mask = 0
+        for row, col in row_cols:
+            if 1 <= row <= self.height and 1 <= col <= self.width:
+                mask |= 1 << ((row - 1) * self.width + (col - 1))
+        return mask
+
+class UniformBoatPlacer:
+    """Class to produce uniformly distributed random boat placements, i.e., all valid
+    placements are produced with the same probability. Unlike the other placers,
+    the cost of each placement is bounded: no search nor retries are involved.
+
+    All valid placements are counted exactly with a dynamic program over the rows of the board.
+    The profile of a row tells, for each column, whether the square is empty, occupied by a boat
+    that does not continue downwards, or occupied by a vertical boat of a given length so far
+    that may continue downwards. For each row r and profile P, the number of ways of completing
+    rows r, r+1, ... consuming exactly each possible sub-fleet is stored in
+    `self._completion_counts[r][P]`. Placements are then ranked in [0, `self.placement_count`),
+    and a uniform placement is obtained by unranking a random index row by row.
+
+    The boat placement rules of `game.Battl3ship.is_valid_boat_layout` are enforced while
+    building each row (which requires width and height to be at least 3). Building
+    the tables takes a few seconds for the default configuration, so instances are meant
+    to be reused. NumPy is required. Counts are stored as int64 while they are guaranteed to fit,
+    and as Python integers (object arrays) otherwise, so that they are always exact.
+    """
+    # Number of row transitions processed at once when building the tables
+    transition_chunk_size = 8192
+
+    def __init__(self, width=None, height=None, boat_count_by_length=None, seed=None):
+        """Initialize, optionally defining the board dimensions and the fleet.
+        :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+        :param boat_count_by_length: dict with the number of boats of each length. If None,
+          `game.Battl3ship.required_boat_count_by_length` is used.
+        :param seed: seed for `self.random_generator`, the source of randomness of this placer.
+          If None, the generator is seeded from the OS entropy sources.
+        """
+        import numpy as np
+
+        self.width = width if width is not None else Battl3ship.default_board_width
+        self.height = height if height is not None else Battl3ship.default_board_height
+        self.random_generator = random.Random(seed)
+        self.boat_count_by_length = dict(boat_count_by_length if boat_count_by_length is not None
+                                         else Battl3ship.required_boat_count_by_length)
+        self.max_length = max(length for length, count in self.boat_count_by_length.items() if count > 0)
+
+        # Sub-fleets are represented by the flat index of their boat counts (lengths 1, 2, ...)
+        # in an array of shape self._fleet_shape. An extra index (self._fleet_state_count)
+        # represents invalid fleets and always has zero completions.
+        boat_counts = [self.boat_count_by_length.get(length, 0) for length in range(1, self.max_length + 1)]
+        self._fleet_shape = tuple(count + 1 for count in boat_counts)
+        self._fleet_state_count = int(np.prod(self._fleet_shape))
+        self._full_fleet_index = int(np.ravel_multi_index(boat_counts, self._fleet_shape))
+        fleet_states = np.array(np.unravel_index(np.arange(self._fleet_state_count), self._fleet_shape)).T
+        # Index of each distinct tuple of consumed boat counts
+        self._consumed_index_by_counts = {}
+        # Row i gives the index of fleet - consumed for each fleet index, for the i-th consumed tuple
+        self._remaining_fleet_rows = []
+
+        # Reachable profiles before each row (the last one, after the last row)
+        self._profiles = [[(0,) * self.width]]
+        # Transitions from the profiles before row r to those after it, in compressed sparse row format:
+        # the transitions of the i-th profile are in range(offsets[i], offsets[i+1]) of the other arrays.
+        self._transition_offsets = []
+        self._transition_targets = []
+        self._transition_consumed_indices = []
+        self._transition_row_masks = []
+        transitions_by_kind_profile = {}
+        for row in range(self.height):
+            kind = (row in (0, self.height - 1), row == 1)
+            target_index_by_profile = {}
+            offsets = [0]
+            targets = []
+            consumed_indices = []
+            row_masks = []
+            for profile in self._profiles[-1]:
+                try:
+                    transitions = transitions_by_kind_profile[kind, profile]
+                except KeyError:
+                    transitions = self._get_row_transitions(
+                        profile=profile, is_edge_row=kind[0], is_below_edge_row=kind[1])
+                    transitions_by_kind_profile[kind, profile] = transitions
+                for target_profile, consumed_counts, row_mask in transitions:
+                    targets.append(target_index_by_profile.setdefault(
+                        target_profile, len(target_index_by_profile)))
+                    consumed_indices.append(self._get_consumed_index(consumed_counts, fleet_states))
+                    row_masks.append(row_mask)
+                offsets.append(len(targets))
+            self._profiles.append(list(target_index_by_profile.keys()))
+            self._transition_offsets.append(np.array(offsets, dtype=np.int64))
+            self._transition_targets.append(np.array(targets, dtype=np.int64))
+            self._transition_consumed_indices.append(np.array(consumed_indices, dtype=np.int64))
+            self._transition_row_masks.append(row_masks)
+        self._remaining_fleet_rows = np.array(self._remaining_fleet_rows, dtype=np.int64)
+
+        # After the last row, vertical boats are finished. Single-square boats there would be on the edge.
+        last_counts = np.zeros((len(self._profiles[-1]), self._fleet_state_count + 1), dtype=np.int64)
+        for i, profile in enumerate(self._profiles[-1]):
+            if 1 in profile:
+                continue
+            consumed_counts = self._get_consumed_counts(length for length in profile if length > 0)
+            if all(count <= max_count for count, max_count in zip(consumed_counts, boat_counts)):
+                last_counts[i, np.ravel_multi_index(consumed_counts, self._fleet_shape)] = 1
+
+        # Completion counts, computed backwards. Transitions are processed in chunks to bound memory usage.
+        self._completion_counts = [None] * self.height + [last_counts]
+        for row in range(self.height - 1, -1, -1):
+            next_counts = self._completion_counts[row + 1]
+            offsets = self._transition_offsets[row]
+            # Each count is a sum of at most max_transition_count counts of the next row
+            max_transition_count = int(np.diff(offsets).max(initial=0))
+            if next_counts.dtype == object \
+                    or int(next_counts.max(initial=0)) * max_transition_count > np.iinfo(np.int64).max:
+                dtype = object
+            else:
+                dtype = np.int64
+            counts = np.zeros((len(offsets) - 1, self._fleet_state_count + 1), dtype=dtype)
+            sources = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            for first in range(0, len(sources), self.transition_chunk_size):
+                chunk = slice(first, first + self.transition_chunk_size)
+                np.add.at(counts[:, :-1], sources[chunk], next_counts[
+                    self._transition_targets[row][chunk, np.newaxis],
+                    self._remaining_fleet_rows[self._transition_consumed_indices[row][chunk]]])
+            self._completion_counts[row] = counts
+
+        # Number of distinct valid placements
+        self.placement_count = int(self._completion_counts[0][0, self._full_fleet_index])
+
+    def get_random_placement(self):
+        """Get a random valid boat placement, with all valid placements being equally likely.
+
+        :return: a list of boats, each boat being a list of (row,col) coordinates.
+          This is the format specified by `game.Battl3ship.set_boats`.
+
+        :raise ValueError: if there are no valid placements.
+        """
+        if self.placement_count == 0:
+            raise ValueError("No valid placements exist for this board and fleet")
+        return self.get_placement(self.random_generator.randrange(self.placement_count))
+
+    def get_placement(self, index):
+        """Get the index-th valid boat placement (unranking). Different indices produce different placements.
+
+        :param index: integer in [0, `self.placement_count`)
+        :return: a list of boats, each boat being a list of (row,col) coordinates.
+          This is the format specified by `game.Battl3ship.set_boats`.
+
+        :raise IndexError: if index is not in the valid range.
+        """
+        import numpy as np
+
+        if not 0 <= index < self.placement_count:
+            raise IndexError("Placement index {} not in [0, {})".format(index, self.placement_count))
+
+        profile_index = 0
+        fleet_index = self._full_fleet_index
+        row_masks = []
+        for row in range(self.height):
+            first, last = self._transition_offsets[row][profile_index:profile_index + 2]
+            remaining_fleet_indices = self._remaining_fleet_rows[
+                self._transition_consumed_indices[row][first:last], fleet_index]
+            targets = self._transition_targets[row][first:last]
+            cumulative_counts = np.cumsum(self._completion_counts[row + 1][targets, remaining_fleet_indices])
+            selected = int(np.searchsorted(cumulative_counts, index, side="right"))
+            if selected > 0:
+                index -= int(cumulative_counts[selected - 1])
+            row_masks.append(self._transition_row_masks[row][first + selected])
+            profile_index = int(targets[selected])
+            fleet_index = int(remaining_fleet_indices[selected])
+
+        return self._row_masks_to_row_col_lists(row_masks)
+
+    def _get_row_transitions(self, profile, is_edge_row, is_below_edge_row):
+        """Get all the ways of filling a row, given the profile of the previous one.
+
+        Profiles are tuples with one entry per column: 0 for an empty square, -1 for a square
+        occupied by a boat that does not continue downwards, and the length so far of
+        the vertical boat (1 for new boats) occupying the square otherwise. While building a row,
+        -length is used for the last square of a horizontal boat.
+
+        :param profile: profile of the previous row (all zeros for the first row)
+        :param is_edge_row: is this the first or the last row?
+        :param is_below_edge_row: is this the second row?
+        :return: a list of (target_profile, consumed_counts, row_mask) tuples, where consumed_counts
+          are the numbers of boats of each length finished in this row, and bit c of row_mask is set
+          if and only if square c of this row is occupied.
+        """
+        transitions = []
+        width = self.width
+        max_length = self.max_length
+
+        # Stack of (col, row_profile, is_above_left_occupied, finished_lengths, row_mask)
+        pending = [(0, (), False, (), 0)]
+        while pending:
+            col, row_profile, is_above_left_occupied, finished_lengths, row_mask = pending.pop()
+            if col == width:
+                if row_profile[-1] < -1:
+                    finished_lengths += (-row_profile[-1],)
+                    row_profile = row_profile[:-1] + (-1,)
+                transitions.append((row_profile, self._get_consumed_counts(finished_lengths), row_mask))
+                continue
+
+            above = profile[col]
+            left = row_profile[-1] if col > 0 else 0
+            is_edge_col = col == 0 or col == width - 1
+
+            # Empty square: boats above and to the left are finished
+            if not (above == 1 and (is_edge_col or is_below_edge_row)):
+                empty_finished_lengths = finished_lengths
+                empty_row_profile = row_profile
+                if above > 0:
+                    empty_finished_lengths += (above,)
+                if left < -1:
+                    empty_finished_lengths += (-left,)
+                    empty_row_profile = row_profile[:-1] + (-1,)
+                pending.append((col + 1, empty_row_profile + (0,), above != 0,
+                                empty_finished_lengths, row_mask))
+
+            # Occupied square: no diagonal neighbours allowed
+            if is_above_left_occupied or (col + 1 < width and profile[col + 1] != 0):
+                continue
+            if above != 0:
+                # Vertical boat continues
+                if above < 0 or left != 0 or above >= max_length or is_edge_col:
+                    continue
+                row_profile += (above + 1,)
+            elif left != 0:
+                # Horizontal boat continues
+                length = 2 if left == 1 else -left + 1
+                if is_edge_row or left == -1 or left >= 2 or length > max_length:
+                    continue
+                row_profile = row_profile[:-1] + (-1, -length)
+            else:
+                row_profile += (1,)
+            pending.append((col + 1, row_profile, above != 0, finished_lengths, row_mask | (1 << col)))
+
+        return transitions
+
+    def _get_consumed_counts(self, lengths):
+        """Get a tuple with the number of boats of each length in 1, ..., self.max_length.
+        """
+        consumed_counts = [0] * self.max_length
+        for length in lengths:
+            consumed_counts[length - 1] += 1
+        return tuple(consumed_counts)
+
+    def _get_consumed_index(self, consumed_counts, fleet_states):
+        """Get the index of consumed_counts in self._consumed_index_by_counts, adding it to
+        self._remaining_fleet_rows if not already there.
+        """
+        try:
+            return self._consumed_index_by_counts[consumed_counts]
+        except KeyError:
+            import numpy as np
+            remaining_states = fleet_states - np.array(consumed_counts)
+            remaining_fleet_row = np.full(self._fleet_state_count, self._fleet_state_count, dtype=np.int64)
+            is_possible = np.all(remaining_states >= 0, axis=1)
+            remaining_fleet_row[is_possible] = np.ravel_multi_index(
+                remaining_states[is_possible].T, self._fleet_shape)
+            self._consumed_index_by_counts[consumed_counts] = len(self._remaining_fleet_rows)
+            self._remaining_fleet_rows.append(remaining_fleet_row)
+            return self._consumed_index_by_counts[consumed_counts]
+
+    def _row_masks_to_row_col_lists(self, row_masks):
+        """Get the list of boats, each a list of (row, col) coordinates, from the occupied square masks of each row.
+        """
+        return get_placement_from_row_cols((row + 1, col + 1)
+                                           for row, row_mask in enumerate(row_masks)
+                                           for col in range(self.width)
+                                           if row_mask & (1 << col))
+
+
+class PlacementPool:
+    """Thread-safe pool of pre-generated random valid placements.
+
+    A background daemon thread keeps the pool full, so that `get_placement` usually returns immediately.
+    The thread pauses `refill_pause_seconds` after each placement to yield the CPU to other threads.
+    If the pool is empty (e.g., during a burst of requests), placements are generated in the calling thread.
+    """
+
+    def __init__(self, max_size=256, placer_class=None, refill_pause_seconds=0.001, width=None, height=None):
+        """Initialize and start refilling the pool.
+        :param max_size: maximum number of placements kept in the pool.
+        :param placer_class: class used to generate placements. If None, `BitmaskBoatPlacer` is used.
+        :param refill_pause_seconds: time to wait after generating each placement in the background.
+        :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+        """
+        placer_class = placer_class if placer_class is not None else BitmaskBoatPlacer
+        self.refill_pause_seconds = refill_pause_seconds
+        self._placements = queue.Queue(maxsize=max_size)
+        # Placers keep state between calls, so each thread uses its own one
+        self._refill_boat_placer = placer_class(width=width, height=height)
+        self._inline_boat_placer = placer_class(width=width, height=height)
+        self._inline_lock = threading.Lock()
+
+        t = threading.Thread(target=self._refill_forever)
+        t.daemon = True
+        t.start()
+
+    def get_placement(self):
+        """Get a random valid placement, removing it from the pool.
+
+        :return: a list of boats, each boat being a list of (row,col) coordinates.
+          This is the format specified by `game.Battl3ship.set_boats`.
+        """
+        try:
+            return self._placements.get_nowait()
+        except queue.Empty:
+            with self._inline_lock:
+                return self._inline_boat_placer.get_random_placement()
+
+    def __len__(self):
+        """Approximate number of placements currently in the pool.
+        """
+        return self._placements.qsize()
+
+    def _refill_forever(self):
+        """Add placements to the pool, blocking while it is full.
+        """
+        while True:
+            self._placements.put(self._refill_boat_placer.get_random_placement())
+            time.sleep(self.refill_pause_seconds)
+
+
+def generate_placements(placement_count=None, seed=None, placer_class=None, process_count=None,
+                        batch_size=256, max_pending_batch_count=None, width=None, height=None,
+                        first_batch_index=0):
+    """Generate random valid placements in a pool of processes, yielding them as they become available.
+
+    Placements are produced in batches of `batch_size`. The i-th batch is generated by a placer
+    seeded with the i-th seed drawn from a generator seeded with `seed`, and batches are yielded
+    in order. Therefore, the sequence of placements depends only on `seed`, `placer_class`,
+    `batch_size` and the board dimensions (not on `process_count` nor on process scheduling).
+    At most `max_pending_batch_count` batches are requested before being yielded, which bounds
+    the memory used regardless of how fast placements are consumed.
+
+    :param placement_count: number of placements to generate. If None, placements
+      are generated indefinitely.
+    :param seed: master seed of the run. If None, a random one is used
+      (the run is then not reproducible).
+    :param placer_class: class used to generate placements, e.g., `BitmaskBoatPlacer`
+      (the default) or `UniformBoatPlacer`. One instance is created in each process.
+    :param process_count: number of worker processes. If None, os.cpu_count() is used.
+      If 0, placements are generated in the calling process.
+    :param batch_size: number of placements generated with each derived seed.
+    :param max_pending_batch_count: maximum number of batches being generated or waiting to be yielded.
+      If None, twice the number of processes is used.
+    :param width, height: board dimensions. If none, the defaults defined in game.Battl3ship are used.
+    :param first_batch_index: number of batches of the run to skip. Used to resume an interrupted run:
+      the output is the same as that of the complete run after its first first_batch_index batches.
+
+    :return: a generator of placements, each a list of boats, each boat being a list of
+      (row,col) coordinates. This is the format specified by `game.Battl3ship.set_boats`.
+    """
+    placer_class = placer_class if placer_class is not None else BitmaskBoatPlacer
+    process_count = process_count if process_count is not None else os.cpu_count()
+    max_pending_batch_count = max_pending_batch_count if max_pending_batch_count is not None \
+        else 2 * max(process_count, 1)
+    seed_generator = random.Random(seed)
+
+    for _ in range(first_batch_index):
+        seed_generator.getrandbits(64)
+
+    def batch_sizes():
+        remaining_count = placement_count
+        while remaining_count is None or remaining_count > 0:
+            current_batch_size = batch_size if remaining_count is None else min(batch_size, remaining_count)
+            yield seed_generator.getrandbits(64), current_batch_size
+            if remaining_count is not None:
+                remaining_count -= current_batch_size
+
+    if process_count == 0:
+        boat_placer = placer_class(width=width, height=height)
+        for batch_seed, current_batch_size in batch_sizes():
+            yield from _get_placement_batch(seed=batch_seed, batch_size=current_batch_size,
+                                            boat_placer=boat_placer)
+        return
+
+    with multiprocessing.Pool(processes=process_count, initializer=_init_placement_worker,
+                              initargs=(placer_class, width, height)) as pool:
+        pending_results = collections.deque()
+        for batch_seed, current_batch_size in batch_sizes():
+            if len(pending_results) >= max_pending_batch_count:
+                yield from pending_results.popleft().get()
+            pending_results.append(pool.apply_async(
+                _get_placement_batch, kwds=dict(seed=batch_seed, batch_size=current_batch_size)))
+        while pending_results:
+            yield from pending_results.popleft().get()
+
+
+# Placer used by the current process in `generate_placements`
+_worker_boat_placer = None
+
+
+def _init_placement_worker(placer_class, width, height):
+    """Create the placer used by this process in `generate_placements`.
+    """
+    global _worker_boat_placer
+    _worker_boat_placer = placer_class(width=width, height=height)
+
+
+def _get_placement_batch(seed, batch_size, boat_placer=None):
+    """Get a list of batch_size placements produced by boat_placer after seeding it with seed.
+    :param boat_placer: if None, the placer created by `_init_placement_worker` in this process is used.
+    """
+    boat_placer = boat_placer if boat_placer is not None else _worker_boat_placer
+    boat_placer.random_generator.seed(seed)
+    if getattr(boat_placer, "pending_placements", None):
+        # Images left by the previous batch (symmetric mode) would make this batch depend on it
+        boat_placer.pending_placements = []
+    return [boat_placer.get_random_placement() for _ in range(batch_size)]
+
+
 def test_random_generation():
     from matplotlib import pyplot as plt
     import numpy as np
@@ -277,5 +976,61 @@ def test_random_generation():
     plt.imshow(boat_placement_count)
     plt.savefig("distribution.png")
 
+def benchmark_layout_validation(placement_count=500, repetitions=5):
+    """Measure the time needed by `Battl3ship.is_valid_boat_layout` for complete valid placements,
+    partial placements (as checked by `RandomBoatPlacer`) and invalid placements.
+    """
+    import numpy as np
+
+    boat_placer = RandomBoatPlacer()
+    dummy_game = boat_placer.dummy_game
+    valid_placements = [boat_placer.get_random_placement() for _ in range(placement_count)]
+    partial_placements = [placement[:len(placement) // 2] for placement in valid_placements]
+    invalid_placements = [[[(r + 1, c) for r, c in placement[0]]] + placement[1:]
+                          for placement in valid_placements]
+
+    for label, placements, ignore_boat_count in [("valid", valid_placements, False),
+                                                 ("partial", partial_placements, True),
+                                                 ("invalid", invalid_placements, False)]:
+        best_time = None
+        for _ in range(repetitions):
+            time_before = time.perf_counter()
+            for placement in placements:
+                dummy_game.is_valid_boat_layout(row_col_lists=placement, ignore_boat_count=ignore_boat_count)
+            total_time = time.perf_counter() - time_before
+            best_time = total_time if best_time is None else min(best_time, total_time)
+        print("[watch] {} layouts: time/validation = {:.2f} us".format(
+            label, 1e6 * best_time / len(placements)))
+
+        time_before = time.perf_counter()
+        dummy_game.check_boat_layouts(layouts=placements, ignore_boat_count=ignore_boat_count)
+        print("[watch] {} layouts: time/validation (batch) = {:.2f} us".format(
+            label, 1e6 * (time.perf_counter() - time_before) / len(placements)))
+
+    boat_ids, _, _ = dummy_game._row_col_lists_to_boat_id_array(valid_placements)
+    time_before = time.perf_counter()
+    dummy_game.check_boat_layouts(layouts=boat_ids)
+    print("[watch] valid layouts: time/validation (batch, boat id array) = {:.2f} us".format(
+        1e6 * (time.perf_counter() - time_before) / len(valid_placements)))
+
+
+def benchmark_placement_generation(placement_count=200):
+    """Measure the time needed to produce random placements with each placer.
+    """
+    for boat_placer, count in [(RandomBoatPlacer(), placement_count),
+                               (BitmaskBoatPlacer(), 100 * placement_count),
+                               (UniformBoatPlacer(), 10 * placement_count)]:
+        time_before = time.perf_counter()
+        for _ in range(count):
+            boat_placer.get_random_placement()
+        total_time = time.perf_counter() - time_before
+        print("[watch] {}: time/placement = {:.2f} us ({:.0f} placements/s)".format(
+            boat_placer.__class__.__name__, 1e6 * total_time / count, count / total_time))
+
+
 if __name__ == '__main__':
-    test_random_generation()
\ No newline at end of file
+    if len(sys.argv) == 2 and sys.argv[1] == "benchmark":
+        benchmark_layout_validation()
+        benchmark_placement_generation()
+    else:
+        test_random_generation()
\ No newline at end of file
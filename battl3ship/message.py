@@ -22,8 +22,10 @@ Only information contained in data_dict is passed when a message is sent.
 __author__ = "Miguel Hernández Cabronero <mhernandez314@gmail.com>"
 
 import sys
-import inspect
 import json
+import struct
+import time
+import types
 
 from player import Player
 
@@ -40,38 +42,177 @@ class MessageException(Exception):
     pass
 
 
+def _pack_binary_int(value):
+    if type(value) is not int:
+        raise TypeError(f"Expected int, got {value!r}")
+    return struct.pack("<i", value)
+
+
+def _unpack_binary_int(payload, offset):
+    return struct.unpack_from("<i", payload, offset)[0], offset + 4
+
+
+def _pack_binary_bool(value):
+    if type(value) is not bool:
+        raise TypeError(f"Expected bool, got {value!r}")
+    return struct.pack("<?", value)
+
+
+def _unpack_binary_bool(payload, offset):
+    return struct.unpack_from("<?", payload, offset)[0], offset + 1
+
+
+def _pack_binary_str(value):
+    if not isinstance(value, str):
+        raise TypeError(f"Expected str, got {value!r}")
+    value_bytes = value.encode("utf8")
+    return struct.pack("<H", len(value_bytes)) + value_bytes
+
+
+def _unpack_binary_str(payload, offset):
+    length = struct.unpack_from("<H", payload, offset)[0]
+    offset += 2
+    if offset + length > len(payload):
+        raise ValueError("Truncated string")
+    return bytes(payload[offset:offset + length]).decode("utf8"), offset + length
+
+
+def _pack_binary_uint8_list(value):
+    return bytes([len(value)]) + bytes(value)
+
+
+def _unpack_binary_uint8_list(payload, offset):
+    count = payload[offset]
+    offset += 1
+    if offset + count > len(payload):
+        raise ValueError("Truncated list")
+    return list(payload[offset:offset + count]), offset + count
+
+
+def _pack_binary_uint8_pairs(value):
+    if any(len(pair) != 2 for pair in value):
+        raise ValueError(f"Expected a list of pairs, got {value!r}")
+    return bytes([len(value)]) + bytes(x for pair in value for x in pair)
+
+
+def _unpack_binary_uint8_pairs(payload, offset):
+    count = payload[offset]
+    offset += 1
+    if offset + 2 * count > len(payload):
+        raise ValueError("Truncated list of pairs")
+    return [[payload[offset + 2 * i], payload[offset + 2 * i + 1]] for i in range(count)], offset + 2 * count
+
+
+# Field kinds that can be used in Message.binary_fields -> (pack function, unpack function)
+# pack(value) returns bytes or raises TypeError/ValueError/struct.error if value cannot be represented,
+# unpack(payload, offset) returns value, next_offset
+binary_codec_by_field_kind = {
+    "int": (_pack_binary_int, _unpack_binary_int),
+    "bool": (_pack_binary_bool, _unpack_binary_bool),
+    "str": (_pack_binary_str, _unpack_binary_str),
+    "uint8_list": (_pack_binary_uint8_list, _unpack_binary_uint8_list),
+    "uint8_pairs": (_pack_binary_uint8_pairs, _unpack_binary_uint8_pairs),
+}
+
+
+def _copy_lists(value):
+    """Return a copy of value in which all (possibly nested) lists are copied.
+    """
+    if isinstance(value, list):
+        return [_copy_lists(element) for element in value]
+    return value
+
+
 class Message:
     """
     Base class that represents a message to be passed to the server or to a player.
     Message types allowed by the game protocol are represented by subclassing of Message.
 
     The `encode()` method provides a string representation of the message, including
-    any data present in `self.data_dict`.
+    any data present in `self.data_dict`. Encodings are computed lazily and cached until
+    a public field of the message is set again, or the id of player_from or player_to changes.
+    Lists assigned to public fields are copied, so that later changes to the caller's lists do not
+    affect the message. Lists of the message itself must not be modified in place unless
+    `invalidate_encoding()` is invoked afterwards.
 
     The static `parse_data()` method creates an instance of Message (of the appropriate
-    subclass) given a string as produced by `encode()`.
+    subclass) given a string as produced by `encode()`. Subclasses are automatically
+    registered in `Message.class_by_type` when they are defined.
+
+    Frequent message types also support a compact binary format (see `encode_binary()`
+    and `parse_binary()`) by defining `binary_type` and `binary_fields`.
     """
+    # type name -> Message subclass, filled in when each subclass is defined
+    class_by_type = dict()
+    # binary_type -> Message subclass, for subclasses that support the binary format
+    class_by_binary_type = dict()
+
+    # Unique type code (>= 0x80) of the binary format for this class, or None if not supported
+    binary_type = None
+    # Tuple of (field_name, field_kind) pairs, with field_kind in binary_codec_by_field_kind.
+    # Field names must be accepted as keyword arguments by the class' __init__.
+    binary_fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Message.class_by_type[cls.__name__] = cls
+        if cls.binary_type is not None and "binary_type" in cls.__dict__:
+            assert 0x80 <= cls.binary_type <= 0xFF, cls.binary_type
+            assert cls.binary_type not in Message.class_by_binary_type, cls.binary_type
+            assert len(cls.binary_fields) <= 8, cls.binary_fields
+            Message.class_by_binary_type[cls.binary_type] = cls
 
     def __init__(self, player_from=None, player_to=None, extra_info_str=None, data_dict=None):
         self.player_from = player_from
         self.player_to = player_to
         self.data = data_dict
-        self.type = type
+        self.type = self.__class__.__name__
         self.extra_info_str = extra_info_str
-        self.data_dict = data_dict
 
-        if self.data_dict is not None:
-            # Filter _* just in case
-            for k, v in self.data_dict.items():
-                if k[0] != "_":
+        if data_dict is not None:
+            # Filter _* just in case, as well as read-only properties (e.g., data_dict) and methods,
+            # which cannot or must not be overwritten by received data. Properties with a setter
+            # (e.g., name_id_list) are part of the message's data
+            for k, v in data_dict.items():
+                class_attribute = getattr(type(self), k, None)
+                if k[0] != "_" and k not in Message._reserved_keys \
+                        and not isinstance(class_attribute, types.FunctionType) \
+                        and not (isinstance(class_attribute, property) and class_attribute.fset is None):
                     self.__setattr__(k, v)
-        else:
-            self.data_dict = {}
-        self.encode()
+
+    # Keys added to data_dict by Message itself, which are not restored as attributes when parsing
+    _reserved_keys = {"type", "from_id", "to_id"}
+
+    def __setattr__(self, name, value):
+        if name[0] != "_":
+            # Any change to a public field invalidates the cached encoding
+            self.__dict__["_encoding_cache"] = None
+            if isinstance(value, list):
+                value = _copy_lists(value)
+        object.__setattr__(self, name, value)
+
+    def invalidate_encoding(self):
+        """Discard the cached encodings. It must be invoked after modifying any field of the message in place.
+        """
+        self.__dict__["_encoding_cache"] = None
 
     def __eq__(self, other):
         return self.data == other.data
 
+    def get_data_dict(self):
+        """Return a dict with the subclass-specific fields to be sent with the message.
+
+        Subclasses that wish to include additional data must override this method.
+        """
+        return {}
+
+    @property
+    def data_dict(self):
+        """Dict with all data sent with this message (see `encode()`). It is built lazily and cached
+        as described in `Message`, so it must not be modified in place.
+        """
+        return self._get_encoding_cache()[0]
+
     def encode(self):
         """Return a string with this instance's class and self.data_dict.
 
@@ -79,33 +220,72 @@ class Message:
           * from_id : the id of the player sending the message
           * to_id : the id of the destinatary player
           * type : the name of the class
-        In addition, it includes any key=value pairs available in `self.data_dict`.
+        In addition, it includes any key=value pairs returned by `get_data_dict()`.
 
-        Subclasses that wish to include additional data must set any desired data
-        in `self.data_dict` and then call `Message.encode()`.
+        The result is cached as described in `Message`: fields modified in place
+        require `invalidate_encoding()` to be invoked.
         """
-        self.data_dict["type"] = self.__class__.__name__
-        self.data_dict["extra_info_str"] = self.extra_info_str
-        if self.player_from is None:
-            self.data_dict["from_id"] = None
-        else:
-            self.data_dict["from_id"] = self.player_from.id
-        if self.player_to is None:
-            self.data_dict["to_id"] = None
-        else:
-            self.data_dict["to_id"] = self.player_to.id
-
-        if self.data_dict is not None:
-            # Filter _* just in case
-            for k, v in self.data_dict.items():
-                if k[0] != "_":
-                    self.__setattr__(k, v)
-        for k, v in self.data_dict.items():
-            self.data_dict[k] = v
+        encoding_cache = self._get_encoding_cache()
+        if encoding_cache[1] is None:
+            encoding_cache[1] = json.dumps(encoding_cache[0])
+        return encoding_cache[1]
 
-        encoded_text = json.dumps(self.data_dict)
-
-        return encoded_text
+    def encode_bytes(self):
+        """Return the utf8 bytes of `encode()`, cached in the same way.
+        """
+        encoding_cache = self._get_encoding_cache()
+        if encoding_cache[2] is None:
+            encoding_cache[2] = self.encode().encode("utf8")
+        return encoding_cache[2]
+
+    def encode_binary(self):
+        """Return the compact binary encoding of this message, or None if it cannot be represented
+        in binary format (its class does not support it, extra_info_str is set or some field
+        cannot be packed). The result is cached as in `encode()`.
+
+        The encoding consists of one byte with a bit set for each field in `binary_fields` that is None,
+        followed by the packed values of the remaining fields. The type is not included (see `binary_type`),
+        nor are from_id and to_id, which are implied by the connection the message is sent through.
+        """
+        encoding_cache = self._get_encoding_cache()
+        if encoding_cache[3] is None:
+            encoding_cache[3] = self._pack_binary_fields() or False
+        return encoding_cache[3] or None
+
+    def _pack_binary_fields(self):
+        if self.binary_type is None or self.extra_info_str is not None:
+            return None
+        null_flags = 0
+        field_bytes = []
+        try:
+            for index, (field_name, field_kind) in enumerate(self.binary_fields):
+                value = getattr(self, field_name)
+                if value is None:
+                    null_flags |= 1 << index
+                else:
+                    field_bytes.append(binary_codec_by_field_kind[field_kind][0](value))
+        except (TypeError, ValueError, struct.error):
+            return None
+        return bytes([null_flags]) + b"".join(field_bytes)
+
+    def _get_encoding_cache(self):
+        """Return the [data_dict, encoded_text, encoded_bytes, encoded_binary] list of cached encodings
+        of this message, building data_dict if necessary. The other elements are None
+        until encode(), encode_bytes() or encode_binary() are invoked.
+        """
+        encoding_cache = self.__dict__.get("_encoding_cache")
+        from_id = self.player_from.id if self.player_from is not None else None
+        to_id = self.player_to.id if self.player_to is not None else None
+        # Players' ids can change after the message is created (e.g., when the client logs in)
+        if encoding_cache is None or encoding_cache[0]["from_id"] != from_id or encoding_cache[0]["to_id"] != to_id:
+            data_dict = self.get_data_dict()
+            data_dict["type"] = self.__class__.__name__
+            data_dict["extra_info_str"] = self.extra_info_str
+            data_dict["from_id"] = from_id
+            data_dict["to_id"] = to_id
+            encoding_cache = [data_dict, None, None, None]
+            self.__dict__["_encoding_cache"] = encoding_cache
+        return encoding_cache
 
     @staticmethod
     def parse_data(data, player_from=None, player_to=None):
@@ -116,36 +296,49 @@ class Message:
         try:
             # Load json data
             data_dict = json.loads(data)
-
-            # Create an instance of the correct class
-            message = None
-            name = None
-            for name, possible_class_member in inspect.getmembers(sys.modules[__name__]):
-                if name == data_dict["type"] and inspect.isclass(possible_class_member) \
-                        and name.startswith("Message") \
-                        and "." not in name:
-
-                    message = possible_class_member(
-                        data_dict=data_dict,
-                        player_from=player_from,
-                        player_to=player_to)
-                    if not isinstance(message, Message):
-                        message = None
-                    message.encode()
-            if message is None:
-                raise MessageException("[parse_data] Error! Unrecognized message type {}".format(name))
-
-            return message
+            message_class = Message.class_by_type[data_dict["type"]]
         except KeyError as ex:
+            raise MessageException("[parse_data] Error! Unrecognized message type {}".format(ex))
+        except (TypeError, ValueError) as ex:
             raise MessageException(ex)
 
-    def __str__(self):
-        self.encode()
+        # Create an instance of the correct class
+        return message_class(data_dict=data_dict, player_from=player_from, player_to=player_to)
+
+    @staticmethod
+    def parse_binary(binary_type, payload, player_from=None, player_to=None):
+        """Parse a message encoded with `encode_binary()` and return an instance of the correct class.
+
+        :param binary_type: `binary_type` of the encoded message's class
+        :param payload: bytes-like object returned by `encode_binary()`
+
+        Raises MessageException if data is not valid
+        """
+        try:
+            message_class = Message.class_by_binary_type[binary_type]
+        except KeyError:
+            raise MessageException("[parse_binary] Error! Unrecognized binary message type {}".format(binary_type))
+
+        try:
+            null_flags = payload[0]
+            offset = 1
+            fields = dict()
+            for index, (field_name, field_kind) in enumerate(message_class.binary_fields):
+                if null_flags & (1 << index):
+                    fields[field_name] = None
+                else:
+                    fields[field_name], offset = binary_codec_by_field_kind[field_kind][1](payload, offset)
+            if offset != len(payload):
+                raise ValueError("Unexpected trailing data")
+        except (IndexError, ValueError, struct.error) as ex:
+            raise MessageException("[parse_binary] Error! Invalid {} data: {}".format(message_class.__name__, ex))
+
+        return message_class(player_from=player_from, player_to=player_to, **fields)
 
+    def __str__(self):
         string = "[{}".format(self.__class__.__name__)
-        if self.data_dict is not None:
-            for k, v in self.data_dict.items():
-                string += "\n\t{} = {}".format(k, v)
+        for k, v in self.data_dict.items():
+            string += "\n\t{} = {}".format(k, v)
         string += "]"
         return string
 
@@ -155,24 +348,27 @@ class Message:
 
 class MessageHello(Message):
     """
-    p2s (name, pass): Request connection and choose name. Must be the first message sent.
+    p2s (name, pass, binary_protocol): Request connection and choose name. Must be the first message sent.
+        binary_protocol is True if the player can send and receive messages in binary format.
 
-    s2p (name, id): A new player has connected
+    s2p (name, id, binary_protocol): A new player has connected.
+        binary_protocol is True if the server accepts the binary format for players that requested it.
     """
 
-    def __init__(self, id=None, name=None, password=None, *args, **kwargs):
+    def __init__(self, id=None, name=None, password=None, binary_protocol=False, *args, **kwargs):
         self.id = id
         self.name = name
         self.password = password
+        self.binary_protocol = binary_protocol
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "name": str(self.name),
             "password": self.password,
             "id": self.id,
+            "binary_protocol": self.binary_protocol,
         }
-        return Message.encode(self)
 
 
 class MessageBye(Message):
@@ -186,19 +382,13 @@ class MessageBye(Message):
         self.id = id
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "id": self.id,
         }
-        return Message.encode(self)
 
     def __str__(self):
-        if self.data_dict is None:
-            return Message.__str__(self)
-        else:
-            return "[MessageBye:{} ({})]".format(
-                self.data_dict["id"],
-                self.data_dict["extra_info_str"])
+        return "[MessageBye:{} ({})]".format(self.id, self.extra_info_str)
 
 
 class MessagePlayerList(Message):
@@ -220,11 +410,10 @@ class MessagePlayerList(Message):
     def name_id_list(self, name_id_list):
         self.player_list = [Player(id=id, name=name) for name, id in name_id_list]
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "name_id_list": self.name_id_list,
         }
-        return Message.encode(self)
 
 
 class MessageChat(Message):
@@ -233,6 +422,8 @@ class MessageChat(Message):
         - broadcast if destination_id is None
         - private message otherwise
     """
+    binary_type = 0x83
+    binary_fields = (("text", "str"), ("recipient_id", "int"), ("origin_id", "int"))
 
     def __init__(self, text=None, recipient_id=None, origin_id=None, *args, **kwargs):
         self.text = text
@@ -240,13 +431,12 @@ class MessageChat(Message):
         self.origin_id = origin_id
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "text": self.text,
             "origin_id": self.origin_id,
             "recipient_id": self.recipient_id,
         }
-        return Message.encode(self)
 
 
 class MessageChallenge(Message):
@@ -257,6 +447,8 @@ class MessageChallenge(Message):
         text [=None]  # optional text sent by the challenger
         ):
     """
+    binary_type = 0x84
+    binary_fields = (("challenge_id", "str"), ("origin_id", "int"), ("recipient_id", "int"), ("text", "str"))
 
     def __init__(self, challenge_id=None, origin_id=None, recipient_id=None, text=None, *args, **kwargs):
         self.challenge_id = challenge_id
@@ -268,14 +460,13 @@ class MessageChallenge(Message):
     def __eq__(self, other):
         return self.origin_id == other.origin_id
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "text": self.text,
             "challenge_id": self.challenge_id,
             "origin_id": self.origin_id,
             "recipient_id": self.recipient_id,
         }
-        return Message.encode(self)
 
 
 class MessageCancelChallenge(Message):
@@ -287,11 +478,10 @@ class MessageCancelChallenge(Message):
         self.origin_id = origin_id
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "origin_id": self.origin_id
         }
-        return Message.encode(self)
 
 
 class MessageAcceptChallenge(Message):
@@ -304,12 +494,11 @@ class MessageAcceptChallenge(Message):
         self.recipient_id = recipient_id
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "origin_id": self.origin_id,
             "recipient_id": self.recipient_id,
         }
-        return Message.encode(self)
 
 
 class MessageStartGame(Message):
@@ -323,13 +512,12 @@ class MessageStartGame(Message):
         self.starting_id = starting_id
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "player_a_id": self.player_a_id,
             "player_b_id": self.player_b_id,
             "starting_id": self.starting_id,
         }
-        return Message.encode(self)
 
 
 class MessageProposeBoardPlacement(Message):
@@ -341,11 +529,37 @@ class MessageProposeBoardPlacement(Message):
         self.boat_row_col_lists = boat_row_col_lists
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
+            "boat_row_col_lists": self.boat_row_col_lists
+        }
+
+
+class MessageRequestPlacementSuggestion(Message):
+    """
+    p2s() # Ask the server for a random valid board placement - awaits for MessagePlacementSuggestion
+    """
+
+    def __init__(self, *args, **kwargs):
+        Message.__init__(self, *args, **kwargs)
+
+    def get_data_dict(self):
+        return {}
+
+
+class MessagePlacementSuggestion(Message):
+    """
+    s2p([boat1_row_col_list, ..., boatN_row_col_list) # A random valid board placement, one list of coordinates per boat
+    """
+
+    def __init__(self, boat_row_col_lists=None, *args, **kwargs):
+        self.boat_row_col_lists = boat_row_col_lists
+        Message.__init__(self, *args, **kwargs)
+
+    def get_data_dict(self):
+        return {
             "boat_row_col_lists": self.boat_row_col_lists
         }
-        return Message.encode(self)
 
 
 class MessageShot(Message):
@@ -354,22 +568,26 @@ class MessageShot(Message):
     s2p: player receives this shot - turn changes. First shot has row_col_list=None to indicate player to start firing.
          player is responsible for detecting when this shot finishes the game
     """
+    binary_type = 0x81
+    binary_fields = (("row_col_lists", "uint8_pairs"),)
 
     def __init__(self, row_col_lists=None, *args, **kwargs):
         self.row_col_lists = row_col_lists
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "row_col_lists": self.row_col_lists
         }
-        return Message.encode(self)
 
 
 class MessageShotResult(Message):
     """
     s2p: result of the last shot (accepted) - next turn.
     """
+    binary_type = 0x82
+    binary_fields = (("hit_length_list", "uint8_list"), ("sunk_length_list", "uint8_list"),
+                     ("game_finished", "bool"))
 
     def __init__(self, hit_length_list=None, sunk_length_list=None, game_finished=False, *args, **kwargs):
         """result_list = ['(h|s)\(d+)'|...] -> hit|sink boat_length
@@ -385,10 +603,65 @@ class MessageShotResult(Message):
         self.game_finished = game_finished
         Message.__init__(self, *args, **kwargs)
 
-    def encode(self):
-        self.data_dict = {
+    def get_data_dict(self):
+        return {
             "hit_length_list": self.hit_length_list,
             "sunk_length_list": self.sunk_length_list,
             "game_finished": self.game_finished,
         }
-        return Message.encode(self)
+
+
+Message.class_by_type[Message.__name__] = Message
+
+
+def benchmark_parse_data(message_count=20000):
+    """Measure the time needed by `Message.parse_data` to decode messages of several types,
+    compared to the time needed only to load their json data.
+    """
+    player = Player(id=1, name="Player1", unique_id=False)
+    for message in [MessageHello(id=1, name="Player1", password="password"),
+                    MessageChat(text="Hello world!", origin_id=1, recipient_id=None),
+                    MessageShot(row_col_lists=[(1, 2), (3, 4), (5, 6)]),
+                    MessageShotResult(hit_length_list=[2], sunk_length_list=[1], game_finished=False)]:
+        data = message.encode()
+
+        time_before = time.perf_counter()
+        for _ in range(message_count):
+            json.loads(data)
+        json_time = time.perf_counter() - time_before
+
+        time_before = time.perf_counter()
+        for _ in range(message_count):
+            Message.parse_data(data, player_from=player)
+        parse_time = time.perf_counter() - time_before
+
+        print("[watch] {}: time/message = {:.2f} us (json.loads only: {:.2f} us)".format(
+            message.__class__.__name__, 1e6 * parse_time / message_count, 1e6 * json_time / message_count))
+
+
+def test_syntax():
+    player = Player(id=1, name="Player1", unique_id=False)
+    message = MessageShot(row_col_lists=[[1, 2], [3, 4], [5, 6]], player_from=player)
+    parsed_message = Message.parse_data(message.encode(), player_from=player)
+    assert isinstance(parsed_message, MessageShot)
+    assert parsed_message.data_dict == message.data_dict
+
+    # Properties with a setter are restored from received data
+    message_list = MessagePlayerList(player_list=[player, Player(id=2, name="Player2", unique_id=False)])
+    parsed_message = Message.parse_data(message_list.encode(), player_from=player)
+    assert parsed_message.name_id_list == message_list.name_id_list
+
+    # Received keys that collide with read-only properties or methods are ignored
+    parsed_message = Message.parse_data(json.dumps(dict(
+        message.data_dict, data_dict={"type": "MessageBye"}, encode="Not a method")), player_from=player)
+    assert parsed_message.data_dict == message.data_dict
+    assert parsed_message.encode() == message.encode()
+
+    print("[message.py] Tests ok!")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == "benchmark":
+        benchmark_parse_data()
+    if len(sys.argv) == 2 and sys.argv[1] == "test_syntax":
+        test_syntax()
@@ -39,6 +39,8 @@ class Player:
         self.port = port
         self.server = server
         self.name = str(name)
+        # Whether this player agreed to receive messages in binary format (see MessageHello)
+        self.binary_protocol = False
         if id is None and unique_id:
             with Player._lock:
                 self.id = Player.next_id
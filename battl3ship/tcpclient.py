@@ -24,16 +24,20 @@ import socket
 import random
 import threading
 import queue
+import asyncio
 
 from player import Player
 from message import *
-from tcpmessagestream import TCPMessageStream
+from tcpmessagestream import TCPMessageStream, AsyncTCPMessageStream
 import tcpserver
 
 ############################ Begin configurable part
 
 default_password = tcpserver.default_password
 
+# Request the binary message format to the server? It is used only if the server accepts it.
+use_binary_protocol = True
+
 # Be verbose?
 be_verbose = False
 be_superverbose = False and be_verbose
@@ -64,6 +68,8 @@ class GenericGameClient:
         self.open_challenges = []  # Challenges (messages) available to us
         self.my_challenge = None  # Challenge (message) currently posted by us
         self.current_game = None
+        self.suggested_placement = None  # Last placement received in a MessagePlacementSuggestion
+        self.binary_protocol = False  # Send messages in binary format? Set by connect()
 
         self.callback_incoming_message = callback_incoming_message
         self._message_stream = TCPMessageStream(
@@ -93,12 +99,14 @@ class GenericGameClient:
 
         self.tcp_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_connection.connect((self.server_ip, self.server_port))
+        TCPMessageStream.configure_connection(self.tcp_connection)
         self.player.tcp_connection = self.tcp_connection
 
         hello_message = MessageHello(
             player_from=self.player,
             name=self.player.name,
-            password=self.password)
+            password=self.password,
+            binary_protocol=use_binary_protocol)
 
         self._outgoing_messages.put(hello_message)
 
@@ -109,12 +117,13 @@ class GenericGameClient:
         if response_message.data_dict["type"] == MessageHello.__name__:
             self.player.id = response_message.data_dict["id"]
             self.player.name = response_message.data_dict["name"]
+            self.binary_protocol = use_binary_protocol and response_message.binary_protocol is True
         else:
             raise IOError("[tcpclient.connect] cannot connect to server: received {} instead of hello".format(
                 response_message))
 
         t = threading.Thread(target=self._receive_messages_forever,
-                             args=(self._incoming_messages, self.tcp_connection, self.server_player))
+                             args=(self._incoming_messages, self.tcp_connection, self.server_player, pending_data))
         t.daemon = True
         t.start()
 
@@ -155,7 +164,8 @@ class GenericGameClient:
             message = self._outgoing_messages.get()
             if be_superverbose:
                 print("[tcpclient._process_outgoing_messages]", "Output message:", message)
-            self._message_stream.send_message(message=message, tcp_connection=self.tcp_connection)
+            self._message_stream.send_message(message=message, tcp_connection=self.tcp_connection,
+                                              binary=self.binary_protocol)
 
 
 class Py3SinkClient(GenericGameClient):
@@ -251,6 +261,222 @@ class Py3SinkClient(GenericGameClient):
             if be_verbose:
                 print("[tcpclient.process_incoming_message] Ignoring SHOT results {}".format(message))
 
+        elif message.type == MessagePlacementSuggestion.__name__:
+            if be_verbose:
+                print("[tcpclient.process_incoming_message] Received placement suggestion {}".format(message))
+            with self._lock:
+                self.suggested_placement = message.boat_row_col_lists
+
         else:
             if be_verbose:
                 print("[tcpclient.process_incoming_message] IGNORING incoming message: {}".format(message))
+
+
+class AsyncGenericGameClient:
+    """
+    Variant of GenericGameClient for asyncio, which starts no threads: messages are sent with `await send()`,
+    and received by iterating asynchronously over the client, e.g.:
+
+        client = AsyncPy3SinkClient(server_ip, server_port, player_name, password)
+        await client.connect()
+        await client.send(MessageChat(text="Hi!"))
+        async for message in client:
+            ...
+
+    Received messages are passed to process_incoming_message before being returned,
+    so any number of clients can be driven by a single event loop.
+    """
+
+    def __init__(self, server_ip, server_port, player_name, password, callback_incoming_message=None):
+        """
+        :param callback_incoming_message: when a message.Message is received, this is called with that message as arg
+        """
+        self._lock = threading.RLock()
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.tcp_connection = None
+        self.password = password
+        # Don't need unique ids in the client
+        self.server_player = Player(tcp_connection=None, ip=server_ip, port=server_port, server=None,
+                                    name="TheServer", unique_id=False)
+        self.player = Player(tcp_connection=None, ip=server_ip, port=server_port, server=None, name=player_name,
+                             unique_id=False)
+        self.player_list = [self.player]
+        self.open_challenges = []  # Challenges (messages) available to us
+        self.my_challenge = None  # Challenge (message) currently posted by us
+        self.current_game = None
+        self.suggested_placement = None  # Last placement received in a MessagePlacementSuggestion
+        self.binary_protocol = False  # Send messages in binary format? Set by connect()
+
+        self.callback_incoming_message = callback_incoming_message
+        self._message_stream = AsyncTCPMessageStream(
+            bytes_message_length=tcpserver.BYTES_MESSAGE_FIELD,
+            max_message_length=tcpserver.MAX_MESSAGE_LENGTH,
+            buffer_size=tcpserver.BUFFER_SIZE,
+            name=f"Player:{player_name}")
+        self._reader = None
+        self._writer = None
+
+    def process_incoming_message(self, message):
+        raise Exception("[tcpclient.process_incoming_message] Error! Subclasses must implement this method")
+
+    async def send(self, message):
+        """Send a message to the server, waiting only if the connection cannot accept more data.
+        """
+        if be_superverbose:
+            print("[tcpclient.send]", "Output message:", message)
+        await self._message_stream.send_message(message=message, writer=self._writer, binary=self.binary_protocol)
+
+    async def connect(self):
+        """Connect to the server and log in.
+
+        Raise IOError if the login is refused.
+        """
+        if be_verbose:
+            print("[tcpclient.connect] Connecting to {}:{}".format(self.server_ip, self.server_port))
+
+        self._reader, self._writer = await asyncio.open_connection(self.server_ip, self.server_port)
+        self.tcp_connection = self._writer.get_extra_info("socket")
+        TCPMessageStream.configure_connection(self.tcp_connection)
+        self.player.tcp_connection = self.tcp_connection
+
+        hello_message = MessageHello(
+            player_from=self.player,
+            name=self.player.name,
+            password=self.password,
+            binary_protocol=use_binary_protocol)
+        await self._message_stream.send_message(message=hello_message, writer=self._writer)
+
+        response_message = await self._message_stream.read_message(self._reader, player_from=self.server_player)
+
+        if callable(self.callback_incoming_message):
+            self.callback_incoming_message(response_message)
+        if isinstance(response_message, MessageHello):
+            self.player.id = response_message.data_dict["id"]
+            self.player.name = response_message.data_dict["name"]
+            self.binary_protocol = use_binary_protocol and response_message.binary_protocol is True
+        else:
+            raise IOError("[tcpclient.connect] cannot connect to server: received {} instead of hello".format(
+                response_message))
+
+    async def receive_message(self):
+        """Wait for the next message from the server, process it and return it.
+
+        :return: the received message, or None if the connection has been closed
+        """
+        try:
+            message = await self._message_stream.read_message(self._reader, player_from=self.server_player)
+        except IOError:
+            return None
+        if message is None:
+            return None
+        if callable(self.callback_incoming_message):
+            self.callback_incoming_message(message)
+        self.process_incoming_message(message)
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive_message()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def disconnect(self):
+        if be_verbose:
+            print("[tcpclient.disconnect] Closing client ({})".format(self.player))
+        self._writer.close()
+
+
+class AsyncPy3SinkClient(AsyncGenericGameClient):
+    """
+    Minimal asyncio client of the Py3Sink game, which keeps track of the same information as Py3SinkClient.
+    """
+    process_incoming_message = Py3SinkClient.process_incoming_message
+
+
+def benchmark_async_clients(client_count=1000):
+    """Play client_count // 2 simultaneous games between AsyncPy3SinkClient instances driven by
+    a single event loop, against a server with the asyncio engine running in a separate process.
+    Report the time needed to connect all clients, the number of threads used, and the latency of the turns.
+    """
+    import multiprocessing
+    import generation
+
+    turn_latencies = []
+
+    async def wait_for(client, message_class):
+        async for message in client:
+            if isinstance(message, message_class):
+                return message
+        raise IOError("[benchmark_async_clients] Connection closed waiting for {}".format(message_class.__name__))
+
+    async def play(client, opponent, starts_challenge, placement, opponent_placement):
+        if starts_challenge:
+            await client.send(MessageChallenge(origin_id=client.player.id, recipient_id=opponent.player.id))
+        else:
+            await wait_for(client, MessageChallenge)
+            await client.send(MessageAcceptChallenge(origin_id=opponent.player.id, recipient_id=client.player.id))
+        await wait_for(client, MessageStartGame)
+
+        await client.send(MessageProposeBoardPlacement(boat_row_col_lists=placement))
+        boat_cells = set(tuple(row_col) for row_col_list in placement for row_col in row_col_list)
+        target_cells = tcpserver.get_target_cells(opponent_placement)
+        while True:
+            # The server asks for a shot by sending the opponent's last one (if any)
+            opponent_shot = await wait_for(client, MessageShot)
+            boat_cells.difference_update(tuple(row_col) for row_col in opponent_shot.row_col_lists or [])
+            if not boat_cells:
+                return
+            time_before = time.perf_counter()
+            await client.send(MessageShot(row_col_lists=[target_cells.pop()
+                                                         for _ in range(tcpserver.Battl3ship.shots_per_turn)]))
+            shot_result = await wait_for(client, MessageShotResult)
+            turn_latencies.append(time.perf_counter() - time_before)
+            if shot_result.game_finished:
+                return
+
+    async def run_clients(port):
+        clients = [AsyncPy3SinkClient(tcpserver.local_host_ip, port, "Bot{}".format(i), None)
+                   for i in range(client_count)]
+        time_before = time.perf_counter()
+        await asyncio.gather(*(client.connect() for client in clients))
+        print("[watch] {} clients connected in {:.2f} s, {} threads in this process".format(
+            client_count, time.perf_counter() - time_before, threading.active_count()))
+
+        placements = [generation.RandomBoatPlacer().get_random_placement() for _ in clients]
+        time_before = time.perf_counter()
+        await asyncio.gather(*(play(clients[i + j], clients[i + 1 - j], starts_challenge=(j == 0),
+                                    placement=placements[i + j], opponent_placement=placements[i + 1 - j])
+                               for i in range(0, client_count - 1, 2) for j in range(2)))
+        print("[watch] {} games played in {:.2f} s".format(client_count // 2, time.perf_counter() - time_before))
+        for client in clients:
+            client.disconnect()
+
+    with socket.socket() as s:
+        s.bind((tcpserver.local_host_ip, 0))
+        port = s.getsockname()[1]
+    server_process = multiprocessing.Process(target=tcpserver.serve_benchmark, args=(port, "asyncio", client_count))
+    server_process.start()
+    try:
+        while True:
+            try:
+                socket.create_connection((tcpserver.local_host_ip, port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        asyncio.run(run_clients(port))
+        turn_latencies.sort()
+        print("[watch] Turn latency: {}".format(", ".join(
+            "p{} = {:.2f} ms".format(p, 1e3 * turn_latencies[min(len(turn_latencies) - 1, len(turn_latencies) * p // 100)])
+            for p in [50, 90, 99, 100])))
+    finally:
+        server_process.kill()
+        server_process.join()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) in [2, 3] and sys.argv[1] == "benchmark":
+        benchmark_async_clients(**({"client_count": int(sys.argv[2])} if len(sys.argv) == 3 else {}))
@@ -18,13 +18,25 @@
 """
 __author__ = "Miguel Hernández Cabronero <mhernandez314@gmail.com>"
 
-import select
+import sys
+import time
+import asyncio
 import socket
+import struct
 from message import *
 
 ############################ Begin configurable part
 
-default_timeout_seconds = 3
+# Timeout in seconds for each read from a connection, after which the read is retried.
+# If None, connections are read in blocking mode, so that idle connections cause no wakeups.
+default_timeout_seconds = None
+
+# Disable Nagle's algorithm in connections (see `TCPMessageStream.configure_connection()`)?
+# Messages sent together are already coalesced by `send_messages()`, so delaying them further only adds latency.
+tcp_nodelay = True
+# Send batches of messages as separate writes while the connection is corked (TCP_CORK, Linux only),
+# instead of joining them into a single buffer?
+use_tcp_cork = False
 
 # Be verbose?
 be_verbose = False
@@ -40,7 +52,15 @@ class TCPMessageStream:
     The application protocol is simply a fixed length field of `bytes_message_length` characters
     with the ASCII encoding (using leading '0' characters) of the length of the message data,
     followed by the actual message data. Everything is utf-8 encoded.
+
+    Messages can also be sent in binary format (see `Message.encode_binary()`), once both ends
+    have agreed to it in their MessageHello. Binary frames consist of the message's binary_type byte
+    (always >= 0x80, hence distinguishable from the ASCII length digits), the big-endian unsigned
+    16-bit length of the payload, and the payload itself. Both frame formats are always accepted
+    when receiving.
     """
+    # Header of binary frames: binary_type, payload length
+    binary_header_struct = struct.Struct(">BH")
 
     def __init__(self, bytes_message_length, max_message_length, buffer_size,
                  timeout_seconds=default_timeout_seconds, name=""):
@@ -48,7 +68,8 @@ class TCPMessageStream:
         :param bytes_message_length: number of bytes devoted to specify each message's body length in bytes
         :param max_message_length: maximum number of bytes allowed for a single message's body
         :param buffer_size: buffer size to use
-        :param timeout_seconds: default timeout in seconds (see `send_message()` and `receive_message()`)
+        :param timeout_seconds: timeout in seconds for each read from a connection, or None
+          to read in blocking mode (see `_receive_into_timeout()`)
         :param name: name of the stream - useful for debugging
         """
         self.bytes_message_length = bytes_message_length
@@ -58,76 +79,197 @@ class TCPMessageStream:
         self.timeout_seconds = timeout_seconds
         self.name = name
 
-    def send_message(self, message: Message, tcp_connection):
+    def send_message(self, message: Message, tcp_connection, binary=False):
         """Send a message over the tcp connection
+
+        :param binary: if True, the message is sent in binary format if its type supports it
         """
         if be_verbose:
             print(f"[>>O?>> TCPMessageStream[{self.name}]] Sending message")
             print("[[Encoded]]='{}'".format(message.encode()))
 
-        message_body_text = message.encode()
-        message_body_bytes = message_body_text.encode("utf8")
-        message_body_length = len(message_body_bytes)
-        tcp_message = \
-            self.tcp_message_length_bytes_template.format(message_body_length).encode("utf8") \
-            + message_body_bytes
-
-        tcp_connection.sendall(tcp_message)
+        self.send_tcp_message(tcp_message=self.frame_message(message, binary=binary), tcp_connection=tcp_connection)
 
         if be_verbose:
             print(f"[>>O!>> TCPMessageStream[{self.name}]] Sent OK!", message)
 
+    def send_messages(self, messages, tcp_connection, binary=False):
+        """Send a batch of messages over the tcp connection, coalescing them in as few writes as possible:
+        they are joined into a single buffer written with one sendall() call, or written
+        while the connection is corked if `use_tcp_cork` is True and supported.
+
+        :param messages: list of message.Message instances or already framed messages (see `frame_message()`)
+        :param binary: if True, messages are sent in binary format if their type supports it
+        """
+        tcp_messages = [message if isinstance(message, bytes) else self.frame_message(message, binary=binary)
+                        for message in messages]
+        if len(tcp_messages) == 1:
+            self.send_tcp_message(tcp_message=tcp_messages[0], tcp_connection=tcp_connection)
+        elif use_tcp_cork and hasattr(socket, "TCP_CORK"):
+            tcp_connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            try:
+                for tcp_message in tcp_messages:
+                    tcp_connection.sendall(tcp_message)
+            finally:
+                tcp_connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        else:
+            self.send_tcp_message(tcp_message=b"".join(tcp_messages), tcp_connection=tcp_connection)
+
+        if be_verbose:
+            print(f"[>>O!>> TCPMessageStream[{self.name}]] Sent {len(tcp_messages)} messages OK!")
+
+    @staticmethod
+    def configure_connection(tcp_connection):
+        """Set the socket options used for message streams in tcp_connection (see `tcp_nodelay`).
+        """
+        tcp_connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if tcp_nodelay else 0)
+
+    def frame_message(self, message: Message, binary=False):
+        """Return the bytes that represent message in this stream, i.e., the length field followed
+        by the message's encoding. Unchanged messages are serialized only once (see `Message.encode_bytes()`),
+        and the returned bytes can be sent any number of times with `send_tcp_message()`.
+
+        :param binary: if True, a binary frame is returned if the message can be encoded
+          in binary format. Otherwise, the default (json) format is used.
+        """
+        if binary:
+            payload = message.encode_binary()
+            if payload is not None and len(payload) <= 0xFFFF:
+                return self.binary_header_struct.pack(message.binary_type, len(payload)) + payload
+
+        message_body_bytes = message.encode_bytes()
+        return self.tcp_message_length_bytes_template.format(len(message_body_bytes)).encode("utf8") \
+               + message_body_bytes
+
+    def send_tcp_message(self, tcp_message, tcp_connection):
+        """Send the bytes of an already framed message (see `frame_message()`) over the tcp connection
+        """
+        tcp_connection.sendall(tcp_message)
+
     def receive_messages(self, queue, tcp_connection, player_from=None, pending_data=None):
         """Receive all messages from a tcp_connection and put them sequentially in queue.
+        All complete messages available after each read from the connection are queued before reading again.
 
         Raise MessageException if an invalid message is received.
         Raise IOError if cannot get new data (connection broken?).
 
-        :return: any unprocessed pending_data
-        """
-        # Get all messages from this player
-        connected = True
+        :param pending_data: None, bytes or `ReceiveBuffer` with data already received from tcp_connection
+          (e.g., as returned by `receive_one_message()`).
 
-        while connected:
-            message, pending_data = self.receive_one_message(
-                pending_data=pending_data,
-                tcp_connection=tcp_connection,
-                player_from=player_from)
+        :return: any unprocessed pending_data, as a ReceiveBuffer
+        """
+        receive_buffer = self._get_receive_buffer(pending_data)
 
-            if message is None:
-                connected = False
+        # Get all messages from this player
+        while True:
+            complete, message = self._parse_frame(receive_buffer=receive_buffer, player_from=player_from)
+            if not complete:
+                self._receive_into_timeout(receive_buffer=receive_buffer, tcp_connection=tcp_connection)
+            elif message is None:
+                return receive_buffer
             else:
                 queue.put(message)
 
-        return pending_data
-
-    def receive_one_message(self, pending_data, tcp_connection, player_from):
+    def receive_one_message(self, pending_data, tcp_connection, player_from, deadline=None):
         """Blockingly receive one complete message.
         Return a None message if the connection is broken before a message is obtained.
 
         Raise MessageException if an invalid message is received.
+        Raise TimeoutError if deadline is reached before a complete message is received.
         Raise IOError if cannot get new data (connection broken?).
 
-        :return message, pending_data"""
-        if pending_data is None:
-            pending_data = b""
+        :param pending_data: None, bytes or `ReceiveBuffer` with data already received from tcp_connection.
+        :param deadline: None, or maximum time.monotonic() value until which data are awaited.
+          The timeout of tcp_connection is set accordingly while reading, and restored
+          to self.timeout_seconds before returning, so that later sends are not affected.
+
+        :return message, pending_data, where pending_data is a `ReceiveBuffer` that must be passed to
+          subsequent calls to `receive_one_message()` or `receive_messages()` for that connection"""
+        receive_buffer = self._get_receive_buffer(pending_data)
+        if deadline is None:
+            while True:
+                complete, message = self._parse_frame(receive_buffer=receive_buffer, player_from=player_from)
+                if complete:
+                    return message, receive_buffer
+                self._receive_into_timeout(receive_buffer=receive_buffer, tcp_connection=tcp_connection)
 
-        # Get message length
-        if be_superverbose:
-            print("[receive_one_message] Getting length...")
-            print("[watch] pending_data = {}".format(pending_data))
-            print("[watch] len(pending_data) = {}".format(len(pending_data)))
-            print("[watch] self.bytes_message_length = {}".format(self.bytes_message_length))
-        while len(pending_data) < self.bytes_message_length:
-            new_data = self._read_data_timeout(
-                tcp_connection=tcp_connection,
-                max_size=self.bytes_message_length - len(pending_data))
-            if new_data is None:
-                continue
-            pending_data += new_data
+        try:
+            while True:
+                complete, message = self._parse_frame(receive_buffer=receive_buffer, player_from=player_from)
+                if complete:
+                    return message, receive_buffer
+                remaining_seconds = deadline - time.monotonic()
+                if remaining_seconds <= 0 or self._receive_into_timeout(
+                        receive_buffer=receive_buffer, tcp_connection=tcp_connection,
+                        timeout_seconds=remaining_seconds) == 0:
+                    raise TimeoutError("[TCPMessageStream.receive_one_message] Error! Deadline reached")
+        finally:
+            try:
+                tcp_connection.settimeout(self.timeout_seconds)
+            except OSError:
+                # Connection already closed
+                pass
+
+    def _get_receive_buffer(self, pending_data):
+        if isinstance(pending_data, ReceiveBuffer):
+            return pending_data
+        return ReceiveBuffer(initial_data=pending_data if pending_data is not None else b"",
+                             capacity=self.buffer_size)
+
+    def _parse_frame(self, receive_buffer, player_from):
+        """Parse the first frame in receive_buffer if it is complete, and consume it from the buffer.
+
+        Raise MessageException if an invalid message is found.
+
+        :return: complete, message: complete is False if more data is needed to parse the first frame.
+          Otherwise, message is the parsed message, or None if a zero-length message
+          (meaning the connection is being closed) was found.
+        """
+        view = receive_buffer.view
+        start = receive_buffer.start
+        available = receive_buffer.end - start
+        if available < 1:
+            return False, None
+
+        # The first byte tells binary frames apart from length-prefixed json messages
+        if view[start] >= 0x80:
+            header_size = self.binary_header_struct.size
+            if available < header_size:
+                return False, None
+            binary_type, message_length = self.binary_header_struct.unpack_from(view, start)
+            if available < header_size + message_length:
+                receive_buffer.reserve(header_size + message_length)
+                return False, None
+            message = Message.parse_binary(
+                binary_type, view[start + header_size:start + header_size + message_length])
+        else:
+            header_size = self.bytes_message_length
+            if available < header_size:
+                return False, None
+            message_length = self._parse_message_length(view[start:start + header_size])
+            if available < header_size + message_length:
+                receive_buffer.reserve(header_size + message_length)
+                return False, None
+            if message_length == 0:
+                receive_buffer.consume(header_size)
+                return True, None
+            message = self._parse_message_body(view[start + header_size:start + header_size + message_length])
+        receive_buffer.consume(header_size + message_length)
+        message.player_from = player_from
 
+        if be_verbose:
+            print(f"[<<I!<< TCPMessageStream[{self.name}] Message received: ", message)
+            print(f"[                                   ] Pending data: {len(receive_buffer)} bytes")
+
+        return True, message
+
+    def _parse_message_length(self, length_field):
+        """Parse the length field of a json message.
+
+        Raise MessageException if the length is not valid.
+        """
         try:
-            message_length = int(pending_data[:self.bytes_message_length], base=10)
+            message_length = int(bytes(length_field), base=10)
         except ValueError:
             raise MessageException("[TCPMessageStream.receive_one_message] Wrong message length")
         if message_length < 0 or message_length > self.max_message_length:
@@ -135,65 +277,252 @@ class TCPMessageStream:
                 "[TCPMessageStream.receive_one_message] Error! Bad message length {}".format(message_length))
         if be_superverbose:
             print("[receive_one_message] Length = {}".format(message_length))
+        return message_length
 
-        pending_data = pending_data[self.bytes_message_length:]
-        # Get message body
-        if message_length == 0:
-            return None, pending_data
-        while len(pending_data) < message_length:
-            new_data = self._read_data_timeout(
-                tcp_connection=tcp_connection,
-                max_size=message_length - len(pending_data))
-            if new_data is None:
-                # Data is not available yet but connexion is up. Keep trying
-                continue
-            pending_data += new_data
-        message_str = pending_data[:message_length].decode("utf8")
-
-        message = Message.parse_data(message_str)
-        message.player_from = player_from
-        pending_data = pending_data[message_length:]
+    def _parse_message_body(self, message_body):
+        """Parse the utf-8 encoded body of a json message.
 
-        if be_verbose:
-            print(f"[<<I!<< TCPMessageStream[{self.name}] Message received: ", message)
-            print(f"[                                   ] Pending data: {pending_data}")
+        Raise MessageException if the body is not a valid message.
+        """
+        try:
+            message_str = str(message_body, "utf8")
+        except UnicodeDecodeError as ex:
+            raise MessageException(ex)
+        return Message.parse_data(message_str)
 
-        return message, pending_data
+    def _receive_into_timeout(self, receive_buffer, tcp_connection, timeout_seconds=None):
+        """Try to get data for timeout_seconds seconds, appending them to receive_buffer.
+        As many bytes as fit in the buffer are read at once, with a single recv_into call.
 
-    def _read_data_timeout(self, tcp_connection, timeout_seconds=None, max_size=None):
-        """Try to get data for timeout_seconds seconds.
-        If no data was available before the timeout, None is returned.
-        If connection is not available, an IOError is raised
+        The timeout is implemented by the socket itself: it is set on tcp_connection only
+        if it differs from the connection's current timeout, i.e., typically once per connection.
+        A None timeout means blocking mode.
 
         Raise IOError if cannot get new data (connection broken?).
 
-        :param max_size: if not None, recv is invoked with that value
-
-        :return: new_data, or None if not received in time
+        :return: the number of bytes received, 0 if none were received in time
         """
         if timeout_seconds is None:
             timeout_seconds = self.timeout_seconds
 
         try:
+            if tcp_connection.gettimeout() != timeout_seconds:
+                tcp_connection.settimeout(timeout_seconds)
             if be_superverbose:
-                print("[_read_data_timeout(max_size={}] Trying to get data from {}...".format(
-                    max_size, id(tcp_connection)))
-            
-            ready = select.select([tcp_connection], [], [], timeout_seconds)
-
-            if ready[0]:
-                tcp_connection.setblocking(False)
-                if max_size is None:
-                    recv_arg = self.buffer_size
-                else:
-                    recv_arg = max_size
-                new_data = tcp_connection.recv(recv_arg)
-                tcp_connection.setblocking(True)
-                if new_data == b"":
-                    raise IOError("[_read_data_timeout] Error! Cannot get new data from the connection")
+                print("[_receive_into_timeout] Trying to get data from {}...".format(id(tcp_connection)))
+            received_size = tcp_connection.recv_into(receive_buffer.get_free_view())
+        except socket.timeout:
+            return 0
+        except OSError as ex:
+            raise IOError("[_receive_into_timeout] Error: {}".format(ex))
+
+        if received_size == 0:
+            raise IOError("[_receive_into_timeout] Error! Cannot get new data from the connection")
+        receive_buffer.end += received_size
+        return received_size
+
+
+class AsyncTCPMessageStream(TCPMessageStream):
+    """Variant of TCPMessageStream for asyncio streams: messages are read from an asyncio.StreamReader
+    and written to an asyncio.StreamWriter instead of a socket. Frames are exactly the same in both variants,
+    so that either end of a connection can use any of them.
+
+    Note that send_message and send_messages are coroutines in this class, and they expect a StreamWriter.
+    """
+
+    async def send_message(self, message: Message, writer, binary=False):
+        """Write a message to writer and wait until it can accept more data (see `asyncio.StreamWriter.drain()`).
+
+        :param binary: if True, the message is sent in binary format if its type supports it
+        """
+        await self.send_messages([message], writer, binary=binary)
+
+    async def send_messages(self, messages, writer, binary=False):
+        """Write a batch of messages to writer with a single write, and wait until it can accept more data.
+
+        Raise IOError if the connection is broken.
+
+        :param messages: list of message.Message instances or already framed messages (see `frame_message()`)
+        :param binary: if True, messages are sent in binary format if their type supports it
+        """
+        self.write_messages(messages, writer, binary=binary)
+        await writer.drain()
+
+    async def iterate_messages(self, reader, player_from=None):
+        """Asynchronously iterate over all messages read from reader, until a zero-length message is received.
+
+        Raise MessageException if an invalid message is received.
+        Raise IOError if the connection is closed before a zero-length message is received.
+        """
+        while True:
+            message = await self.read_message(reader, player_from=player_from)
+            if message is None:
+                return
+            yield message
+
+    async def read_message(self, reader, player_from=None):
+        """Read one complete message from reader.
+
+        Raise MessageException if an invalid message is received.
+        Raise IOError if the connection is closed before a complete message is received.
+
+        :return: the message, or None if a zero-length message (meaning the connection
+          is being closed) was received
+        """
+        try:
+            first_byte = await reader.readexactly(1)
+            # The first byte tells binary frames apart from length-prefixed json messages
+            if first_byte[0] >= 0x80:
+                header = first_byte + await reader.readexactly(self.binary_header_struct.size - 1)
+                binary_type, message_length = self.binary_header_struct.unpack(header)
+                message = Message.parse_binary(binary_type, await reader.readexactly(message_length))
             else:
-                new_data = None
+                message_length = self._parse_message_length(
+                    first_byte + await reader.readexactly(self.bytes_message_length - 1))
+                if message_length == 0:
+                    return None
+                message = self._parse_message_body(await reader.readexactly(message_length))
+        except asyncio.IncompleteReadError as ex:
+            raise IOError("[AsyncTCPMessageStream.read_message] Error! Connection closed: {}".format(ex))
+        message.player_from = player_from
+
+        if be_verbose:
+            print(f"[<<I!<< AsyncTCPMessageStream[{self.name}] Message received: ", message)
+
+        return message
+
+    def write_messages(self, messages, writer, binary=False):
+        """Write a batch of messages to writer with a single write (without waiting for them to be sent).
 
-            return new_data
-        except socket.error as ex:
-            raise IOError("[_read_data_timeout] Error: {}".format(ex))
+        :param messages: list of message.Message instances or already framed messages (see `frame_message()`)
+        :param binary: if True, messages are sent in binary format if their type supports it
+        """
+        writer.write(b"".join(message if isinstance(message, bytes) else self.frame_message(message, binary=binary)
+                              for message in messages))
+
+        if be_verbose:
+            print(f"[>>O!>> AsyncTCPMessageStream[{self.name}]] Wrote {len(messages)} messages")
+
+
+class ReceiveBuffer:
+    """Preallocated buffer where the data received from a connection are stored until complete messages
+    can be parsed from it. Valid data are in self.data[self.start:self.end].
+
+    Data are received directly into the buffer (see `get_free_view()`) and parsed through `self.view`,
+    so that no intermediate bytes objects are created.
+    """
+
+    def __init__(self, initial_data=b"", capacity=4096):
+        self.data = bytearray(max(capacity, len(initial_data)))
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = len(initial_data)
+        self.data[:self.end] = initial_data
+
+    def __len__(self):
+        return self.end - self.start
+
+    def consume(self, size):
+        """Discard the first size bytes of valid data.
+        """
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def reserve(self, size):
+        """Make sure that at least size bytes of valid data fit in the buffer without moving them.
+        """
+        if self.start + size <= len(self.data):
+            return
+        valid_size = self.end - self.start
+        if size <= len(self.data):
+            # Move valid data to the beginning
+            self.data[:valid_size] = self.data[self.start:self.end]
+        else:
+            # Replace with a larger buffer (the old one cannot be resized while views exist)
+            new_data = bytearray(max(size, 2 * len(self.data)))
+            new_data[:valid_size] = self.view[self.start:self.end]
+            self.view.release()
+            self.data = new_data
+            self.view = memoryview(self.data)
+        self.start, self.end = 0, valid_size
+
+    def get_free_view(self):
+        """Return a memoryview of the free space after the valid data, which is made available if necessary.
+        """
+        if self.end == len(self.data):
+            self.reserve(len(self) + 1 if self.start > 0 else 2 * len(self.data))
+        return self.view[self.end:]
+
+
+def benchmark_wire_formats(message_count=20000):
+    """Compare the size and the encoding and decoding time of the json and binary formats
+    for the message types that support the latter.
+    """
+    message_stream = TCPMessageStream(bytes_message_length=6, max_message_length=10 ** 6 - 1, buffer_size=1024)
+    header_size = TCPMessageStream.binary_header_struct.size
+    for message_factory in [lambda: MessageShot(row_col_lists=[(1, 2), (3, 4), (5, 6)]),
+                            lambda: MessageShotResult(hit_length_list=[2], sunk_length_list=[1], game_finished=False),
+                            lambda: MessageChat(text="Hello world!", origin_id=1, recipient_id=None),
+                            lambda: MessageChallenge(challenge_id="Player1 vs Player2", origin_id=1, recipient_id=2)]:
+        message = message_factory()
+        for binary in [False, True]:
+            tcp_message = message_stream.frame_message(message, binary=binary)
+
+            # New instances are needed to avoid measuring cached encodings
+            messages = [message_factory() for _ in range(message_count)]
+            time_before = time.perf_counter()
+            for m in messages:
+                message_stream.frame_message(m, binary=binary)
+            encoding_time = time.perf_counter() - time_before
+
+            time_before = time.perf_counter()
+            if binary:
+                payload = tcp_message[header_size:]
+                for _ in range(message_count):
+                    Message.parse_binary(message.binary_type, payload)
+            else:
+                body = tcp_message[message_stream.bytes_message_length:].decode("utf8")
+                for _ in range(message_count):
+                    Message.parse_data(body)
+            decoding_time = time.perf_counter() - time_before
+
+            print("[watch] {} ({}): {} bytes, encoding {:.2f} us, decoding {:.2f} us".format(
+                message.__class__.__name__, "binary" if binary else "json", len(tcp_message),
+                1e6 * encoding_time / message_count, 1e6 * decoding_time / message_count))
+
+
+def benchmark_receive(message_count=100000):
+    """Measure the number of messages per second received and parsed from a single connection.
+    """
+    import threading
+
+    class ListQueue(list):
+        put = list.append
+
+    message_stream = TCPMessageStream(bytes_message_length=6, max_message_length=10 ** 6 - 1, buffer_size=16384)
+    message = MessageShot(row_col_lists=[(1, 2), (3, 4), (5, 6)])
+    for binary in [False, True]:
+        # A zero-length message ends receive_messages
+        data = message_stream.frame_message(message, binary=binary) * message_count + b"000000"
+        sending_socket, receiving_socket = socket.socketpair()
+        sending_thread = threading.Thread(target=sending_socket.sendall, args=(data,))
+        received_messages = ListQueue()
+
+        time_before = time.perf_counter()
+        sending_thread.start()
+        message_stream.receive_messages(queue=received_messages, tcp_connection=receiving_socket)
+        total_time = time.perf_counter() - time_before
+        sending_thread.join()
+        sending_socket.close()
+        receiving_socket.close()
+
+        assert len(received_messages) == message_count
+        print("[watch] {} ({}): {:.0f} messages/s".format(
+            message.__class__.__name__, "binary" if binary else "json", message_count / total_time))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == "benchmark":
+        benchmark_wire_formats()
+        benchmark_receive()
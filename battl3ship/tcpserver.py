@@ -22,16 +22,20 @@ challenge each other and send their game decisions.
 __author__ = "Miguel Hernández Cabronero <mhernandez314@gmail.com>"
 
 import queue
+import asyncio
 import socketserver
 import os
 import socket
 import threading
 import random
+import time
 
 from message import *
 from player import Player
-from tcpmessagestream import TCPMessageStream
+import tcpmessagestream
+from tcpmessagestream import TCPMessageStream, AsyncTCPMessageStream
 from game import Battl3ship
+import generation
 
 ############################ Begin configurable part
 
@@ -45,7 +49,40 @@ max_connections_per_ip = 128  # Maximum number of allowed connections from the s
 
 max_player_name_length = 30
 
-BUFFER_SIZE = 1024
+# Maximum time in seconds for new connections to send their MessageHello.
+# Connections still logging in count for the connection limits.
+login_timeout_seconds = 10
+
+# Server engine used unless another one is given when starting the server:
+#   "threads": one thread per connection, plus one thread per player to send its messages
+#   "asyncio": all connections are served by a single asyncio event loop, without per-player threads
+default_engine = "threads"
+server_engines = ["threads", "asyncio"]
+# Maximum number of connections waiting to be accepted by the server engine
+listen_backlog = 1024
+# Maximum number of bytes written to a player and not yet sent with the asyncio engine.
+# Players that do not read their messages fast enough to stay below it are disconnected.
+# It must be larger than the MessagePlayerList sent to new players.
+max_pending_output_bytes = 1 << 20
+
+# Maximum number of pre-generated placements kept to answer MessageRequestPlacementSuggestion
+placement_pool_size = 256
+
+# Accept the binary message format for players that request it in their MessageHello?
+allow_binary_protocol = True
+
+# Number of threads that process game messages (see `GenericGameServer.game_message_types`) with the threads engine.
+# All messages of a game are processed in order by the same thread, in parallel with lobby messages and other games.
+# If 0, game messages are processed by the lobby thread.
+game_worker_count = 4
+
+# Send all messages queued for a player at once with a single write?
+coalesce_outgoing_messages = True
+# Maximum number of messages sent together when coalescing
+max_coalesced_message_count = 256
+
+# Initial size of each connection's receive buffer (it grows as needed for longer messages)
+BUFFER_SIZE = 16384
 BYTES_MESSAGE_FIELD = 6
 MAX_MESSAGE_LENGTH = 10 ** BYTES_MESSAGE_FIELD - 1
 
@@ -65,65 +102,126 @@ class GenericGameServer:
 
     Subclasses must implement the _process_incoming_messages method, which will be sequentially invoked
     as messages from logged-in player (hello protocol does not invoke this method).
+
+    Connections are served either by threads or by an asyncio event loop, depending on the engine
+    chosen at startup (see `server_engines`). The same login protocol and game logic are used with both engines.
+
+    Messages whose type is in game_message_types concern only the sender's active game. With the threads engine,
+    they are processed by one of `game_worker_count` threads chosen by game, in parallel with the lobby.
+    Lobby state (players and challenges) is protected by self._lock, the game indexes by self._games_lock,
+    and the state of each game by its own lock (see `get_game_lock()`). Locks are always acquired in that order,
+    and are never held during socket I/O: messages are only put in per-player queues while holding them.
     """
-    _lock = threading.RLock()
+    # Types of the messages processed by game workers
+    game_message_types = ()
+
+    # Put in a player's outgoing queue to close their connection after sending all previous messages
+    _close_connection = object()
 
     _next_player_id = 0
 
-    def __init__(self, port=None, password=None):
+    def __init__(self, port=None, password=None, engine=None):
         """Initialize but don't start serving (nonblocking)
+
+        :param engine: one of `server_engines`, or None to use `default_engine`
         """
         self.port = port if port is not None else default_port
         self.password = password
-        self.player_list = []
-        self.pending_challenge_messages = []
+        self.engine = engine if engine is not None else default_engine
+        if self.engine not in server_engines:
+            raise ValueError("[tcpserver.GenericGameServer] Error! Invalid engine {}".format(self.engine))
         self.server_player = Player(tcp_connection=None, ip=None, port=None, server=None, name="TheServer")
         self.active_game_by_id = dict()
+        # Lobby lock
+        self._lock = threading.RLock()
+        # Lock of the game indexes
+        self._games_lock = threading.RLock()
+        self._game_lock_by_id = dict()
+
+        # Indexes of the logged-in players, games and pending challenges, maintained by the
+        # _add_* and _remove_* methods so that messages are processed in constant time regardless of the lobby size.
+        # Players are kept in login order
+        self.player_by_id = dict()
+        self.player_by_lower_name = dict()
+        self.player_count_by_ip = dict()
+        # Active games in which each player participates, in creation order
+        self.active_games_by_player_id = dict()
+        # Pending challenges (only one per origin), also indexed by recipient id
+        # (None for open challenges) and then by origin id, in posting order
+        self.challenge_by_origin_id = dict()
+        self.challenges_by_recipient_id = dict()
+        # Connections that have not completed their login yet
+        self._logging_in_players = set()
+        self._login_count_by_ip = dict()
 
         self._message_stream = TCPMessageStream(
             bytes_message_length=BYTES_MESSAGE_FIELD,
             max_message_length=MAX_MESSAGE_LENGTH,
             buffer_size=BUFFER_SIZE,
             name="Server")
-        # This TCP server invokes the _handle_connection in a separate thread for each connection
-        GenericGameServer._RequestHandler.game_server = self
-        socketserver.TCPServer.allow_reuse_address = True
-        self._tcp_server = GenericGameServer._ThreadedTCPServer(
-            (local_host_ip, self.port), GenericGameServer._RequestHandler)
-        self._tcp_server.allow_reuse_address = True  # In case a previous instance was killed without proper shoutdown
-
-        # Message queues
-        # Each que is processed asynchronously in order by a single thread
-        # (threads can safely pass queues from one queue to another as long as there are no infinite loops)
-        self._incoming_messages = queue.Queue()
-        self._outgoing_messages = queue.Queue()
-        self._player_outgoing_messages = dict()  # One queue per player
-        # Start the threads associated to the queues
-        t = threading.Thread(target=self._process_incoming_messages)
-        t.daemon = True
-        t.start()
-        t = threading.Thread(target=self._process_outgoing_messages)
-        t.daemon = True
-        t.start()
+        # One queue per player (or _AsyncOutbox with the asyncio engine)
+        self._player_outgoing_messages = dict()
+
+        if self.engine == "asyncio":
+            # The event loop is started by serve_forever, which then invokes
+            # _handle_connection_async in a separate task for each connection
+            self._async_message_stream = AsyncTCPMessageStream(
+                bytes_message_length=BYTES_MESSAGE_FIELD,
+                max_message_length=MAX_MESSAGE_LENGTH,
+                buffer_size=BUFFER_SIZE,
+                name="Server")
+            self._loop = None
+            self._stop_serving = None
+        else:
+            # This TCP server invokes the _handle_connection in a separate thread for each connection
+            GenericGameServer._RequestHandler.game_server = self
+            socketserver.TCPServer.allow_reuse_address = True
+            self._tcp_server = GenericGameServer._ThreadedTCPServer(
+                (local_host_ip, self.port), GenericGameServer._RequestHandler)
+            self._tcp_server.allow_reuse_address = True  # In case a previous instance was killed without proper shoutdown
+
+            # Message queues
+            # Each que is processed asynchronously in order by a single thread
+            # (threads can safely pass queues from one queue to another as long as there are no infinite loops)
+            self._incoming_messages = queue.Queue()
+            self._game_message_queues = [queue.Queue() for _ in range(game_worker_count)]
+            self._outgoing_messages = queue.Queue()
+            # Start the threads associated to the queues
+            for message_queue in [self._incoming_messages] + self._game_message_queues:
+                t = threading.Thread(target=self._process_incoming_messages, args=(message_queue,))
+                t.daemon = True
+                t.start()
+            t = threading.Thread(target=self._process_outgoing_messages)
+            t.daemon = True
+            t.start()
+
+    @property
+    def player_list(self):
+        """List of logged-in players, in login order.
+        """
+        return list(self.player_by_id.values())
+
+    def get_challenge_players(self, challenge):
+        """Get the logged-in players that are notified about a challenge: all of them for open challenges,
+        or its origin and recipient otherwise.
+        """
+        if challenge.recipient_id is None:
+            return self.player_by_id.values()
+        return [self.player_by_id[player_id] for player_id in (challenge.origin_id, challenge.recipient_id)
+                if player_id in self.player_by_id]
 
     def remove_challenge_and_notify(self, in_message):
         """Only the affected players will be notified
         """
         with self._lock:
-            try:
-                dummy_challenge = MessageChallenge(origin_id=in_message.origin_id)
-                posted_challenge = [challenge for challenge in self.pending_challenge_messages
-                                    if challenge == dummy_challenge][0]
-                self.pending_challenge_messages.remove(posted_challenge)
-
-                for player in self.player_list:
-                    if player.id in [posted_challenge.origin_id, posted_challenge.recipient_id] \
-                            or posted_challenge.recipient_id is None:
-                        self.send_message_to_player(player=player, message=in_message)
-            except IndexError:
+            posted_challenge = self.challenge_by_origin_id.get(in_message.origin_id)
+            if posted_challenge is None:
                 if be_verbose:
                     print("[tcpserver.remove_challenge_and_notify] Received bogus CancelChallenge from {}".format(
                         in_message.player_from))
+                return
+            self._remove_challenge(posted_challenge)
+            self.broadcast_message(message=in_message, players=self.get_challenge_players(posted_challenge))
 
     def process_incoming_message(self, message):
         raise Exception("[tcpserver.process_incoming_message] Error! Subclasses must implement this method")
@@ -131,29 +229,93 @@ class GenericGameServer:
     def serve_forever(self):
         try:
             if be_verbose:
-                print("[tcpserver.serve_forever] Starting TCP Server @ port {}".format(self.port))
-            self._tcp_server.serve_forever()
+                print("[tcpserver.serve_forever] Starting TCP Server @ port {} ({} engine)".format(
+                    self.port, self.engine))
+            if self.engine == "asyncio":
+                asyncio.run(self._serve_forever_async())
+            else:
+                self._tcp_server.serve_forever()
         finally:
             if be_verbose:
                 print("[tcpserver.serve_forever] Ended serving forever")
 
+    def shutdown(self):
+        """Make serve_forever return. It must be invoked from a different thread.
+        """
+        if self.engine == "asyncio":
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._stop_serving.set)
+        else:
+            self._tcp_server.shutdown()
+
+    async def _serve_forever_async(self):
+        """Accept and serve connections with the asyncio engine until shutdown is invoked.
+        Connections still open are closed afterwards.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop_serving = asyncio.Event()
+        async_server = await asyncio.start_server(
+            self._handle_connection_async, local_host_ip, self.port, backlog=listen_backlog, reuse_address=True)
+        self.port = async_server.sockets[0].getsockname()[1]
+        async with async_server:
+            await self._stop_serving.wait()
+
     def send_message(self, message):
         """Queue an outgoing message and return.
         """
-        self._outgoing_messages.put(message)
+        if self.engine == "asyncio":
+            # Per-player outboxes are not blocking, no need for an intermediate queue
+            self.send_message_to_player(message=message, player=message.player_to)
+        else:
+            self._outgoing_messages.put(message)
 
     def send_message_to_player(self, message, player):
-        self._player_outgoing_messages[player].put(message)
+        """Queue a message for a player. Players not connected anymore are ignored.
+        """
+        try:
+            self._player_outgoing_messages[player].put(message)
+        except KeyError:
+            pass
+
+    def broadcast_message(self, message, players=None):
+        """Send the same message to several players. The message is serialized and framed only once
+        per format (json or binary), and the resulting bytes are shared by the outgoing queues of all recipients.
+
+        :param players: iterable of recipient players. If None, all players in `self.player_list`
+          are notified. Players not connected anymore are ignored.
+        """
+        tcp_message_by_binary = dict()
+        with self._lock:
+            for player in (players if players is not None else self.player_by_id.values()):
+                try:
+                    tcp_message = tcp_message_by_binary[player.binary_protocol]
+                except KeyError:
+                    tcp_message = self._message_stream.frame_message(message, binary=player.binary_protocol)
+                    tcp_message_by_binary[player.binary_protocol] = tcp_message
+                try:
+                    self._player_outgoing_messages[player].put(tcp_message)
+                except KeyError:
+                    pass
 
-    def _process_incoming_messages(self):
+    def _process_incoming_messages(self, message_queue):
         """Process valid incoming message and call the process_incoming_message method sequentially.
         """
         if be_superverbose:
             print("[tcpserver._process_incoming_messages] Started")
         while True:
-            message = self._incoming_messages.get()
+            message = message_queue.get()
             self.process_incoming_message(message)
 
+    def _get_incoming_message_queue(self, message):
+        """Get the queue where an incoming message must be put with the threads engine: the lobby queue,
+        or the queue of the worker of the sender's active game for game messages.
+        """
+        if message.type in self.game_message_types and self._game_message_queues:
+            game = self.get_active_game(message.player_from)
+            key = game.id if game is not None else message.player_from.id
+            return self._game_message_queues[hash(key) % len(self._game_message_queues)]
+        return self._incoming_messages
+
     def _process_outgoing_messages(self):
         """Process outgoing messages in order.
 
@@ -168,122 +330,81 @@ class GenericGameServer:
             message = self._outgoing_messages.get()
             if be_superverbose:
                 print("[tcpserver._process_outgoing_messages >>>] Processing message {}".format(message))
-            try:
-                self.send_message_to_player(message=message, player=message.player_to)
-            except KeyError as ex:
-                pass
+            self.send_message_to_player(message=message, player=message.player_to)
 
     def _send_messages_to_player(self, player, *args, **kwargs):
         """Monitor the outgoing message queue for a player,
         sending data to the socket in the order given by the queue.
+
+        If coalesce_outgoing_messages is True, all messages waiting in the queue
+        are sent together (see `TCPMessageStream.send_messages()`).
         """
         while True:
             try:
+                player_queue = self._player_outgoing_messages[player]
                 # Queue every 5 seconds to allow disposing of threads associated to disconnected players
-                message = self._player_outgoing_messages[player].get(timeout=5)
-                self._message_stream.send_message(message=message, tcp_connection=player.tcp_connection)
+                # (messages can be already framed by broadcast_message)
+                messages = [player_queue.get(timeout=5)]
+                if coalesce_outgoing_messages:
+                    try:
+                        while len(messages) < max_coalesced_message_count \
+                                and messages[-1] is not GenericGameServer._close_connection:
+                            messages.append(player_queue.get_nowait())
+                    except queue.Empty:
+                        pass
+                close_connection = messages[-1] is GenericGameServer._close_connection
+                if close_connection:
+                    messages.pop()
+                if messages:
+                    self._message_stream.send_messages(messages=messages, tcp_connection=player.tcp_connection,
+                                                       binary=player.binary_protocol)
+                if close_connection:
+                    # The receiving thread does the cleanup
+                    player.tcp_connection.shutdown(socket.SHUT_RDWR)
+                    player.tcp_connection.close()
+                    break
             except queue.Empty:
                 pass
-            except KeyError:
+            except (KeyError, OSError):
+                # Player removed or connection closed - cleanup is done by _handle_connection
                 break
 
     def _handle_connection(self, tcp_connection, client_ip, client_port):
         """Handle a connection request. This is invoked in a parallel thread.
         """
         new_player = Player(tcp_connection=tcp_connection, ip=client_ip, port=client_port, server=self)
+        TCPMessageStream.configure_connection(tcp_connection)
 
         broken_connection = False
 
         try:
-            with self._lock:
-                # Check connection count limits
-                players_same_ip = [player for player in self.player_list if player.ip == new_player.ip]
-                if len(self.player_list) > max_connections or len(players_same_ip) + 1 > max_connections_per_ip:
-                    message = MessageBye(
-                        player_from=self.server_player, id=new_player.id,
-                        extra_info_str="Too many connections!")
-                    self._message_stream.send_message(message=message, tcp_connection=tcp_connection)
-                    return
-                if be_verbose:
-                    print("[tcpserver._handle_connection] Valid incoming connection from {}:{}".format(client_ip,
-                                                                                                       client_port))
-
-                # Wait for Hello from player
+            refusal = self._start_login(new_player)
+            if refusal is None:
+                # Wait for Hello from player, without holding any lock
                 if be_verbose:
                     print("[tcpserver._handle_connection] Waiting for player's hello...")
-                initial_message, pending_data = self._message_stream.receive_one_message(
-                    pending_data=None, tcp_connection=tcp_connection, player_from=new_player)
-
-                if not isinstance(initial_message, MessageHello) or initial_message.data_dict["name"].strip() == "":
-                    message = MessageBye(
-                        player_from=self.server_player, id=new_player.id,
-                        extra_info_str="Protocol violation!")
-                    self._message_stream.send_message(message=message, tcp_connection=tcp_connection)
-                    return
-                # Check for password if necessary
-                if self.password is not None:
-                    if initial_message.data_dict["password"] != self.password:
-                        print(">>>>>> self {}".format(self.password))
-
-                        message = MessageBye(
-                            player_from=self.server_player, id=new_player.id,
-                            extra_info_str="Wrong user/pass!".format(initial_message))
-                        self._message_stream.send_message(message=message, tcp_connection=tcp_connection)
-                        return
-                # Check name is unique and satisfies restrictions
-                new_player.name = initial_message.data_dict["name"].strip()
-                if len(new_player.name) > max_player_name_length:
-                    message = MessageBye(
-                        player_from=self.server_player, id=new_player.id, extra_info_str="Invalid name")
-                    self._message_stream.send_message(message=message, tcp_connection=tcp_connection)
-                    return
-                for player in self.player_list:
-                    if player.name.strip().lower() == initial_message.data_dict["name"].strip().lower():
-                        message = MessageBye(
-                            player_from=self.server_player, id=new_player.id,
-                            extra_info_str="Name already in use - please connect again.")
-                        self._message_stream.send_message(message=message, tcp_connection=tcp_connection)
-                        return
-                if be_verbose:
-                    print("[tcpserver._handle_connection] Player connected!", new_player)
-
-                # Add player to the list and notify other players
-                self.player_list.append(new_player)
-                self._player_outgoing_messages[new_player] = queue.Queue()
-                t = threading.Thread(target=self._send_messages_to_player, args=(new_player,))
-                t.daemon = True
-                t.start()
+                try:
+                    initial_message, pending_data = self._message_stream.receive_one_message(
+                        pending_data=None, tcp_connection=tcp_connection, player_from=new_player,
+                        deadline=time.monotonic() + login_timeout_seconds)
+                    refusal = self._get_login_refusal(initial_message)
+                except TimeoutError:
+                    refusal = "Login timeout!"
+            if refusal is None:
+                refusal = self._register_player(new_player=new_player, initial_message=initial_message,
+                                                outgoing_messages=queue.Queue())
+            if refusal is not None:
+                message = MessageBye(player_from=self.server_player, id=new_player.id, extra_info_str=refusal)
+                self._message_stream.send_message(message=message, tcp_connection=tcp_connection)
+                return
 
-                for player in self.player_list:
-                    if be_verbose:
-                        print(f"[tcpserver._handle_connection]: Notifying {player} for new player {new_player}")
-
-                    self._outgoing_messages.put(MessageHello(player_from=new_player,
-                                                             player_to=player,
-                                                             name=new_player.name,
-                                                             id=new_player.id))
-
-                self._outgoing_messages.put(MessagePlayerList(
-                    player_from=self.server_player,
-                    player_to=new_player,
-                    player_list=list(self.player_list)))
-
-                for open_challenge in self.pending_challenge_messages:
-                    if open_challenge.recipient_id is None:
-                        message = MessageChallenge(
-                            player_from=self.server_player,
-                            player_to=new_player,
-                            origin_id=open_challenge.origin_id,
-                            recipient_id=open_challenge.recipient_id)
-                        if be_superverbose:
-                            print("[tcpserver._handle_connection]:  Notifying of open challenges "
-                                  "to new player {}:\n{}".format(
-                                new_player, message))
-                        self._outgoing_messages.put(message)
+            t = threading.Thread(target=self._send_messages_to_player, args=(new_player,))
+            t.daemon = True
+            t.start()
 
             # Get all messages from this player
             self._message_stream.receive_messages(
-                queue=self._incoming_messages,
+                queue=GenericGameServer._IncomingMessageDispatcher(self),
                 tcp_connection=tcp_connection,
                 player_from=new_player,
                 pending_data=pending_data)
@@ -306,41 +427,261 @@ class GenericGameServer:
                 try:
                     if be_verbose:
                         print("[tcpserver._handle_connection] Closing connection for", new_player)
-                    with self._lock:
-                        tcp_connection.shutdown(socket.SHUT_RDWR)
-                        tcp_connection.close()
+                    tcp_connection.shutdown(socket.SHUT_RDWR)
+                    tcp_connection.close()
                 except OSError:
                     pass
 
             # Cleanup and say good-bye to other players
             with self._lock:
-                if be_verbose:
-                    print("[tcpserver._handle_connection] Removing player {} from server and notifying".format(
-                        new_player))
+                self._end_login(new_player)
+                self._remove_player(new_player)
+
+    async def _handle_connection_async(self, reader, writer):
+        """Handle a connection request with the asyncio engine. This is invoked in a separate task
+        of the event loop for each connection, and incoming messages are processed within that task.
+        """
+        tcp_connection = writer.get_extra_info("socket")
+        client_ip, client_port = writer.get_extra_info("peername")[:2]
+        new_player = Player(tcp_connection=tcp_connection, ip=client_ip, port=client_port, server=self)
+        TCPMessageStream.configure_connection(tcp_connection)
 
-                # Remove any pending challenges from the player
+        try:
+            refusal = self._start_login(new_player)
+            if refusal is None:
+                # Other connections are served while waiting for Hello from player
+                if be_verbose:
+                    print("[tcpserver._handle_connection_async] Waiting for player's hello...")
                 try:
-                    dummyChallenge = MessageChallenge(origin_id=new_player.id)
-                    self.pending_challenge_messages.remove(dummyChallenge)
-                except ValueError:
-                    pass
+                    initial_message = await asyncio.wait_for(
+                        self._async_message_stream.read_message(reader, player_from=new_player),
+                        timeout=login_timeout_seconds)
+                    refusal = self._get_login_refusal(initial_message)
+                except asyncio.TimeoutError:
+                    refusal = "Login timeout!"
+            if refusal is None:
+                refusal = self._register_player(new_player=new_player, initial_message=initial_message,
+                                                outgoing_messages=GenericGameServer._AsyncOutbox(
+                                                    writer=writer, player=new_player,
+                                                    message_stream=self._async_message_stream))
+            if refusal is not None:
+                message = MessageBye(player_from=self.server_player, id=new_player.id, extra_info_str=refusal)
+                self._async_message_stream.write_messages([message], writer)
+                return
+
+            # Process all messages from this player
+            async for message in self._async_message_stream.iterate_messages(reader, player_from=new_player):
+                self.process_incoming_message(message)
+
+        except MessageException as ex:
+            if be_verbose:
+                print("[tcpserver._handle_connection_async] Wrong message syntax for {}: {}. Kicking them!".format(
+                    new_player, ex))
+
+        except IOError:
+            # Connection was closed
+            if be_verbose:
+                print("[tcpserver._handle_connection_async] Broken connection from {}:{}".format(
+                    client_ip, client_port))
+
+        except asyncio.CancelledError:
+            # The server is shutting down
+            pass
+
+        finally:
+            # Pending data are still sent before closing
+            writer.close()
+            with self._lock:
+                self._end_login(new_player)
+                self._remove_player(new_player)
+
+    def _start_login(self, new_player):
+        """Check the connection count limits for a new connection, including connections still logging in.
+        If the connection is accepted, it is counted as logging in until `_end_login()` is invoked.
+
+        :return: None if the connection is accepted, or the reason to refuse it otherwise
+        """
+        with self._lock:
+            if len(self.player_by_id) + len(self._logging_in_players) > max_connections \
+                    or self.player_count_by_ip.get(new_player.ip, 0) \
+                    + self._login_count_by_ip.get(new_player.ip, 0) + 1 > max_connections_per_ip:
+                return "Too many connections!"
+            self._logging_in_players.add(new_player)
+            self._login_count_by_ip[new_player.ip] = self._login_count_by_ip.get(new_player.ip, 0) + 1
+        if be_verbose:
+            print("[tcpserver._start_login] Valid incoming connection from {}:{}".format(
+                new_player.ip, new_player.port))
+        return None
+
+    def _end_login(self, new_player):
+        """Stop counting a connection as logging in, if it still was. Must be invoked with self._lock held.
+        """
+        if new_player in self._logging_in_players:
+            self._logging_in_players.remove(new_player)
+            self._login_count_by_ip[new_player.ip] -= 1
+            if self._login_count_by_ip[new_player.ip] == 0:
+                del self._login_count_by_ip[new_player.ip]
+
+    def _register_player(self, new_player, initial_message, outgoing_messages):
+        """Complete the login of a player whose initial message has been validated with `_get_login_refusal()`,
+        adding them to the server unless their name is already in use. Only this step holds the lock.
 
-                self.active_game_by_id = {id: game
-                                          for id, game in self.active_game_by_id.items()
-                                          if new_player not in [game.player_a, game.player_b]}
+        :param outgoing_messages: object where messages for this player are put (see `send_message_to_player()`)
+
+        :return: None if the player has been added, or the reason to refuse the login otherwise
+        """
+        with self._lock:
+            self._end_login(new_player)
+            if initial_message.data_dict["name"].strip().lower() in self.player_by_lower_name:
+                return "Name already in use - please connect again."
+            self._add_player(new_player=new_player, initial_message=initial_message,
+                             outgoing_messages=outgoing_messages)
+        return None
+
+    def _get_login_refusal(self, initial_message):
+        """Check the first message of a new connection, which must be a MessageHello with
+        the server's password and a valid name. It can be invoked without holding any lock,
+        since name uniqueness is checked by `_register_player()`.
+
+        :return: None if the login is accepted, or the reason to refuse it otherwise
+        """
+        if not isinstance(initial_message, MessageHello) or initial_message.data_dict["name"].strip() == "":
+            return "Protocol violation!"
+        # Check for password if necessary
+        if self.password is not None and initial_message.data_dict["password"] != self.password:
+            return "Wrong user/pass!"
+        # Check name satisfies restrictions (uniqueness is checked at registration)
+        name = initial_message.data_dict["name"].strip()
+        if len(name) > max_player_name_length:
+            return "Invalid name"
+        return None
+
+    def _add_player(self, new_player, initial_message, outgoing_messages):
+        """Add a player whose login has been accepted, and notify them and the other players.
+        Must be invoked with self._lock held.
+
+        :param outgoing_messages: object where messages for this player are put (see `send_message_to_player()`)
+        """
+        new_player.name = initial_message.data_dict["name"].strip()
+        new_player.binary_protocol = allow_binary_protocol and initial_message.binary_protocol is True
+        if be_verbose:
+            print("[tcpserver._add_player] Player connected!", new_player)
 
-                if new_player in self.player_list:
-                    self.player_list.remove(new_player)
-                    message = MessageBye(id=new_player.id, extra_info_str="Player quit")
-                    for player in self.player_list:
-                        self.send_message_to_player(player=player, message=message)
-                    del self._player_outgoing_messages[new_player]
+        # Add player to the indexes and notify other players
+        self.player_by_id[new_player.id] = new_player
+        self.player_by_lower_name[new_player.name.lower()] = new_player
+        self.player_count_by_ip[new_player.ip] = self.player_count_by_ip.get(new_player.ip, 0) + 1
+        self._player_outgoing_messages[new_player] = outgoing_messages
+
+        if be_verbose:
+            print(f"[tcpserver._add_player]: Notifying {len(self.player_by_id)} players for new player {new_player}")
+        self.broadcast_message(MessageHello(player_from=new_player,
+                                            name=new_player.name,
+                                            id=new_player.id,
+                                            binary_protocol=allow_binary_protocol))
+
+        self.send_message_to_player(player=new_player, message=MessagePlayerList(
+            player_from=self.server_player,
+            player_to=new_player,
+            player_list=list(self.player_by_id.values())))
+
+        for open_challenge in self.challenges_by_recipient_id.get(None, dict()).values():
+            message = MessageChallenge(
+                player_from=self.server_player,
+                player_to=new_player,
+                origin_id=open_challenge.origin_id,
+                recipient_id=open_challenge.recipient_id)
+            if be_superverbose:
+                print("[tcpserver._add_player]:  Notifying of open challenges "
+                      "to new player {}:\n{}".format(
+                    new_player, message))
+            self.send_message_to_player(player=new_player, message=message)
+
+    def _remove_player(self, player):
+        """Remove a disconnected player from the server, along with their challenges and games,
+        and say good-bye to the other players. Must be invoked with self._lock held.
+        """
+        if be_verbose:
+            print("[tcpserver._remove_player] Removing player {} from server and notifying".format(player))
+
+        # Remove any pending challenges from the player
+        challenge = self.challenge_by_origin_id.get(player.id)
+        if challenge is not None:
+            self._remove_challenge(challenge)
+
+        for game in list(self.active_games_by_player_id.get(player.id, [])):
+            self._remove_game(game)
+
+        if self.player_by_id.get(player.id) is player:
+            del self.player_by_id[player.id]
+            del self.player_by_lower_name[player.name.lower()]
+            self.player_count_by_ip[player.ip] -= 1
+            if self.player_count_by_ip[player.ip] == 0:
+                del self.player_count_by_ip[player.ip]
+            self.broadcast_message(MessageBye(id=player.id, extra_info_str="Player quit"))
+            del self._player_outgoing_messages[player]
+
+    def _add_challenge(self, challenge):
+        """Add a pending challenge to the indexes. Must be invoked with self._lock held.
+        """
+        self.challenge_by_origin_id[challenge.origin_id] = challenge
+        self.challenges_by_recipient_id.setdefault(challenge.recipient_id, dict())[challenge.origin_id] = challenge
+
+    def _remove_challenge(self, challenge):
+        """Remove a pending challenge from the indexes. Must be invoked with self._lock held.
+        """
+        del self.challenge_by_origin_id[challenge.origin_id]
+        challenges = self.challenges_by_recipient_id[challenge.recipient_id]
+        del challenges[challenge.origin_id]
+        if not challenges:
+            del self.challenges_by_recipient_id[challenge.recipient_id]
+
+    def _add_game(self, game):
+        """Add an active game to the indexes. Must not be invoked while holding a game lock.
+        """
+        with self._games_lock:
+            self.active_game_by_id[game.id] = game
+            self._game_lock_by_id[game.id] = threading.RLock()
+            for player in (game.player_a, game.player_b):
+                self.active_games_by_player_id.setdefault(player.id, []).append(game)
+
+    def _remove_game(self, game):
+        """Remove an active game from the indexes, if it is still there.
+        Must not be invoked while holding a game lock.
+        """
+        with self._games_lock:
+            if self.active_game_by_id.get(game.id) is not game:
+                return
+            del self.active_game_by_id[game.id]
+            self._game_lock_by_id.pop(game.id, None)
+            for player in (game.player_a, game.player_b):
+                games = self.active_games_by_player_id[player.id]
+                games.remove(game)
+                if not games:
+                    del self.active_games_by_player_id[player.id]
+
+    def get_active_game(self, player):
+        """Get the active game in which player participates (the oldest one if there are several),
+        or None if there is none.
+        """
+        with self._games_lock:
+            games = self.active_games_by_player_id.get(player.id)
+            return games[0] if games else None
+
+    def get_game_lock(self, game):
+        """Get the lock that protects the state of a game.
+        A new lock is returned for games not active anymore, which are not modified by other threads.
+        """
+        with self._games_lock:
+            if self.active_game_by_id.get(game.id) is game:
+                return self._game_lock_by_id[game.id]
+        return threading.RLock()
 
     class _ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         """Threaded TCP server, obviously, as described in
         https://docs.python.org/2/library/socketserver.html#asynchronous-mixins
         """
-        pass
+        request_queue_size = listen_backlog
 
     class _RequestHandler(socketserver.BaseRequestHandler):
         """Wrapper for GenericGameServer._handle_connection(·)
@@ -350,6 +691,77 @@ class GenericGameServer:
         def handle(self):
             self.game_server._handle_connection(self.request, *self.client_address)
 
+    class _IncomingMessageDispatcher:
+        """Queue-like object where the threads engine puts incoming messages, which are forwarded
+        to the lobby queue or to a game worker's queue (see `_get_incoming_message_queue()`).
+        """
+
+        def __init__(self, game_server):
+            self.game_server = game_server
+
+        def put(self, message):
+            self.game_server._get_incoming_message_queue(message).put(message)
+
+    class _AsyncOutbox:
+        """Outgoing messages for a player with the asyncio engine, used instead of the player's outgoing queue.
+        All messages put during one iteration of the event loop are written together in the next one
+        (see `coalesce_outgoing_messages`), without blocking the loop. Since writes are not awaited,
+        the connection is aborted if more than `max_pending_output_bytes` are waiting to be sent.
+        """
+
+        def __init__(self, writer, player, message_stream):
+            """Must be created within the event loop's thread.
+            """
+            self.writer = writer
+            self.player = player
+            self.message_stream = message_stream
+            self.loop = asyncio.get_running_loop()
+            self.loop_thread_id = threading.get_ident()
+            self.pending_messages = []
+
+        def put(self, message):
+            """Write a message or an already framed message to the player.
+            It can be invoked from any thread.
+            """
+            if threading.get_ident() != self.loop_thread_id:
+                self.loop.call_soon_threadsafe(self.put, message)
+                return
+            if message is GenericGameServer._close_connection:
+                self.close()
+                return
+            if not self.pending_messages:
+                self.loop.call_soon(self.flush)
+            self.pending_messages.append(message)
+
+        def flush(self):
+            """Write all pending messages to the player's connection.
+            """
+            messages, self.pending_messages = self.pending_messages, []
+            if not messages or self.writer.is_closing():
+                return
+            if coalesce_outgoing_messages:
+                self.message_stream.write_messages(messages, self.writer, binary=self.player.binary_protocol)
+            else:
+                for message in messages:
+                    self.message_stream.write_messages([message], self.writer, binary=self.player.binary_protocol)
+            if self.writer.transport.get_write_buffer_size() > max_pending_output_bytes:
+                # The player is not reading: pending data are discarded, and the handler of the connection
+                # removes the player when it finds the connection closed
+                if be_verbose:
+                    print("[tcpserver._AsyncOutbox.flush] Too much pending output for {}. Disconnecting them!".format(
+                        self.player))
+                self.writer.transport.abort()
+
+        def close(self):
+            """Close the connection after writing all pending messages.
+            It can be invoked from any thread.
+            """
+            if threading.get_ident() != self.loop_thread_id:
+                self.loop.call_soon_threadsafe(self.close)
+                return
+            self.flush()
+            self.writer.close()
+
     def kick_player(self, player, extra_info_str, notify_others=True):
         if be_verbose:
             print("[tcpserver.kick_player] Kicking ", player, " :: ", extra_info_str)
@@ -357,79 +769,79 @@ class GenericGameServer:
         out_message = MessageBye(
             id=player.id,
             extra_info_str=extra_info_str)
-        with self._lock:
-            self._message_stream.send_message(message=out_message, tcp_connection=player.tcp_connection)
-            player.tcp_connection.shutdown(socket.SHUT_RDWR)
-            player.tcp_connection.close()
-            # Other players are notified as part of the _handle connection lifecycle
+        # The connection is closed by the player's sender after the message is sent, so that no lock is held.
+        # Other players are notified as part of the _handle connection lifecycle
+        self.send_message_to_player(message=out_message, player=player)
+        self.send_message_to_player(message=GenericGameServer._close_connection, player=player)
 
 
 class Py3SinkServer(GenericGameServer):
+    game_message_types = (MessageProposeBoardPlacement.__name__, MessageShot.__name__)
+
+    def __init__(self, *args, **kwargs):
+        GenericGameServer.__init__(self, *args, **kwargs)
+        # Random valid placements suggested to players, refilled in the background
+        self.placement_pool = generation.PlacementPool(max_size=placement_pool_size)
+
     def process_incoming_message(self, in_message):
         if in_message.type == MessageChat.__name__:
             # Overwrite to avoid tampering
             in_message.origin_id = in_message.player_from.id
+            out_message = MessageChat(
+                text=in_message.text,
+                recipient_id=in_message.recipient_id,
+                origin_id=in_message.player_from.id)
             with self._lock:
-                for player in self.player_list:
-                    if in_message.origin_id != player.id \
-                            and (in_message.recipient_id is None or in_message.recipient_id == player.id):
-                        out_message = MessageChat(
-                            text=in_message.text,
-                            recipient_id=in_message.recipient_id,
-                            origin_id=in_message.player_from.id)
-                        self.send_message_to_player(player=player, message=out_message)
+                if in_message.recipient_id is None:
+                    recipients = [player for player in self.player_by_id.values() if in_message.origin_id != player.id]
+                elif in_message.recipient_id != in_message.origin_id and in_message.recipient_id in self.player_by_id:
+                    recipients = [self.player_by_id[in_message.recipient_id]]
+                else:
+                    recipients = []
+                self.broadcast_message(message=out_message, players=recipients)
 
         elif in_message.type == MessageChallenge.__name__:
             if in_message.origin_id != in_message.player_from.id:
-                self.kick_player(player=in_message.player_from.id, extra_info_str="Are you spoofing me?")
+                self.kick_player(player=in_message.player_from, extra_info_str="Are you spoofing me?")
                 return
             if in_message.origin_id == in_message.recipient_id:
-                self.kick_player(player=in_message.player_from.id, extra_info_str="You can't challenge yourself.")
+                self.kick_player(player=in_message.player_from, extra_info_str="You can't challenge yourself.")
                 return
 
             with self._lock:
                 # Check for duplicates and invalid challenges
-                if in_message in self.pending_challenge_messages:
+                if in_message.origin_id in self.challenge_by_origin_id:
                     self.kick_player(player=in_message.player_from, extra_info_str="Don't spam challenges.")
                     return
-                if in_message.player_to is not None and in_message.player_to not in self.player_list:
+                if in_message.player_to is not None and in_message.player_to.id not in self.player_by_id:
                     self.kick_player(player=in_message.player_from,
-                                     extra_info_str="Challenged player {}, but not in current player list {}".format(
-                                         in_message.recipient_id, self.player_list))
+                                     extra_info_str="Challenged player {}, but not in current player list".format(
+                                         in_message.recipient_id))
                     return
 
-                if Battl3ship.players_to_id(in_message.player_from,
-                                            in_message.player_to) in list(self.active_game_by_id.values()):
-                    self.kick_player(player=in_message.player_from.id, extra_info_str="Cannot duplicate game.")
+                if any(in_message.recipient_id in (game.player_a.id, game.player_b.id)
+                       for game in self.active_games_by_player_id.get(in_message.origin_id, [])):
+                    self.kick_player(player=in_message.player_from, extra_info_str="Cannot duplicate game.")
                     return
 
                 # Transform cross-challenges into challenge acceptances
-                try:
-                    cross_challenges = [challenge
-                                        for challenge in self.pending_challenge_messages
-                                        if challenge.recipient_id == in_message.origin_id]
-                    cross_challenges += [challenge
-                                         for challenge in self.pending_challenge_messages
-                                         if challenge.recipient_id is None]
-
-                    cross_challenge = cross_challenges[0]
+                # (challenges to this player first, then open challenges, in posting order)
+                cross_challenges = self.challenges_by_recipient_id.get(in_message.origin_id) \
+                                   or self.challenges_by_recipient_id.get(None)
+                if cross_challenges:
+                    cross_challenge = next(iter(cross_challenges.values()))
                     accept_message = MessageAcceptChallenge(player_from=in_message.player_from,
                                                             origin_id=cross_challenge.origin_id,
                                                             recipient_id=in_message.origin_id)
                     self.process_incoming_message(accept_message)
                     return
-                except IndexError:
-                    # No cross-challenges
-                    pass
 
                 if be_verbose:
                     print("[tcpserver.process_incoming_message] Posting CHALLENGE {}".format(in_message))
-                self.pending_challenge_messages.append(in_message)
+                self._add_challenge(in_message)
 
                 # Notify relevant players
-                for player in self.player_list:
-                    if in_message.recipient_id is None or player.id in [in_message.recipient_id, in_message.origin_id]:
-                        self.send_message_to_player(player=player, message=in_message)
+                self.broadcast_message(message=in_message, players=self.get_challenge_players(in_message))
 
         elif in_message.type == MessageCancelChallenge.__name__:
             with self._lock:
@@ -437,74 +849,57 @@ class Py3SinkServer(GenericGameServer):
 
         elif in_message.type == MessageAcceptChallenge.__name__:
             with self._lock:
-                try:
-                    accepted_challenge = [challenge
-                                          for challenge in self.pending_challenge_messages
-                                          if challenge.origin_id == in_message.origin_id][0]
-                    if accepted_challenge.recipient_id is not None and accepted_challenge.recipient_id != in_message.player_from.id:
-                        self.kick_player(player=in_message.player_from, extra_info_str="Don't try to fool us!")
-                        return
-
-                    # Create and add game
-                    player_a = [player
-                                for player in self.player_list
-                                if player.id == accepted_challenge.origin_id][0]
-                    player_b = [player
-                                for player in self.player_list
-                                if player.id == in_message.player_from.id][0]
-                    starting_player = random.choice([player_a, player_b])
-                    new_game = Battl3ship(
-                        player_a=player_a,
-                        player_b=player_b,
-                        starting_player=starting_player)
-                    assert new_game.id not in self.active_game_by_id
-                    self.active_game_by_id[new_game.id] = new_game
-
-                    # Notify new game
-                    start_game_message = MessageStartGame(
-                        player_a_id=player_a.id,
-                        player_b_id=player_b.id,
-                        starting_id=starting_player.id)
-                    for p in self.player_list:
-                        if p.id in [accepted_challenge.origin_id, in_message.player_from.id]:
-                            self.send_message_to_player(message=start_game_message, player=p)
-
-                    challenges_to_cancel = [accepted_challenge]
-                    challenges_to_cancel += [challenge
-                                             for challenge in self.pending_challenge_messages
-                                             if accepted_challenge.origin_id == challenge.origin_id \
-                                             and challenge != accepted_challenge]
-                    for challenge in challenges_to_cancel:
-                        self.pending_challenge_messages.remove(challenge)
-                        for p in self.player_list:
-                            cancel_message = MessageCancelChallenge(
-                                origin_id=challenge.origin_id,
-                                player_from=self.server_player, player_to=p)
-                            if p.id in [accepted_challenge.origin_id, accepted_challenge.recipient_id]:
-                                continue
-                            if p.id in [challenge.origin_id, challenge.recipient_id] or challenge.recipient_id is None:
-                                self.send_message_to_player(message=cancel_message, player=p)
-
-                except IndexError:
+                accepted_challenge = self.challenge_by_origin_id.get(in_message.origin_id)
+                player_a = self.player_by_id.get(in_message.origin_id)
+                player_b = self.player_by_id.get(in_message.player_from.id)
+                if accepted_challenge is None or player_a is None or player_b is None:
                     if be_verbose:
                         print("[tcpserver.process_incoming_message] Received bogus ACCEPT {} " \
-                              "not in self.pending_challenge_messages {}".format(in_message,
-                                                                                 self.pending_challenge_messages))
+                              "not in self.challenge_by_origin_id".format(in_message))
+                    return
+                if accepted_challenge.recipient_id is not None and accepted_challenge.recipient_id != in_message.player_from.id:
+                    self.kick_player(player=in_message.player_from, extra_info_str="Don't try to fool us!")
+                    return
+
+                # Create and add game
+                starting_player = random.choice([player_a, player_b])
+                new_game = Battl3ship(
+                    player_a=player_a,
+                    player_b=player_b,
+                    starting_player=starting_player)
+                assert new_game.id not in self.active_game_by_id
+                self._add_game(new_game)
+
+                # Notify new game
+                start_game_message = MessageStartGame(
+                    player_a_id=player_a.id,
+                    player_b_id=player_b.id,
+                    starting_id=starting_player.id)
+                for p in (player_a, player_b):
+                    self.send_message_to_player(message=start_game_message, player=p)
+
+                # There is only one challenge per origin. Directed challenges concern only the two players
+                # of the game, and open ones are cancelled for everybody else.
+                self._remove_challenge(accepted_challenge)
+                if accepted_challenge.recipient_id is None:
+                    cancel_message = MessageCancelChallenge(
+                        origin_id=accepted_challenge.origin_id,
+                        player_from=self.server_player)
+                    self.broadcast_message(message=cancel_message, players=[
+                        p for p in self.player_by_id.values() if p.id != accepted_challenge.origin_id])
 
         elif in_message.type == MessageProposeBoardPlacement.__name__:
-            with self._lock:
-                if be_verbose:
-                    print("[tcpserver.process_incoming_message] Received BOARD PLACEMENT")
+            # Game messages don't need the lobby lock
+            if be_verbose:
+                print("[tcpserver.process_incoming_message] Received BOARD PLACEMENT")
 
-                try:
-                    game = [game
-                            for game in list(self.active_game_by_id.values())
-                            if in_message.player_from.id in [game.player_a.id, game.player_b.id]][0]
-                except IndexError:
-                    self.kick_player(in_message.player_from,
-                                     extra_info_str="Error! Board placement for game not active")
-                    return
+            game = self.get_active_game(in_message.player_from)
+            if game is None:
+                self.kick_player(in_message.player_from,
+                                 extra_info_str="Error! Board placement for game not active")
+                return
 
+            with self.get_game_lock(game):
                 try:
                     game.set_boats(player=in_message.player_from, row_col_lists=in_message.boat_row_col_lists)
                     if game.player_a_board.locked and game.player_b_board.locked:
@@ -515,20 +910,24 @@ class Py3SinkServer(GenericGameServer):
                         print("[tcpserver.process_incoming_message] Exception setting boards: {}".format(ex))
                     self.kick_player(player=in_message.player_from, extra_info_str="Invalid boat placement!")
 
+        elif in_message.type == MessageRequestPlacementSuggestion.__name__:
+            # The pool is thread-safe, no need to hold the lock
+            self.send_message_to_player(
+                message=MessagePlacementSuggestion(boat_row_col_lists=self.placement_pool.get_placement()),
+                player=in_message.player_from)
+
         elif in_message.type == MessageShot.__name__:
-            with self._lock:
-                if be_verbose:
-                    print("[tcpserver.process_incoming_message] Received Shot")
+            if be_verbose:
+                print("[tcpserver.process_incoming_message] Received Shot")
 
-                try:
-                    game = [game
-                            for game in list(self.active_game_by_id.values())
-                            if in_message.player_from.id in [game.player_a.id, game.player_b.id]][0]
-                except IndexError:
-                    self.kick_player(player=in_message.player_from,
-                                     extra_info_str="Shot in a non-active game.")
-                    return
+            game = self.get_active_game(in_message.player_from)
+            if game is None:
+                self.kick_player(player=in_message.player_from,
+                                 extra_info_str="Shot in a non-active game.")
+                return
 
+            game_finished = False
+            with self.get_game_lock(game):
                 if not game.accepting_shots:
                     self.kick_player(player=in_message.player_from,
                                      extra_info_str="Shot in a game not accepting shots.")
@@ -561,44 +960,499 @@ class Py3SinkServer(GenericGameServer):
                             in_message, hit_length_list, sunk_length_list, game_finished))
 
                     if game_finished:
-                        if be_verbose:
-                            print("[process_incoming_message] Finishing game {}".format(game))
-                        del (self.active_game_by_id[game.id])
+                        # The game is removed after releasing its lock, to respect the lock order
+                        game.accepting_shots = False
 
                 except (IndexError, ValueError):
                     self.kick_player(player=in_message.player_from,
                                      extra_info_str="Invalid shot")
                     return
 
+            if game_finished:
+                if be_verbose:
+                    print("[process_incoming_message] Finishing game {}".format(game))
+                self._remove_game(game)
+
         else:
             print("[tcpserver.process_incoming_message] Ignoring incoming in_message", in_message)
 
 
-def start_server(port, password):
+def start_server(port, password, engine=None):
     """Start the game server and serve forever
+
+    :param engine: one of `server_engines`, or None to use `default_engine`
     """
     if be_verbose:
         print("Starting on server_port {}".format(port))
-    server = Py3SinkServer(port=port, password=password)
+    server = Py3SinkServer(port=port, password=password, engine=engine)
     server.serve_forever()
 
 
 ############################ Begin main executable part
 
+def get_target_cells(opponent_placement, board_width=Battl3ship.default_board_width,
+                     board_height=Battl3ship.default_board_height):
+    """Get a random order of the cells to shoot against opponent_placement, to be taken with pop().
+
+    Cells cannot be shot twice, so the game could not finish if the last target cell had a boat:
+    a water cell is always left at index 0.
+
+    :param opponent_placement: list of boats of the opponent, each one a list of [row, col] cells
+    :return: a list with the (row, col) of all cells of the board
+    """
+    boat_cells = set(tuple(row_col) for row_col_list in opponent_placement for row_col in row_col_list)
+    target_cells = [(row, col) for row in range(1, board_height + 1) for col in range(1, board_width + 1)]
+    random.shuffle(target_cells)
+    water_index = [i for i, row_col in enumerate(target_cells) if row_col not in boat_cells][0]
+    target_cells[0], target_cells[water_index] = target_cells[water_index], target_cells[0]
+    return target_cells
+
+
+def test_silent_connections(silent_connection_count=1000, engines=None):
+    """Check that connections which never send their MessageHello do not block other players: a new pair of
+    players can still log in, and the shot latency of their game is close to the one without silent connections.
+    """
+    global max_connections, max_connections_per_ip
+    import tcpclient
+
+    def wait_for_message(message_queue, message_class, timeout=5):
+        deadline = time.monotonic() + timeout
+        while True:
+            message = message_queue.get(timeout=max(0, deadline - time.monotonic()))
+            if isinstance(message, message_class):
+                return message
+
+    def play(port, name_prefix):
+        """Log in two players and let them play a game.
+
+        :return: the sorted shot latencies, in seconds
+        """
+        clients = []
+        for name in [name_prefix + "A", name_prefix + "B"]:
+            message_queue = queue.Queue()
+            client = tcpclient.Py3SinkClient(local_host_ip, port, name, None, callback_incoming_message=message_queue.put)
+            client.connect()
+            clients.append((client, message_queue))
+        (client_a, queue_a), (client_b, queue_b) = clients
+        client_a.send_message(MessageChallenge(origin_id=client_a.player.id, recipient_id=client_b.player.id))
+        wait_for_message(queue_b, MessageChallenge)
+        client_b.send_message(MessageAcceptChallenge(origin_id=client_a.player.id, recipient_id=client_b.player.id))
+        starting_id = wait_for_message(queue_a, MessageStartGame).starting_id
+        wait_for_message(queue_b, MessageStartGame)
+
+        placements = [generation.RandomBoatPlacer().get_random_placement() for _ in clients]
+        target_cells_by_id = dict()
+        for (client, message_queue), placement, opponent_placement in zip(clients, placements, placements[::-1]):
+            client.send_message(MessageProposeBoardPlacement(boat_row_col_lists=placement))
+            target_cells_by_id[client.player.id] = get_target_cells(opponent_placement)
+
+        latencies = []
+        client_by_id = {client.player.id: (client, message_queue) for client, message_queue in clients}
+        turn_id = starting_id
+        game_finished = False
+        while not game_finished:
+            client, message_queue = client_by_id[turn_id]
+            wait_for_message(message_queue, MessageShot)
+            time_before = time.perf_counter()
+            client.send_message(MessageShot(row_col_lists=[
+                target_cells_by_id[turn_id].pop() for _ in range(Battl3ship.shots_per_turn)]))
+            game_finished = wait_for_message(message_queue, MessageShotResult).game_finished
+            latencies.append(time.perf_counter() - time_before)
+            turn_id = client_a.player.id if turn_id == client_b.player.id else client_b.player.id
+        for client, _ in clients:
+            client.disconnect()
+        return sorted(latencies)
+
+    original_limits = max_connections, max_connections_per_ip
+    max_connections = max_connections_per_ip = silent_connection_count + 16
+    try:
+        for engine in engines if engines is not None else server_engines:
+            with socket.socket() as s:
+                s.bind((local_host_ip, 0))
+                port = s.getsockname()[1]
+            server = Py3SinkServer(port=port, engine=engine)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            while True:
+                try:
+                    socket.create_connection((local_host_ip, port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+
+            baseline_latencies = play(port, "Baseline")
+            silent_connections = [socket.create_connection((local_host_ip, port))
+                                  for _ in range(silent_connection_count)]
+            time_before = time.perf_counter()
+            latencies = play(port, "Busy")
+            game_time = time.perf_counter() - time_before
+            for silent_connection in silent_connections:
+                silent_connection.close()
+            server.shutdown()
+
+            baseline_median, median = baseline_latencies[len(baseline_latencies) // 2], latencies[len(latencies) // 2]
+            print("[watch] {} engine, {} silent connections: game played in {:.2f} s, "
+                  "median shot latency {:.2f} ms (baseline {:.2f} ms)".format(
+                      engine, silent_connection_count, game_time, 1e3 * median, 1e3 * baseline_median))
+            assert game_time < login_timeout_seconds, "Game blocked by silent connections"
+            assert median < 3 * baseline_median + 0.02, "Shot latency degraded by silent connections"
+    finally:
+        max_connections, max_connections_per_ip = original_limits
+
+
 def test():
     print()
-    test_message()
+    test_silent_connections()
 
     print("[All tests ok!]")
 
 
+def benchmark_burst_sending(burst_size=64, burst_count=100):
+    """Measure the latency of bursts of messages sent to a single player, and the number of
+    socket calls needed to send them, with and without coalescing writes and Nagle's algorithm.
+    """
+    global coalesce_outgoing_messages
+
+    class BurstCounter:
+        """Queue-like object that signals when a whole burst has been received
+        """
+
+        def __init__(self):
+            self.received_count = 0
+            self.burst_received = threading.Event()
+
+        def put(self, message):
+            if isinstance(message, MessageChat):
+                self.received_count += 1
+                if self.received_count % burst_size == 0:
+                    self.burst_received.set()
+
+    def receive_until_closed(message_stream, queue, tcp_connection):
+        try:
+            message_stream.receive_messages(queue=queue, tcp_connection=tcp_connection)
+        except IOError:
+            pass
+
+    socket_call_count = 0
+    original_sendall, original_setsockopt = socket.socket.sendall, socket.socket.setsockopt
+
+    def counting_sendall(*args, **kwargs):
+        nonlocal socket_call_count
+        socket_call_count += 1
+        return original_sendall(*args, **kwargs)
+
+    def counting_setsockopt(*args, **kwargs):
+        nonlocal socket_call_count
+        socket_call_count += 1
+        return original_setsockopt(*args, **kwargs)
+
+    original_config = (coalesce_outgoing_messages, tcpmessagestream.tcp_nodelay, tcpmessagestream.use_tcp_cork)
+    server = Py3SinkServer(port=0)
+    server.port = server._tcp_server.server_address[1]
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    try:
+        for label, coalesce, nodelay, cork in [("one write per message, Nagle", False, False, False),
+                                               ("one write per message, TCP_NODELAY", False, True, False),
+                                               ("coalesced, TCP_NODELAY", True, True, False),
+                                               ("coalesced, TCP_NODELAY + TCP_CORK", True, True, True)]:
+            coalesce_outgoing_messages = coalesce
+            tcpmessagestream.tcp_nodelay = nodelay
+            tcpmessagestream.use_tcp_cork = cork
+
+            # Connect a new player for each configuration, since socket options are set when connecting
+            name = "BenchmarkPlayer{}".format(int(coalesce) + 2 * int(nodelay) + 4 * int(cork))
+            client_stream = TCPMessageStream(bytes_message_length=BYTES_MESSAGE_FIELD,
+                                             max_message_length=MAX_MESSAGE_LENGTH,
+                                             buffer_size=BUFFER_SIZE)
+            client_socket = socket.create_connection((local_host_ip, server.port))
+            TCPMessageStream.configure_connection(client_socket)
+            client_stream.send_message(MessageHello(name=name, password=None), tcp_connection=client_socket)
+            burst_counter = BurstCounter()
+            receiving_thread = threading.Thread(target=receive_until_closed,
+                                                args=(client_stream, burst_counter, client_socket))
+            receiving_thread.daemon = True
+            receiving_thread.start()
+            while True:
+                with server._lock:
+                    player = server.player_by_lower_name.get(name.lower())
+                if player is not None:
+                    break
+                time.sleep(0.01)
+
+            socket.socket.sendall, socket.socket.setsockopt = counting_sendall, counting_setsockopt
+            socket_call_count = 0
+            latencies = []
+            try:
+                for _ in range(burst_count):
+                    burst_counter.burst_received.clear()
+                    time_before = time.perf_counter()
+                    for i in range(burst_size):
+                        server.send_message_to_player(
+                            message=MessageChat(text="Burst message {}".format(i), origin_id=player.id),
+                            player=player)
+                    burst_counter.burst_received.wait()
+                    latencies.append(time.perf_counter() - time_before)
+            finally:
+                socket.socket.sendall, socket.socket.setsockopt = original_sendall, original_setsockopt
+
+            latencies.sort()
+            print("[watch] {}: median burst latency = {:.2f} ms, max = {:.2f} ms, "
+                  "socket calls/burst = {:.1f}".format(
+                label, 1e3 * latencies[len(latencies) // 2], 1e3 * latencies[-1], socket_call_count / burst_count))
+            client_socket.shutdown(socket.SHUT_RDWR)
+            client_socket.close()
+    finally:
+        coalesce_outgoing_messages, tcpmessagestream.tcp_nodelay, tcpmessagestream.use_tcp_cork = original_config
+        server.shutdown()
+
+
+def serve_benchmark(port, engine, player_count):
+    """Run a server that accepts player_count players from the same ip, until killed.
+    """
+    global max_connections, max_connections_per_ip
+    max_connections = max_connections_per_ip = player_count + 16
+    Py3SinkServer(port=port, engine=engine).serve_forever()
+
+
+def benchmark_engines(player_count=10000, engines=None, probe_count=16, round_trip_count=50, login_concurrency=64):
+    """Measure, for each engine, the time needed to log in player_count concurrent players
+    and the latency profile of requests served while all of them are connected.
+
+    The server runs in a separate process. Players are driven by a single asyncio event loop in this one:
+    most of them just discard everything they receive, while probe_count players send
+    MessageRequestPlacementSuggestion requests and measure the time until the answer is received.
+    Note that each login is notified to all players, so the login cost grows with the square of player_count.
+    """
+    import multiprocessing
+
+    engines = engines if engines is not None else server_engines
+    client_stream = AsyncTCPMessageStream(bytes_message_length=BYTES_MESSAGE_FIELD,
+                                          max_message_length=MAX_MESSAGE_LENGTH,
+                                          buffer_size=BUFFER_SIZE)
+
+    def percentiles(values):
+        values = sorted(values)
+        return ", ".join("p{} = {:.2f} ms".format(p, 1e3 * values[min(len(values) - 1, len(values) * p // 100)])
+                         for p in [50, 90, 99, 100])
+
+    async def log_in(port, name):
+        reader, writer = await asyncio.open_connection(local_host_ip, port)
+        TCPMessageStream.configure_connection(writer.get_extra_info("socket"))
+        time_before = time.perf_counter()
+        client_stream.write_messages([MessageHello(name=name, password=None, binary_protocol=True)], writer)
+        # The server's answer to the login is the broadcast of the player's Hello
+        if not isinstance(await client_stream.read_message(reader), MessageHello):
+            raise Exception("[benchmark_engines] Login failed for {}".format(name))
+        return reader, writer, time.perf_counter() - time_before
+
+    async def discard_all(reader):
+        try:
+            while await reader.read(1 << 16):
+                pass
+        except OSError:
+            pass
+
+    async def probe(reader, writer):
+        latencies = []
+        for _ in range(round_trip_count):
+            time_before = time.perf_counter()
+            client_stream.write_messages([MessageRequestPlacementSuggestion()], writer, binary=True)
+            while not isinstance(await client_stream.read_message(reader), MessagePlacementSuggestion):
+                pass
+            latencies.append(time.perf_counter() - time_before)
+        writer.close()
+        return latencies
+
+    async def run_clients(port):
+        login_semaphore = asyncio.Semaphore(login_concurrency)
+        login_times = []
+        writers = []
+        discarding_tasks = []
+
+        async def log_in_silent(name):
+            async with login_semaphore:
+                reader, writer, login_time = await log_in(port, name)
+            login_times.append(login_time)
+            writers.append(writer)
+            discarding_tasks.append(asyncio.create_task(discard_all(reader)))
+
+        time_before = time.perf_counter()
+        await asyncio.gather(*(log_in_silent("Silent{}".format(i)) for i in range(player_count - probe_count)))
+        total_login_time = time.perf_counter() - time_before
+        probes = [(await log_in(port, "Probe{}".format(i)))[:2] for i in range(probe_count)]
+        latencies = sum(await asyncio.gather(*(probe(reader, writer) for reader, writer in probes)), [])
+
+        for writer in writers:
+            writer.close()
+        for task in discarding_tasks:
+            task.cancel()
+        return total_login_time, login_times, latencies
+
+    for engine in engines:
+        with socket.socket() as s:
+            s.bind((local_host_ip, 0))
+            port = s.getsockname()[1]
+        server_process = multiprocessing.Process(target=serve_benchmark, args=(port, engine, player_count))
+        server_process.start()
+        try:
+            while True:
+                try:
+                    socket.create_connection((local_host_ip, port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            total_login_time, login_times, latencies = asyncio.run(run_clients(port))
+            print("[watch] {} engine, {} players: all logged in after {:.1f} s, login time {}".format(
+                engine, player_count, total_login_time, percentiles(login_times)))
+            print("[watch] {} engine, {} players: request latency {}".format(
+                engine, player_count, percentiles(latencies)))
+        except Exception as ex:
+            print("[watch] {} engine, {} players: failed ({})".format(engine, player_count, repr(ex)))
+        finally:
+            server_process.kill()
+            server_process.join()
+
+
+def benchmark_lobby_size(player_counts=(10, 1000, 10000), measured_pair_count=5, round_count=20):
+    """Measure the time needed by Py3SinkServer.process_incoming_message for the messages of a game
+    (challenge, acceptance, placements and shots) and for private chat messages, as the number of players grows.
+
+    Messages are processed directly, without connections. All players are paired in active games,
+    but only measured_pair_count pairs play round_count complete games.
+    """
+
+    class DiscardingOutbox:
+        def put(self, message):
+            pass
+
+    for player_count in player_counts:
+        # The asyncio engine does not open any socket until serve_forever is invoked
+        server = Py3SinkServer(engine="asyncio")
+        players = [Player(ip=local_host_ip, server=server) for _ in range(player_count)]
+        for i, player in enumerate(players):
+            server._add_player(new_player=player, initial_message=MessageHello(name="Player{}".format(i)),
+                               outgoing_messages=DiscardingOutbox())
+
+        time_by_type = dict()
+        count_by_type = dict()
+
+        def process(message):
+            time_before = time.perf_counter()
+            server.process_incoming_message(message)
+            time_by_type[message.type] = time_by_type.get(message.type, 0) + time.perf_counter() - time_before
+            count_by_type[message.type] = count_by_type.get(message.type, 0) + 1
+
+        def start_game(player_a, player_b):
+            process(MessageChallenge(player_from=player_a, origin_id=player_a.id, recipient_id=player_b.id))
+            process(MessageAcceptChallenge(player_from=player_b, origin_id=player_a.id, recipient_id=player_b.id))
+
+        # Idle games between the players not measured
+        for i in range(2 * measured_pair_count, player_count - 1, 2):
+            start_game(players[i], players[i + 1])
+
+        for _ in range(round_count):
+            for i in range(0, 2 * measured_pair_count, 2):
+                start_game(players[i], players[i + 1])
+                game = server.get_active_game(players[i])
+                target_cells_by_player = dict()
+                for player, opponent in [(players[i], players[i + 1]), (players[i + 1], players[i])]:
+                    placement = generation.RandomBoatPlacer().get_random_placement()
+                    process(MessageProposeBoardPlacement(player_from=opponent, boat_row_col_lists=placement))
+                    target_cells_by_player[player] = get_target_cells(placement, game.board_width, game.board_height)
+                while server.get_active_game(players[i]) is game:
+                    player = game.player_turn
+                    process(MessageShot(player_from=player, row_col_lists=[
+                        target_cells_by_player[player].pop() for _ in range(Battl3ship.shots_per_turn)]))
+                process(MessageChat(player_from=players[i], recipient_id=players[i + 1].id, text="Good game!"))
+
+        print("[watch] {} players: {}".format(player_count, ", ".join(
+            "{} {:.1f} us".format(message_type, 1e6 * time_by_type[message_type] / count_by_type[message_type])
+            for message_type in [MessageChallenge.__name__, MessageAcceptChallenge.__name__,
+                                 MessageProposeBoardPlacement.__name__, MessageShot.__name__, MessageChat.__name__])))
+
+
+def benchmark_game_workers(player_count=1000, pair_count=5, chat_burst_size=400, chat_burst_interval=0.3):
+    """Measure the latency of shots while the lobby is busy with bursts of public chat messages, with
+    the threads engine processing game messages in the lobby thread (game_worker_count = 0) or in game workers.
+
+    Messages are put directly in the server's incoming queues, and shot latencies are measured until
+    the shot result is put in the shooting player's outgoing queue. pair_count pairs of players play one game each,
+    while the rest of players just receive the chat messages.
+    """
+    global game_worker_count
+
+    class RecordingOutbox:
+        def __init__(self):
+            self.shot_result_received = threading.Event()
+
+        def put(self, message):
+            if isinstance(message, MessageShotResult):
+                self.shot_result_received.set()
+
+    def play(server, player_a, player_b, latencies):
+        game = server.get_active_game(player_a)
+        target_cells_by_player = dict()
+        for player, opponent in [(player_a, player_b), (player_b, player_a)]:
+            placement = generation.RandomBoatPlacer().get_random_placement()
+            server.process_incoming_message(
+                MessageProposeBoardPlacement(player_from=opponent, boat_row_col_lists=placement))
+            target_cells_by_player[player] = get_target_cells(placement, game.board_width, game.board_height)
+        while server.get_active_game(player_a) is game:
+            player = game.player_turn
+            outbox = server._player_outgoing_messages[player]
+            outbox.shot_result_received.clear()
+            time_before = time.perf_counter()
+            dispatcher.put(MessageShot(player_from=player, row_col_lists=[
+                target_cells_by_player[player].pop() for _ in range(Battl3ship.shots_per_turn)]))
+            outbox.shot_result_received.wait()
+            latencies.append(time.perf_counter() - time_before)
+
+    original_game_worker_count = game_worker_count
+    try:
+        for game_worker_count in [0, original_game_worker_count]:
+            server = Py3SinkServer(port=0, engine="threads")
+            dispatcher = GenericGameServer._IncomingMessageDispatcher(server)
+            players = [Player(ip=local_host_ip, server=server) for _ in range(player_count)]
+            for i, player in enumerate(players):
+                server._add_player(new_player=player, initial_message=MessageHello(name="Player{}".format(i)),
+                                   outgoing_messages=RecordingOutbox())
+            for i in range(0, 2 * pair_count, 2):
+                server.process_incoming_message(MessageChallenge(
+                    player_from=players[i], origin_id=players[i].id, recipient_id=players[i + 1].id))
+                server.process_incoming_message(MessageAcceptChallenge(
+                    player_from=players[i + 1], origin_id=players[i].id, recipient_id=players[i + 1].id))
+
+            latencies = []
+            playing_threads = [threading.Thread(target=play, args=(server, players[i], players[i + 1], latencies))
+                               for i in range(0, 2 * pair_count, 2)]
+            for t in playing_threads:
+                t.start()
+            chat_count = 0
+            while any(t.is_alive() for t in playing_threads):
+                for _ in range(chat_burst_size):
+                    dispatcher.put(MessageChat(player_from=players[-1], text="Chat message {}".format(chat_count)))
+                    chat_count += 1
+                time.sleep(chat_burst_interval)
+            server._tcp_server.server_close()
+
+            latencies.sort()
+            print("[watch] {} game workers, {} players, {} chats: shot latency {}".format(
+                game_worker_count, player_count, chat_count, ", ".join(
+                    "p{} = {:.2f} ms".format(p, 1e3 * latencies[min(len(latencies) - 1, len(latencies) * p // 100)])
+                    for p in [50, 90, 99, 100])))
+    finally:
+        game_worker_count = original_game_worker_count
+
+
 def show_help(message=""):
     message = message.strip()
     if message != "":
         print("-" * len(message))
         print(message)
         print("-" * len(message))
-    print("Usage:", os.path.basename(sys.argv[0]), "[<server_port>={}]".format(default_port))
+    print("Usage:", os.path.basename(sys.argv[0]), "[<server_port>={}] [{}={}]".format(
+        default_port, "|".join(server_engines), default_engine))
 
 
 if __name__ == "__main__":
@@ -606,9 +1460,24 @@ if __name__ == "__main__":
         print("Running some tests...")
         test()
         exit(0)
-    if len(sys.argv) not in [1, 2]:
+    if len(sys.argv) == 2 and sys.argv[1].lower() == "benchmark":
+        benchmark_burst_sending()
+        exit(0)
+    if len(sys.argv) == 2 and sys.argv[1].lower() == "benchmark_lobby":
+        benchmark_lobby_size()
+        exit(0)
+    if len(sys.argv) == 2 and sys.argv[1].lower() == "benchmark_game_workers":
+        benchmark_game_workers()
+        exit(0)
+    if len(sys.argv) in [2, 3] and sys.argv[1].lower() == "benchmark_engines":
+        benchmark_engines(**({"player_count": int(sys.argv[2])} if len(sys.argv) == 3 else {}))
+        exit(0)
+    if len(sys.argv) not in [1, 2, 3]:
         show_help("Incorrect argument count")
         exit(1)
+    if len(sys.argv) == 3 and sys.argv[2] not in server_engines:
+        show_help("Invalid engine {}".format(sys.argv[2]))
+        exit(1)
 
     print("/" * 40)
     print("{:/^40s}".format("    SERVER    "))
@@ -617,5 +1486,6 @@ if __name__ == "__main__":
     port = default_port
     if len(sys.argv) >= 2:
         port = int(sys.argv[1])
+    engine = sys.argv[2] if len(sys.argv) == 3 else default_engine
 
-    start_server(port=port, password=default_password)
+    start_server(port=port, password=default_password, engine=engine)